@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+""" Compare build throughput of per-key insertion, batched insertion and
+native ingestion of text files.
+
+Usage: python benchmarks/bench_build.py [NUM_KEYS]
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from rust_fst import Map, Set
+
+
+def make_keys(num_keys):
+    return ["key{:012d}".format(i) for i in range(num_keys)]
+
+
+def build_set_single(keys, path):
+    with Set.build(path) as builder:
+        for key in keys:
+            builder.insert(key)
+
+
+def build_set_batched(keys, path):
+    Set.from_iter(keys, path)
+
+
+def build_map_single(keys, path):
+    with Map.build(path) as builder:
+        for idx, key in enumerate(keys):
+            builder.insert(key, idx)
+
+
+def build_map_batched(keys, path):
+    Map.from_iter(((key, idx) for idx, key in enumerate(keys)), path)
+
+
+def write_keys_file(keys, path):
+    with open(path, 'w') as fp:
+        for key in keys:
+            fp.write(key + '\n')
+
+
+def write_items_file(keys, path):
+    with open(path, 'w') as fp:
+        for idx, key in enumerate(keys):
+            fp.write('{}\t{}\n'.format(key, idx))
+
+
+def run(name, fn, keys, tmpdir):
+    path = os.path.join(tmpdir, 'bench.fst')
+    start = time.time()
+    fn(keys, path)
+    elapsed = time.time() - start
+    print("{:<20} {:>12,.0f} keys/s".format(name, len(keys) / elapsed))
+
+
+def main():
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    keys = make_keys(num_keys)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        run('set (insert)', build_set_single, keys, tmpdir)
+        run('set (insert_many)', build_set_batched, keys, tmpdir)
+        run('map (insert)', build_map_single, keys, tmpdir)
+        run('map (insert_many)', build_map_batched, keys, tmpdir)
+        keys_path = os.path.join(tmpdir, 'keys.txt')
+        items_path = os.path.join(tmpdir, 'items.tsv')
+        write_keys_file(keys, keys_path)
+        write_items_file(keys, items_path)
+        run('set (from_file)',
+            lambda keys, path: Set.from_file(keys_path, path), keys, tmpdir)
+        run('map (from_file)',
+            lambda keys, path: Map.from_file(items_path, path), keys, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+""" Compare membership tests of single keys with batched lookups.
+
+Usage: python benchmarks/bench_contains.py [NUM_KEYS] [NUM_CANDIDATES]
+"""
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+from rust_fst import Set
+
+
+def make_keys(num_keys):
+    return ["key{:012d}".format(i) for i in range(0, 2 * num_keys, 2)]
+
+
+def scalar(fst_set, candidates):
+    return [key in fst_set for key in candidates]
+
+
+def batched(fst_set, candidates):
+    return fst_set.contains_many(candidates)
+
+
+def run(name, fn, fst_set, candidates):
+    start = time.time()
+    fn(fst_set, candidates)
+    elapsed = time.time() - start
+    print("{:<24} {:>12,.0f} keys/s".format(name, len(candidates) / elapsed))
+
+
+def main():
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    num_candidates = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    fst_set = Set.from_iter(make_keys(num_keys))
+    candidates = ["key{:012d}".format(random.randrange(2 * num_keys))
+                  for _ in range(num_candidates)]
+    run('__contains__ loop', scalar, fst_set, candidates)
+    run('contains_many (list)', batched, fst_set, candidates)
+    try:
+        import numpy as np
+    except ImportError:
+        return
+    run('contains_many (ndarray)', batched, fst_set, np.array(candidates))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+""" Compare map lookups of single keys with batched lookups at different
+miss rates.
+
+Usage: python benchmarks/bench_get.py [NUM_KEYS] [NUM_LOOKUPS]
+"""
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+from rust_fst import Map
+
+
+def make_key(idx):
+    return "key{:012d}".format(idx)
+
+
+def scalar(fst_map, keys):
+    values = []
+    for key in keys:
+        try:
+            values.append(fst_map[key])
+        except KeyError:
+            values.append(0)
+    return values
+
+
+def batched(fst_map, keys):
+    return fst_map.get_many(keys, mask=True)
+
+
+def run(name, fn, fst_map, keys):
+    start = time.time()
+    fn(fst_map, keys)
+    elapsed = time.time() - start
+    print("{:<28} {:>12,.0f} keys/s".format(name, len(keys) / elapsed))
+
+
+def main():
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    num_lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    fst_map = Map.from_iter((make_key(i), i)
+                            for i in range(0, 2 * num_keys, 2))
+    for miss_rate in (0.0, 0.5, 0.9):
+        keys = [make_key(2 * random.randrange(num_keys) +
+                         (random.random() < miss_rate))
+                for _ in range(num_lookups)]
+        run('__getitem__ ({:.0%} misses)'.format(miss_rate), scalar,
+            fst_map, keys)
+        run('get_many ({:.0%} misses)'.format(miss_rate), batched,
+            fst_map, keys)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+""" Compare rank and select with the rank index to finding the position of a
+key and the key at a position by iterating over the set.
+
+Usage: python benchmarks/bench_rank.py [NUM_KEYS] [NUM_LOOKUPS]
+"""
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+from rust_fst import Set
+
+
+def make_key(idx):
+    return "key{:012d}".format(idx)
+
+
+def rank_linear(fst_set, keys, positions):
+    for key in keys:
+        fst_set[:key].count()
+
+
+def select_linear(fst_set, keys, positions):
+    for pos in positions:
+        iter(fst_set).take(1, offset=pos)
+
+
+def rank_indexed(fst_set, keys, positions):
+    for key in keys:
+        fst_set.rank(key)
+
+
+def select_indexed(fst_set, keys, positions):
+    for pos in positions:
+        fst_set.select(pos)
+
+
+def run(name, fn, fst_set, keys, positions):
+    start = time.time()
+    fn(fst_set, keys, positions)
+    elapsed = time.time() - start
+    print("{:<20} {:>12,.0f} lookups/s".format(name, len(keys) / elapsed))
+
+
+def main():
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    num_lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    fst_set = Set.from_iter(make_key(i) for i in range(num_keys))
+    positions = [random.randrange(num_keys) for _ in range(num_lookups)]
+    keys = [make_key(pos) for pos in positions]
+    start = time.time()
+    fst_set.build_rank_index()
+    print("{:<20} {:>12.3f} s".format('build_rank_index',
+                                      time.time() - start))
+    run('rank (iteration)', rank_linear, fst_set, keys, positions)
+    run('select (iteration)', select_linear, fst_set, keys, positions)
+    run('rank (index)', rank_indexed, fst_set, keys, positions)
+    run('select (index)', select_indexed, fst_set, keys, positions)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+""" Compare full-scan throughput of set and map iterators for different
+numbers of items fetched per native call.
+
+Usage: python benchmarks/bench_scan.py [NUM_KEYS]
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+from rust_fst import Map, Set
+
+
+def make_keys(num_keys):
+    return ["key{:012d}".format(i) for i in range(num_keys)]
+
+
+def scan(it, batch_size):
+    it.batch_size = batch_size
+    for _ in it:
+        pass
+
+
+def run(name, make_iter, num_keys, batch_size):
+    start = time.time()
+    scan(make_iter(), batch_size)
+    elapsed = time.time() - start
+    print("{:<24} {:>12,.0f} items/s".format(
+        "{} ({})".format(name, batch_size), num_keys / elapsed))
+
+
+def main():
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    keys = make_keys(num_keys)
+    fst_set = Set.from_iter(keys)
+    fst_map = Map.from_iter((key, idx) for idx, key in enumerate(keys))
+    for batch_size in (1, 64, 1024, 16384):
+        run('set', lambda: iter(fst_set), num_keys, batch_size)
+        run('map.items', fst_map.items, num_keys, batch_size)
+        run('map.values', fst_map.values, num_keys, batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+""" Measure the throughput of concurrent queries on a single shared map with
+an increasing number of threads.
+
+Usage: python benchmarks/bench_threads.py [NUM_KEYS] [MAX_THREADS]
+"""
+from __future__ import print_function
+
+import random
+import sys
+import threading
+import time
+
+from rust_fst import Map
+
+BATCH_SIZE = 10000
+BATCHES_PER_THREAD = 50
+
+
+def make_key(idx):
+    return "key{:012d}".format(idx)
+
+
+def query(fst_map, batches):
+    for batch in batches:
+        fst_map.get_many(batch)
+        fst_map.get(batch[0])
+        list(fst_map.search(batch[0], 1))
+
+
+def run(fst_map, batches, num_threads):
+    threads = [threading.Thread(target=query, args=(fst_map, batches))
+               for _ in range(num_threads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    num_keys = num_threads * len(batches) * BATCH_SIZE
+    print("{:>3} threads {:>14,.0f} keys/s".format(num_threads,
+                                                  num_keys / elapsed))
+
+
+def main():
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    max_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    fst_map = Map.from_iter((make_key(i), i) for i in range(num_keys))
+    batches = [[make_key(random.randrange(2 * num_keys))
+                for _ in range(BATCH_SIZE)]
+               for _ in range(BATCHES_PER_THREAD)]
+    num_threads = 1
+    while num_threads <= max_threads:
+        run(fst_map, batches, num_threads)
+        num_threads *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+""" Compare first-query latencies of a set opened with a cold and a warm page
+cache, for the different prefetch modes.
+
+The file is evicted from the page cache with `posix_fadvise` before every
+run, which requires Python 3.3+ on a platform that supports it.
+
+Usage: python benchmarks/bench_warmup.py [NUM_KEYS] [NUM_QUERIES]
+"""
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from rust_fst import Set
+
+
+def make_keys(num_keys):
+    return ["key{:012d}".format(i) for i in range(num_keys)]
+
+
+def evict(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def percentile(latencies, pct):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * pct))]
+
+
+def run(name, path, queries, cold=True, warmup=False, **kwargs):
+    if cold:
+        evict(path)
+    start = time.time()
+    fst_set = Set(path, **kwargs)
+    if warmup:
+        fst_set.warmup().join()
+    open_time = time.time() - start
+    latencies = []
+    for key in queries:
+        query_start = time.time()
+        key in fst_set
+        latencies.append(time.time() - query_start)
+    total = sum(latencies)
+    latencies.sort()
+    print("{:<28} open {:>9.2f}ms  queries {:>9.2f}ms  "
+          "p50 {:>7.1f}us  p99 {:>7.1f}us".format(
+              name, open_time * 1e3, total * 1e3,
+              percentile(latencies, 0.5) * 1e6,
+              percentile(latencies, 0.99) * 1e6))
+
+
+def main():
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    num_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    keys = make_keys(num_keys)
+    queries = random.sample(keys, num_queries)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'bench.fst')
+        Set.from_iter(keys, path)
+        del keys
+        run("cold (prefetch='none')", path, queries)
+        run("cold (access='random')", path, queries, access='random')
+        run("prefetch='async'", path, queries, prefetch='async')
+        run("prefetch='full'", path, queries, prefetch='full')
+        run("warmup().join()", path, queries, warmup=True)
+        run("warm page cache", path, queries, cold=False)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,8 @@
     =============================== **/
 
 typedef struct {
-    bool  has_error;
-    char* error_type;
-    char* error_description;
-    char* error_display;
-    char* error_debug;
+    uint32_t error_kind;
+    char*    error_msg;
 } Context;
 
 typedef struct BufWriter BufWriter;
@@ -16,14 +13,28 @@ typedef struct Regex Regex;
 
 Levenshtein* fst_levenshtein_new(Context*, char*, uint32_t);
 void fst_levenshtein_free(Levenshtein*);
+size_t fst_levenshtein_heapsize(Levenshtein*);
 
 Regex* fst_regex_new(Context*, char*);
 void fst_regex_free(Regex*);
+size_t fst_regex_heapsize(Regex*);
+
+typedef struct {
+    size_t      num_items;
+    char*       keys;
+    size_t*     offsets;
+    uint64_t*   values;
+    uint32_t*   distances;
+} StreamBatch;
+
+void fst_streambatch_free(StreamBatch*);
 
 Context* fst_context_new();
 void fst_context_free(Context*);
 
 void fst_string_free(char*);
+void fst_bytes_free(char*, size_t);
+void fst_values_free(uint64_t*, size_t);
 
 BufWriter* fst_bufwriter_new(Context*, char*);
 void fst_bufwriter_free(BufWriter*);
@@ -47,33 +58,53 @@ typedef struct SetSymmetricDifference SetSymmetricDifference;
 typedef struct SetStreamBuilder SetStreamBuilder;
 
 FileSetBuilder* fst_filesetbuilder_new(Context*, BufWriter*);
-void fst_filesetbuilder_insert(Context*, FileSetBuilder*, char*);
+bool fst_filesetbuilder_insert(Context*, FileSetBuilder*, char*, size_t);
+bool fst_filesetbuilder_insert_many(Context*, FileSetBuilder*, char*, size_t*,
+                                    size_t);
+bool fst_filesetbuilder_insert_file(Context*, FileSetBuilder*, char*, bool);
+bool fst_filesetbuilder_insert_records(Context*, FileSetBuilder*, char*,
+                                       uint64_t, uint64_t);
 void fst_filesetbuilder_finish(Context*, FileSetBuilder*);
 
 MemSetBuilder* fst_memsetbuilder_new();
-bool fst_memsetbuilder_insert(Context*, MemSetBuilder*, char*);
+bool fst_memsetbuilder_insert(Context*, MemSetBuilder*, char*, size_t);
+bool fst_memsetbuilder_insert_many(Context*, MemSetBuilder*, char*, size_t*,
+                                   size_t);
+bool fst_memsetbuilder_insert_file(Context*, MemSetBuilder*, char*, bool);
+bool fst_memsetbuilder_insert_records(Context*, MemSetBuilder*, char*,
+                                      uint64_t, uint64_t);
 Set* fst_memsetbuilder_finish(Context*, MemSetBuilder*);
 
 Set* fst_set_open(Context*, char*);
-bool fst_set_contains(Set*, char*);
+bool fst_set_contains(Set*, char*, size_t);
+void fst_set_contains_many(Set*, char*, size_t*, size_t, char*);
 size_t fst_set_len(Set*);
 bool fst_set_isdisjoint(Set*, Set*);
 bool fst_set_issubset(Set*, Set*);
 bool fst_set_issuperset(Set*, Set*);
 SetStream* fst_set_stream(Set*);
 SetLevStream* fst_set_levsearch(Set*, Levenshtein*);
+StreamBatch* fst_set_levsearch_ranked(Set*, Levenshtein*, char*, size_t);
 SetRegexStream* fst_set_regexsearch(Set*, Regex*);
 SetOpBuilder* fst_set_make_opbuilder(Set*);
 void fst_set_free(Set*);
+Set* fst_set_from_buffer(Context*, char*, size_t);
+char* fst_set_to_bytes(Set*, size_t*);
 
-char* fst_set_stream_next(SetStream*);
+bool fst_set_stream_next(SetStream*, char**, size_t*);
 void fst_set_stream_free(SetStream*);
+size_t fst_set_stream_count(SetStream*);
+StreamBatch* fst_set_stream_batch(SetStream*, size_t, size_t);
 
-char* fst_set_levstream_next(SetLevStream*);
+bool fst_set_levstream_next(SetLevStream*, char**, size_t*);
 void fst_set_levstream_free(SetLevStream*);
+size_t fst_set_levstream_count(SetLevStream*);
+StreamBatch* fst_set_levstream_batch(SetLevStream*, size_t, size_t);
 
-char* fst_set_regexstream_next(SetRegexStream*);
+bool fst_set_regexstream_next(SetRegexStream*, char**, size_t*);
 void fst_set_regexstream_free(SetRegexStream*);
+size_t fst_set_regexstream_count(SetRegexStream*);
+StreamBatch* fst_set_regexstream_batch(SetRegexStream*, size_t, size_t);
 
 void fst_set_opbuilder_push(SetOpBuilder*, Set*);
 void fst_set_opbuilder_free(SetOpBuilder*);
@@ -83,21 +114,40 @@ SetDifference* fst_set_opbuilder_difference(SetOpBuilder*);
 SetSymmetricDifference* fst_set_opbuilder_symmetricdifference(
     SetOpBuilder*);
 
-char* fst_set_union_next(SetUnion*);
+bool fst_set_union_next(SetUnion*, char**, size_t*);
 void fst_set_union_free(SetUnion*);
+size_t fst_set_union_count(SetUnion*);
+StreamBatch* fst_set_union_batch(SetUnion*, size_t, size_t);
+bool fst_set_union_into(Context*, SetUnion*, char*);
 
-char* fst_set_intersection_next(SetIntersection*);
+bool fst_set_intersection_next(SetIntersection*, char**, size_t*);
 void fst_set_intersection_free(SetIntersection*);
+size_t fst_set_intersection_count(SetIntersection*);
+StreamBatch* fst_set_intersection_batch(SetIntersection*, size_t, size_t);
+bool fst_set_intersection_into(Context*, SetIntersection*, char*);
 
-char* fst_set_difference_next(SetDifference*);
+bool fst_set_difference_next(SetDifference*, char**, size_t*);
 void fst_set_difference_free(SetDifference*);
+size_t fst_set_difference_count(SetDifference*);
+StreamBatch* fst_set_difference_batch(SetDifference*, size_t, size_t);
+bool fst_set_difference_into(Context*, SetDifference*, char*);
 
-char* fst_set_symmetricdifference_next(SetSymmetricDifference*);
+bool fst_set_symmetricdifference_next(SetSymmetricDifference*, char**,
+                                      size_t*);
 void fst_set_symmetricdifference_free(SetSymmetricDifference*);
+size_t fst_set_symmetricdifference_count(SetSymmetricDifference*);
+StreamBatch* fst_set_symmetricdifference_batch(SetSymmetricDifference*, size_t,
+                                               size_t);
+bool fst_set_symmetricdifference_into(Context*, SetSymmetricDifference*,
+                                      char*);
 
 SetStreamBuilder* fst_set_streambuilder_new(Set*);
-SetStreamBuilder* fst_set_streambuilder_add_ge(SetStreamBuilder*, char*);
-SetStreamBuilder* fst_set_streambuilder_add_lt(SetStreamBuilder*, char*);
+SetStreamBuilder* fst_set_streambuilder_add_ge(SetStreamBuilder*, char*,
+                                              size_t);
+SetStreamBuilder* fst_set_streambuilder_add_lt(SetStreamBuilder*, char*,
+                                              size_t);
+SetStreamBuilder* fst_set_streambuilder_add_prefix(SetStreamBuilder*, char*,
+                                                   size_t);
 SetStream* fst_set_streambuilder_finish(SetStreamBuilder*);
 
 
@@ -105,11 +155,6 @@ SetStream* fst_set_streambuilder_finish(SetStreamBuilder*);
                     Map
     =============================== **/
 
-typedef struct {
-    char*       key;
-    uint64_t    value;
-} MapItem;
-
 typedef struct {
     size_t      index;
     uint64_t    value;
@@ -117,10 +162,27 @@ typedef struct {
 
 typedef struct {
     char*           key;
+    size_t          key_len;
     size_t          num_values;
     IndexedValue*   values;
 } MapOpItem;
 
+typedef struct {
+    size_t          num_items;
+    char*           keys;
+    size_t*         offsets;
+    size_t*         value_offsets;
+    IndexedValue*   values;
+} MapOpItemBatch;
+
+typedef struct {
+    uint64_t    count;
+    uint64_t    sum_low;
+    uint64_t    sum_high;
+    uint64_t    min;
+    uint64_t    max;
+} ValueStats;
+
 
 typedef struct FileMapBuilder FileMapBuilder;
 typedef struct MemMapBuilder MemMapBuilder;
@@ -128,6 +190,7 @@ typedef struct Map Map;
 typedef struct MapStream MapStream;
 typedef struct MapLevStream MapLevStream;
 typedef struct MapRegexStream MapRegexStream;
+typedef struct MapReducedStream MapReducedStream;
 typedef struct MapKeyStream MapKeyStream;
 typedef struct MapValueStream MapValueStream;
 typedef struct MapOpBuilder MapOpBuilder;
@@ -138,40 +201,81 @@ typedef struct MapSymmetricDifference MapSymmetricDifference;
 typedef struct MapStreamBuilder MapStreamBuilder;
 
 FileMapBuilder* fst_filemapbuilder_new(Context*, BufWriter*);
-bool fst_filemapbuilder_insert(Context*, FileMapBuilder*, char*, uint64_t);
+bool fst_filemapbuilder_insert(Context*, FileMapBuilder*, char*, size_t,
+                               uint64_t);
+bool fst_filemapbuilder_insert_many(Context*, FileMapBuilder*, char*, size_t*,
+                                    uint64_t*, size_t);
+bool fst_filemapbuilder_insert_file(Context*, FileMapBuilder*, char*, char*,
+                                    size_t, bool);
+bool fst_filemapbuilder_insert_records(Context*, FileMapBuilder*, char*,
+                                       uint64_t, uint64_t);
 bool fst_filemapbuilder_finish(Context*, FileMapBuilder*);
 
 MemMapBuilder* fst_memmapbuilder_new();
-bool fst_memmapbuilder_insert(Context*, MemMapBuilder*, char*, uint64_t);
+bool fst_memmapbuilder_insert(Context*, MemMapBuilder*, char*, size_t,
+                              uint64_t);
+bool fst_memmapbuilder_insert_many(Context*, MemMapBuilder*, char*, size_t*,
+                                   uint64_t*, size_t);
+bool fst_memmapbuilder_insert_file(Context*, MemMapBuilder*, char*, char*,
+                                   size_t, bool);
+bool fst_memmapbuilder_insert_records(Context*, MemMapBuilder*, char*,
+                                      uint64_t, uint64_t);
 Map* fst_memmapbuilder_finish(Context*, MemMapBuilder*);
 
 Map* fst_map_open(Context*, char*);
 void fst_map_free(Map*);
-uint64_t fst_map_get(Context*, Map*, char*);
+Map* fst_map_from_buffer(Context*, char*, size_t);
+char* fst_map_to_bytes(Map*, size_t*);
+bool fst_map_get(Map*, char*, size_t, uint64_t*);
+void fst_map_get_many(Map*, char*, size_t*, size_t, uint64_t, uint64_t*,
+                      char*);
 size_t fst_map_len(Map*);
-bool fst_map_contains(Map*, char*);
+bool fst_map_contains(Map*, char*, size_t);
+void fst_map_contains_many(Map*, char*, size_t*, size_t, char*);
 MapStream* fst_map_stream(Map*);
 MapKeyStream* fst_map_keys(Map*);
 MapValueStream* fst_map_values(Map*);
 MapLevStream* fst_map_levsearch(Map*, Levenshtein*);
+StreamBatch* fst_map_levsearch_ranked(Map*, Levenshtein*, char*, size_t);
 MapRegexStream* fst_map_regexsearch(Map*, Regex*);
 MapOpBuilder* fst_map_make_opbuilder(Map*);
 
-MapItem* fst_mapstream_next(MapStream*);
+bool fst_mapstream_next(MapStream*, char**, size_t*, uint64_t*);
 void fst_mapstream_free(MapStream*);
-void fst_mapitem_free(MapItem*);
+size_t fst_mapstream_count(MapStream*);
+StreamBatch* fst_mapstream_batch(MapStream*, size_t, size_t);
+uint64_t* fst_mapstream_values(MapStream*, size_t*);
+void fst_mapstream_stats(MapStream*, ValueStats*);
+void fst_mapstream_histogram(MapStream*, uint64_t*, size_t, uint64_t*);
 
-char* fst_mapkeys_next(MapKeyStream*);
+bool fst_mapkeys_next(MapKeyStream*, char**, size_t*);
 void fst_mapkeys_free(MapKeyStream*);
+size_t fst_mapkeys_count(MapKeyStream*);
+StreamBatch* fst_mapkeys_batch(MapKeyStream*, size_t, size_t);
 
-uint64_t fst_mapvalues_next(Context*, MapValueStream*);
+bool fst_mapvalues_next(MapValueStream*, uint64_t*);
 void fst_mapvalues_free(MapValueStream*);
+StreamBatch* fst_mapvalues_batch(MapValueStream*, size_t, size_t);
+uint64_t* fst_mapvalues_values(MapValueStream*, size_t*);
+void fst_mapvalues_stats(MapValueStream*, ValueStats*);
+void fst_mapvalues_histogram(MapValueStream*, uint64_t*, size_t, uint64_t*);
 
-MapItem* fst_map_levstream_next(MapLevStream*);
+bool fst_map_levstream_next(MapLevStream*, char**, size_t*, uint64_t*);
 void fst_map_levstream_free(MapLevStream*);
+size_t fst_map_levstream_count(MapLevStream*);
+StreamBatch* fst_map_levstream_batch(MapLevStream*, size_t, size_t);
+uint64_t* fst_map_levstream_values(MapLevStream*, size_t*);
+void fst_map_levstream_stats(MapLevStream*, ValueStats*);
+void fst_map_levstream_histogram(MapLevStream*, uint64_t*, size_t, uint64_t*);
 
-MapItem* fst_map_regexstream_next(MapRegexStream*);
+bool fst_map_regexstream_next(MapRegexStream*, char**, size_t*, uint64_t*);
 void fst_map_regexstream_free(MapRegexStream*);
+size_t fst_map_regexstream_count(MapRegexStream*);
+StreamBatch* fst_map_regexstream_batch(MapRegexStream*, size_t, size_t);
+uint64_t* fst_map_regexstream_values(MapRegexStream*, size_t*);
+void fst_map_regexstream_stats(MapRegexStream*, ValueStats*);
+void fst_map_regexstream_histogram(MapRegexStream*, uint64_t*, size_t,
+                                   uint64_t*);
 
 void fst_map_opbuilder_push(MapOpBuilder*, Map*);
 void fst_map_opbuilder_free(MapOpBuilder*);
@@ -181,20 +285,134 @@ MapDifference* fst_map_opbuilder_difference(MapOpBuilder*);
 MapSymmetricDifference* fst_map_opbuilder_symmetricdifference(
     MapOpBuilder*);
 void fst_map_opitem_free(MapOpItem*);
+void fst_map_opitembatch_free(MapOpItemBatch*);
 
 MapOpItem* fst_map_union_next(MapUnion*);
 void fst_map_union_free(MapUnion*);
+size_t fst_map_union_count(MapUnion*);
+MapOpItemBatch* fst_map_union_batch(MapUnion*, size_t, size_t);
 
 MapOpItem* fst_map_intersection_next(MapIntersection*);
 void fst_map_intersection_free(MapIntersection*);
+size_t fst_map_intersection_count(MapIntersection*);
+MapOpItemBatch* fst_map_intersection_batch(MapIntersection*, size_t, size_t);
 
 MapOpItem* fst_map_difference_next(MapDifference*);
 void fst_map_difference_free(MapDifference*);
+size_t fst_map_difference_count(MapDifference*);
+MapOpItemBatch* fst_map_difference_batch(MapDifference*, size_t, size_t);
 
 MapOpItem* fst_map_symmetricdifference_next(MapSymmetricDifference*);
 void fst_map_symmetricdifference_free(MapSymmetricDifference*);
+size_t fst_map_symmetricdifference_count(MapSymmetricDifference*);
+MapOpItemBatch* fst_map_symmetricdifference_batch(MapSymmetricDifference*,
+                                                  size_t, size_t);
+
+MapReducedStream* fst_map_union_reduce(MapUnion*, uint32_t);
+MapReducedStream* fst_map_intersection_reduce(MapIntersection*, uint32_t);
+MapReducedStream* fst_map_difference_reduce(MapDifference*, uint32_t);
+MapReducedStream* fst_map_symmetricdifference_reduce(MapSymmetricDifference*,
+                                                     uint32_t);
+bool fst_map_reducedstream_next(MapReducedStream*, char**, size_t*,
+                                uint64_t*);
+void fst_map_reducedstream_free(MapReducedStream*);
+size_t fst_map_reducedstream_count(MapReducedStream*);
+bool fst_map_reducedstream_into(Context*, MapReducedStream*, char*);
+bool fst_map_reducedstream_into_set(Context*, MapReducedStream*, char*);
+StreamBatch* fst_map_reducedstream_batch(MapReducedStream*, size_t, size_t);
+uint64_t* fst_map_reducedstream_values(MapReducedStream*, size_t*);
+void fst_map_reducedstream_stats(MapReducedStream*, ValueStats*);
+void fst_map_reducedstream_histogram(MapReducedStream*, uint64_t*, size_t,
+                                     uint64_t*);
 
 MapStreamBuilder* fst_map_streambuilder_new(Map*);
-MapStreamBuilder* fst_map_streambuilder_add_ge(MapStreamBuilder*, char*);
-MapStreamBuilder* fst_map_streambuilder_add_lt(MapStreamBuilder*, char*);
+MapStreamBuilder* fst_map_streambuilder_add_ge(MapStreamBuilder*, char*,
+                                              size_t);
+MapStreamBuilder* fst_map_streambuilder_add_lt(MapStreamBuilder*, char*,
+                                              size_t);
+MapStreamBuilder* fst_map_streambuilder_add_prefix(MapStreamBuilder*, char*,
+                                                   size_t);
 MapStream* fst_map_streambuilder_finish(MapStreamBuilder*);
+
+
+/** ===============================
+            Completion index
+    =============================== **/
+
+typedef struct CompletionIndex CompletionIndex;
+
+CompletionIndex* fst_map_completionindex_build(Map*);
+CompletionIndex* fst_completionindex_open(Context*, char*);
+bool fst_completionindex_save(Context*, CompletionIndex*, char*);
+bool fst_completionindex_matches(CompletionIndex*, Map*);
+void fst_completionindex_free(CompletionIndex*);
+StreamBatch* fst_map_top_completions(Map*, CompletionIndex*, char*, size_t,
+                                     size_t);
+
+
+/** ===============================
+              Rank index
+    =============================== **/
+
+typedef struct RankIndex RankIndex;
+
+RankIndex* fst_set_rankindex_build(Set*);
+RankIndex* fst_map_rankindex_build(Map*);
+RankIndex* fst_rankindex_open(Context*, char*);
+bool fst_rankindex_save(Context*, RankIndex*, char*);
+bool fst_set_rankindex_matches(RankIndex*, Set*);
+bool fst_map_rankindex_matches(RankIndex*, Map*);
+void fst_rankindex_free(RankIndex*);
+size_t fst_set_rank(Set*, RankIndex*, char*, size_t);
+size_t fst_map_rank(Map*, RankIndex*, char*, size_t);
+StreamBatch* fst_set_select(Set*, RankIndex*, size_t);
+StreamBatch* fst_map_select(Map*, RankIndex*, size_t);
+
+
+/** ===============================
+            Composite queries
+    =============================== **/
+
+typedef struct Query Query;
+typedef struct SetQueryStream SetQueryStream;
+typedef struct MapQueryStream MapQueryStream;
+
+Query* fst_query_new();
+void fst_query_free(Query*);
+void fst_query_add_levenshtein(Query*, Levenshtein*, bool);
+void fst_query_add_regex(Query*, Regex*, bool);
+void fst_query_add_prefix(Query*, char*, size_t, bool);
+void fst_query_set_lower(Query*, char*, size_t, bool);
+void fst_query_set_upper(Query*, char*, size_t, bool);
+
+SetQueryStream* fst_set_querysearch(Set*, Query*);
+bool fst_set_querystream_next(SetQueryStream*, char**, size_t*);
+void fst_set_querystream_free(SetQueryStream*);
+size_t fst_set_querystream_count(SetQueryStream*);
+StreamBatch* fst_set_querystream_batch(SetQueryStream*, size_t, size_t);
+
+MapQueryStream* fst_map_querysearch(Map*, Query*);
+bool fst_map_querystream_next(MapQueryStream*, char**, size_t*, uint64_t*);
+void fst_map_querystream_free(MapQueryStream*);
+size_t fst_map_querystream_count(MapQueryStream*);
+StreamBatch* fst_map_querystream_batch(MapQueryStream*, size_t, size_t);
+uint64_t* fst_map_querystream_values(MapQueryStream*, size_t*);
+void fst_map_querystream_stats(MapQueryStream*, ValueStats*);
+void fst_map_querystream_histogram(MapQueryStream*, uint64_t*, size_t,
+                                   uint64_t*);
+
+
+/** ===============================
+         Searches over many FSTs
+    =============================== **/
+
+MapOpBuilder* fst_opbuilder_new();
+void fst_opbuilder_push_mapstream(MapOpBuilder*, MapStream*);
+void fst_opbuilder_push_maplevstream(MapOpBuilder*, MapLevStream*);
+void fst_opbuilder_push_mapregexstream(MapOpBuilder*, MapRegexStream*);
+void fst_opbuilder_push_mapquerystream(MapOpBuilder*, MapQueryStream*);
+void fst_opbuilder_push_reducedstream(MapOpBuilder*, MapReducedStream*);
+void fst_opbuilder_push_setstream(MapOpBuilder*, SetStream*);
+void fst_opbuilder_push_setlevstream(MapOpBuilder*, SetLevStream*);
+void fst_opbuilder_push_setregexstream(MapOpBuilder*, SetRegexStream*);
+void fst_opbuilder_push_setquerystream(MapOpBuilder*, SetQueryStream*);
@@ -0,0 +1,152 @@
+extern crate libc;
+
+use std::cmp::{self, Reverse};
+use std::collections::BinaryHeap;
+use std::io;
+use std::ptr;
+use fst::Map;
+use fst::raw::{CompiledAddr, Fst};
+
+use nodetable::{NodeTable, fold_nodes};
+use util::{BatchBuilder, Context, StreamBatch, bytes_from_ptr, cstr_to_str, to_raw_ptr};
+
+
+/// Identifies completion index files, including the version of the format
+const MAGIC: &'static [u8; 8] = b"fstcidx1";
+
+/// Maximum value of the keys reachable from every node of a map's FST
+///
+/// This allows finding the completions of a prefix with the highest values by a best-first
+/// traversal, whose cost depends on the number of requested completions instead of the number of
+/// keys with the prefix.
+pub struct CompletionIndex {
+    max_values: NodeTable,
+}
+
+impl CompletionIndex {
+    pub fn build(fst: &Fst) -> Self {
+        let max_values = fold_nodes(fst, |node, child_max| {
+            let mut max_value = if node.is_final() { node.final_output().value() } else { 0 };
+            for trans in node.transitions() {
+                max_value = cmp::max(max_value, trans.out.value() + child_max(trans.addr));
+            }
+            max_value
+        });
+        CompletionIndex { max_values: NodeTable::new(fst, max_values) }
+    }
+
+    pub fn matches(&self, fst: &Fst) -> bool {
+        self.max_values.matches(fst)
+    }
+
+    fn max_value(&self, addr: CompiledAddr) -> u64 {
+        self.max_values.get(addr).unwrap_or(0)
+    }
+
+    pub fn save(&self, path: &str) -> io::Result<()> {
+        self.max_values.save(path, MAGIC)
+    }
+
+    pub fn open(path: &str) -> io::Result<Self> {
+        Ok(CompletionIndex { max_values: NodeTable::open(path, MAGIC)? })
+    }
+
+    /// Find up to `k` keys starting with `prefix` with the highest values, ordered by descending
+    /// value and then by key
+    pub fn top_completions(&self, fst: &Fst, prefix: &[u8], k: usize) -> BatchBuilder {
+        let mut batch = BatchBuilder::new(true);
+        let mut node = fst.root();
+        let mut prefix_value = 0;
+        for &byte in prefix {
+            match node.find_input(byte) {
+                Some(idx) => {
+                    let trans = node.transition(idx);
+                    prefix_value += trans.out.value();
+                    node = fst.node(trans.addr);
+                }
+                None => return batch,
+            }
+        }
+        // Entries are ordered by the highest value that can be reached from them, nodes are
+        // expanded into their children and a result entry for their own key if they are final.
+        // Since a node's bound is never lower than that of its descendants, results are popped in
+        // the requested order.
+        let mut heap = BinaryHeap::new();
+        heap.push((prefix_value + self.max_value(node.addr()), Reverse(prefix.to_vec()),
+                   Some(node.addr()), prefix_value));
+        while batch.len() < k {
+            let (bound, Reverse(key), addr, value) = match heap.pop() {
+                Some(entry) => entry,
+                None => break,
+            };
+            let node = match addr {
+                Some(addr) => fst.node(addr),
+                None => {
+                    batch.push_item(&key, bound);
+                    continue;
+                }
+            };
+            if node.is_final() {
+                let final_value = value + node.final_output().value();
+                heap.push((final_value, Reverse(key.clone()), None, final_value));
+            }
+            for trans in node.transitions() {
+                let mut child_key = key.clone();
+                child_key.push(trans.inp);
+                let child_value = value + trans.out.value();
+                heap.push((child_value + self.max_value(trans.addr), Reverse(child_key),
+                           Some(trans.addr), child_value));
+            }
+        }
+        batch
+    }
+}
+
+#[no_mangle]
+pub extern "C" fn fst_map_completionindex_build(map_ptr: *mut Map) -> *mut CompletionIndex {
+    let map = ref_from_ptr!(map_ptr);
+    to_raw_ptr(CompletionIndex::build(map.as_fst()))
+}
+
+#[no_mangle]
+pub extern "C" fn fst_completionindex_open(ctx: *mut Context,
+                                           c_path: *mut libc::c_char)
+                                           -> *mut CompletionIndex {
+    let path = cstr_to_str(c_path);
+    let index = with_context!(ctx, ptr::null_mut(), CompletionIndex::open(path));
+    to_raw_ptr(index)
+}
+
+#[no_mangle]
+pub extern "C" fn fst_completionindex_save(ctx: *mut Context,
+                                           ptr: *mut CompletionIndex,
+                                           c_path: *mut libc::c_char)
+                                           -> bool {
+    let index = ref_from_ptr!(ptr);
+    let path = cstr_to_str(c_path);
+    with_context!(ctx, false, index.save(path));
+    true
+}
+
+#[no_mangle]
+pub extern "C" fn fst_completionindex_matches(ptr: *mut CompletionIndex,
+                                              map_ptr: *mut Map)
+                                              -> bool {
+    let index = ref_from_ptr!(ptr);
+    let map = ref_from_ptr!(map_ptr);
+    index.matches(map.as_fst())
+}
+make_free_fn!(fst_completionindex_free, *mut CompletionIndex);
+
+#[no_mangle]
+pub extern "C" fn fst_map_top_completions(map_ptr: *mut Map,
+                                          ptr: *mut CompletionIndex,
+                                          c_prefix: *const libc::c_char,
+                                          prefix_len: libc::size_t,
+                                          k: libc::size_t)
+                                          -> *mut StreamBatch {
+    let map = ref_from_ptr!(map_ptr);
+    let index = ref_from_ptr!(ptr);
+    let prefix = bytes_from_ptr(c_prefix, prefix_len);
+    index.top_completions(map.as_fst(), prefix, k).finish()
+}
@@ -0,0 +1,43 @@
+extern crate libc;
+
+use fst::Streamer;
+use fst::{map, set};
+
+use map::{MapLevStream, MapRegexStream};
+use query::{MapQueryStream, SetQueryStream};
+use set::{SetLevStream, SetRegexStream};
+use util::to_raw_ptr;
+use values::ReducedStream;
+
+
+/// The keys of a set stream as map items with a value of zero
+///
+/// This allows combining the results of searches on any number of sets with a map `OpBuilder`,
+/// whose union tags every key with the indices of the streams that contain it.
+pub struct SetItems<S>(S);
+
+impl<'a, S: Streamer<'a, Item = &'a [u8]>> Streamer<'a> for SetItems<S> {
+    type Item = (&'a [u8], u64);
+
+    fn next(&'a mut self) -> Option<Self::Item> {
+        self.0.next().map(|key| (key, 0))
+    }
+}
+
+
+/// Create an operation builder without any streams, which are added with the
+/// `fst_*_opbuilder_push_*` functions
+#[no_mangle]
+pub extern "C" fn fst_opbuilder_new() -> *mut map::OpBuilder<'static> {
+    to_raw_ptr(map::OpBuilder::new())
+}
+
+map_make_push_fn!(fst_opbuilder_push_mapstream, *mut map::Stream<'static>);
+map_make_push_fn!(fst_opbuilder_push_maplevstream, *mut MapLevStream);
+map_make_push_fn!(fst_opbuilder_push_mapregexstream, *mut MapRegexStream);
+map_make_push_fn!(fst_opbuilder_push_mapquerystream, *mut MapQueryStream);
+map_make_push_fn!(fst_opbuilder_push_reducedstream, *mut ReducedStream);
+set_make_push_fn!(fst_opbuilder_push_setstream, *mut set::Stream<'static>);
+set_make_push_fn!(fst_opbuilder_push_setlevstream, *mut SetLevStream);
+set_make_push_fn!(fst_opbuilder_push_setregexstream, *mut SetRegexStream);
+set_make_push_fn!(fst_opbuilder_push_setquerystream, *mut SetQueryStream);
@@ -1,5 +1,4 @@
 #![crate_type = "dylib"]
-#![feature(core_intrinsics)]
 
 extern crate libc;
 extern crate fst;
@@ -42,41 +41,139 @@ macro_rules! make_free_fn {
     )
 }
 
-/// Declare a function that returns the next item from a set stream
+/// Declare a function that returns the next key from a set stream
+///
+/// The key is written to the `key` and `len` output parameters and points into a buffer owned by
+/// the stream, i.e. it is only valid until the next call on the stream.
 macro_rules! set_make_next_fn {
     ($name:ident, $t:ty) => (
         #[no_mangle]
-        pub extern fn $name(ptr: $t) -> *const libc::c_char {
+        pub extern fn $name(ptr: $t,
+                            key: *mut *const libc::c_char,
+                            len: *mut libc::size_t)
+                            -> bool {
             let stream = mutref_from_ptr!(ptr);
             match stream.next() {
-                Some(val) => ::std::ffi::CString::new(val).unwrap().into_raw(),
-                None      => ::std::ptr::null()
+                Some(val) => {
+                    unsafe {
+                        *key = val.as_ptr() as *const libc::c_char;
+                        *len = val.len();
+                    }
+                    true
+                },
+                None      => false
             }
         }
     )
 }
 
 /// Declare a function that returns the next item from a map stream
+///
+/// The key is written to the `key` and `len` output parameters and points into a buffer owned by
+/// the stream, i.e. it is only valid until the next call on the stream.
 macro_rules! map_make_next_fn {
     ($name:ident, $t:ty) => (
         #[no_mangle]
-        pub extern fn $name(ptr: $t) -> *mut MapItem {
+        pub extern fn $name(ptr: $t,
+                            key: *mut *const libc::c_char,
+                            len: *mut libc::size_t,
+                            value: *mut u64)
+                            -> bool {
             let stream = mutref_from_ptr!(ptr);
             match stream.next() {
-                Some((k, v)) => to_raw_ptr(
-                    MapItem { key: ::std::ffi::CString::new(k).unwrap().into_raw(),
-                              value: v }),
-                None         => ::std::ptr::null_mut()
+                Some((k, v)) => {
+                    unsafe {
+                        *key = k.as_ptr() as *const libc::c_char;
+                        *len = k.len();
+                        *value = v;
+                    }
+                    true
+                },
+                None         => false
             }
         }
     )
 }
 
-/// Declare a function that returns the next item from a map stream
+/// Declare a function that counts the remaining items of a stream without returning them
+///
+/// The stream is exhausted afterwards.
+macro_rules! make_count_fn {
+    ($name:ident, $t:ty) => (
+        #[no_mangle]
+        pub extern fn $name(ptr: $t) -> libc::size_t {
+            let stream = mutref_from_ptr!(ptr);
+            let mut count = 0;
+            while stream.next().is_some() {
+                count += 1;
+            }
+            count
+        }
+    )
+}
+
+/// Declare a function that skips `offset` keys of a set stream and copies up to `limit` of the
+/// following keys into a batch
+macro_rules! set_make_batch_fn {
+    ($name:ident, $t:ty) => (
+        #[no_mangle]
+        pub extern fn $name(ptr: $t,
+                            offset: libc::size_t,
+                            limit: libc::size_t)
+                            -> *mut $crate::util::StreamBatch {
+            let stream = mutref_from_ptr!(ptr);
+            let mut batch = $crate::util::BatchBuilder::new(false);
+            for _ in 0..offset {
+                if stream.next().is_none() {
+                    break;
+                }
+            }
+            while batch.len() < limit {
+                match stream.next() {
+                    Some(key) => batch.push_key(key),
+                    None      => break
+                }
+            }
+            batch.finish()
+        }
+    )
+}
+
+/// Declare a function that skips `offset` items of a map stream and copies up to `limit` of the
+/// following items into a batch
+macro_rules! map_make_batch_fn {
+    ($name:ident, $t:ty) => (
+        #[no_mangle]
+        pub extern fn $name(ptr: $t,
+                            offset: libc::size_t,
+                            limit: libc::size_t)
+                            -> *mut $crate::util::StreamBatch {
+            let stream = mutref_from_ptr!(ptr);
+            let mut batch = $crate::util::BatchBuilder::new(true);
+            for _ in 0..offset {
+                if stream.next().is_none() {
+                    break;
+                }
+            }
+            while batch.len() < limit {
+                match stream.next() {
+                    Some((k, v)) => batch.push_item(k, v),
+                    None         => break
+                }
+            }
+            batch.finish()
+        }
+    )
+}
+
+/// Declare a function that returns the next item from a map operation stream
+///
+/// The key of the returned item points into a buffer owned by the stream, i.e. it is only valid
+/// until the next call on the stream.
 macro_rules! mapop_make_next_fn {
     ($name:ident, $t:ty) => (
         #[no_mangle]
-        pub extern fn $name(ptr: $t) -> *const MapOpItem {
+        pub extern fn $name(ptr: $t) -> *mut MapOpItem {
             let stream = mutref_from_ptr!(ptr);
             match stream.next() {
                 Some((k, vs)) => {
@@ -85,10 +182,11 @@ macro_rules! mapop_make_next_fn {
                                         value: vs[idx].value }
                     }).collect();
                     let mut vals_boxed: Box<[CIndexedValue]> = vals.into_boxed_slice();
-                    let vals_ptr: *const CIndexedValue = vals_boxed.as_ptr();
+                    let vals_ptr: *mut CIndexedValue = vals_boxed.as_mut_ptr();
                     mem::forget(vals_boxed);
                     to_raw_ptr(MapOpItem {
-                        key: ::std::ffi::CString::new(k).unwrap().into_raw(),
+                        key: k.as_ptr() as *const libc::c_char,
+                        key_len: k.len(),
                         num_values: vs.len(),
                         values: vals_ptr })
                 },
@@ -98,20 +196,144 @@ macro_rules! mapop_make_next_fn {
     )
 }
 
+/// Declare a function that skips `offset` items of a map operation stream and copies up to `limit`
+/// of the following items into a batch
+macro_rules! mapop_make_batch_fn {
+    ($name:ident, $t:ty) => (
+        #[no_mangle]
+        pub extern fn $name(ptr: $t,
+                            offset: libc::size_t,
+                            limit: libc::size_t)
+                            -> *mut MapOpItemBatch {
+            let stream = mutref_from_ptr!(ptr);
+            let mut batch = OpItemBatchBuilder::new();
+            for _ in 0..offset {
+                if stream.next().is_none() {
+                    break;
+                }
+            }
+            while batch.len() < limit {
+                match stream.next() {
+                    Some((k, vs)) => batch.push(k, vs),
+                    None          => break
+                }
+            }
+            batch.finish()
+        }
+    )
+}
+
+/// Declare functions that copy out, summarize and count per bucket the remaining values of a map
+/// stream, see the `values` module
+macro_rules! map_make_value_fns {
+    ($values:ident, $stats:ident, $histogram:ident, $t:ty) => (
+        #[no_mangle]
+        pub extern fn $values(ptr: $t, len: *mut libc::size_t) -> *mut u64 {
+            $crate::values::collect_values(mutref_from_ptr!(ptr), len)
+        }
+
+        #[no_mangle]
+        pub extern fn $stats(ptr: $t, stats: *mut $crate::values::ValueStats) {
+            let result = $crate::values::value_stats(mutref_from_ptr!(ptr));
+            unsafe { *stats = result };
+        }
+
+        #[no_mangle]
+        pub extern fn $histogram(ptr: $t,
+                                 bins: *const u64,
+                                 num_bins: libc::size_t,
+                                 counts: *mut u64) {
+            let (bins, counts) = $crate::values::histogram_args(bins, num_bins, counts);
+            $crate::values::value_histogram(mutref_from_ptr!(ptr), bins, counts);
+        }
+    )
+}
+
+/// Declare a function that writes the remaining keys of a set stream into a new set file
+///
+/// The stream is consumed, the keys never leave the library.
+macro_rules! set_make_into_fn {
+    ($name:ident, $t:ty) => (
+        #[no_mangle]
+        pub extern fn $name(ctx: *mut $crate::util::Context,
+                            ptr: $t,
+                            c_path: *mut libc::c_char)
+                            -> bool {
+            let mut stream = val_from_ptr!(ptr);
+            let path = $crate::util::cstr_to_str(c_path);
+            with_context!(ctx, false, $crate::set::write_stream(&mut *stream, path));
+            true
+        }
+    )
+}
+
+/// Declare a function that writes the remaining items of a map stream into a new map file
+///
+/// The stream is consumed, the items never leave the library.
+macro_rules! map_make_into_fn {
+    ($name:ident, $t:ty) => (
+        #[no_mangle]
+        pub extern fn $name(ctx: *mut $crate::util::Context,
+                            ptr: $t,
+                            c_path: *mut libc::c_char)
+                            -> bool {
+            let mut stream = val_from_ptr!(ptr);
+            let path = $crate::util::cstr_to_str(c_path);
+            with_context!(ctx, false, $crate::map::write_stream(&mut *stream, path));
+            true
+        }
+    )
+}
+
+/// Declare a function that adds a map stream, which is consumed, to a map operation builder
+macro_rules! map_make_push_fn {
+    ($name:ident, $t:ty) => (
+        #[no_mangle]
+        pub extern fn $name(ptr: *mut ::fst::map::OpBuilder<'static>, stream_ptr: $t) {
+            let ob = mutref_from_ptr!(ptr);
+            let stream = val_from_ptr!(stream_ptr);
+            ob.push(*stream);
+        }
+    )
+}
+
+/// Declare a function that adds a set stream, which is consumed, to a map operation builder, see
+/// `fanout::SetItems`
+macro_rules! set_make_push_fn {
+    ($name:ident, $t:ty) => (
+        #[no_mangle]
+        pub extern fn $name(ptr: *mut ::fst::map::OpBuilder<'static>, stream_ptr: $t) {
+            let ob = mutref_from_ptr!(ptr);
+            let stream = val_from_ptr!(stream_ptr);
+            ob.push($crate::fanout::SetItems(*stream));
+        }
+    )
+}
+
 /// Evaluate an expression and in case of an error, store information about the error in the passed
 /// Context struct and return a default value.
 macro_rules! with_context {
     ($ctx_ptr:ident, $default_rval:expr, $e:expr) => {{
-        let ctx = mutref_from_ptr!($ctx_ptr);
-        ctx.has_error = false;
         match $e {
             Ok(val) => val,
             Err(err) => {
-                ctx.has_error = true;
-                ctx.error_type = $crate::util::str_to_cstr($crate::util::get_typename(&err));
-                ctx.error_debug = $crate::util::str_to_cstr(&format!("{:?}", err));
-                ctx.error_display = $crate::util::str_to_cstr(&format!("{}", err));
-                ctx.error_description = $crate::util::str_to_cstr(err.description());
+                let kind = $crate::util::AbiError::error_kind(&err);
+                $crate::util::set_error($ctx_ptr, kind, &err.to_string());
+                return $default_rval;
+            }
+        }
+    }}
+}
+
+/// Like `with_context!`, but prefix the error message with the number of the input line that
+/// caused the error.
+macro_rules! with_line_context {
+    ($ctx_ptr:ident, $line_no:expr, $default_rval:expr, $e:expr) => {{
+        match $e {
+            Ok(val) => val,
+            Err(err) => {
+                let kind = $crate::util::AbiError::error_kind(&err);
+                $crate::util::set_error($ctx_ptr, kind, &format!("line {}: {}", $line_no, err));
                 return $default_rval;
             }
         }
@@ -121,3 +343,9 @@ macro_rules! with_context {
 pub mod util;
 pub mod set;
 pub mod map;
+pub mod nodetable;
+pub mod completion;
+pub mod rank;
+pub mod query;
+pub mod values;
+pub mod fanout;
@@ -1,33 +1,30 @@
 extern crate libc;
 
-use std::error::Error;
 use std::fs::File;
 use std::io;
 use std::mem;
 use std::ptr;
-use fst::{IntoStreamer, Streamer, Map, MapBuilder};
+use std::slice;
+use std::str;
+use fst::{self, IntoStreamer, Streamer, Map, MapBuilder};
 use fst::map;
 use fst_levenshtein::Levenshtein;
 use fst_regex::Regex;
 
-use util::{Context, str_to_cstr, cstr_to_str, to_raw_ptr};
+use util::{BatchBuilder, Context, ErrorKind, LineReader, RecordReader, StreamBatch, TopK,
+           bytes_from_ptr, cstr_to_str, levenshtein_distance, packed_keys, prefix_successor, rfind,
+           set_error, slice_to_raw, to_raw_ptr, vec_to_raw};
+use values::{ReducedStream, Reducer};
 
 
-#[repr(C)]
-#[derive(Debug)]
-#[allow(dead_code)]
-pub struct MapItem {
-    key: *const libc::c_char,
-    value: u64,
-}
-
 #[repr(C)]
 #[derive(Debug)]
 #[allow(dead_code)]
 pub struct MapOpItem {
     key: *const libc::c_char,
+    key_len: libc::size_t,
     num_values: libc::size_t,
-    values: *const CIndexedValue
+    values: *mut CIndexedValue
 }
 
 #[repr(C)]
@@ -38,12 +35,135 @@ pub struct CIndexedValue {
     value: u64,
 }
 
+/// Items of a map operation stream copied out in a single call
+///
+/// Like `StreamBatch`, with the values of the item at position `i` in
+/// `values[value_offsets[i]..value_offsets[i + 1]]`.
+#[repr(C)]
+pub struct MapOpItemBatch {
+    num_items: libc::size_t,
+    keys: *mut libc::c_char,
+    offsets: *mut libc::size_t,
+    value_offsets: *mut libc::size_t,
+    values: *mut CIndexedValue,
+}
+
+/// Collects the items of a map operation stream into a `MapOpItemBatch`
+pub struct OpItemBatchBuilder {
+    keys: Vec<u8>,
+    offsets: Vec<usize>,
+    value_offsets: Vec<usize>,
+    values: Vec<CIndexedValue>,
+}
+
+impl OpItemBatchBuilder {
+    pub fn new() -> Self {
+        OpItemBatchBuilder {
+            keys: Vec::new(),
+            offsets: vec![0],
+            value_offsets: vec![0],
+            values: Vec::new(),
+        }
+    }
+
+    pub fn len(&self) -> usize {
+        self.offsets.len() - 1
+    }
+
+    pub fn push(&mut self, key: &[u8], values: &[map::IndexedValue]) {
+        self.keys.extend_from_slice(key);
+        self.offsets.push(self.keys.len());
+        self.values.extend(values.iter().map(|iv| {
+            CIndexedValue { index: iv.index, value: iv.value }
+        }));
+        self.value_offsets.push(self.values.len());
+    }
+
+    /// Hand the batch over to the caller, who has to free it with `fst_map_opitembatch_free`
+    pub fn finish(self) -> *mut MapOpItemBatch {
+        to_raw_ptr(MapOpItemBatch {
+            num_items: self.len(),
+            keys: slice_to_raw(self.keys) as *mut libc::c_char,
+            offsets: slice_to_raw(self.offsets),
+            value_offsets: slice_to_raw(self.value_offsets),
+            values: slice_to_raw(self.values),
+        })
+    }
+}
+
 pub type FileMapBuilder = MapBuilder<&'static mut io::BufWriter<File>>;
 pub type MemMapBuilder = MapBuilder<Vec<u8>>;
 pub type MapLevStream = map::Stream<'static, &'static Levenshtein>;
 pub type MapRegexStream = map::Stream<'static, &'static Regex>;
 
 
+/// Write the remaining items of a stream into a new map file
+pub fn write_stream<S>(stream: &mut S, path: &str) -> Result<(), fst::Error>
+    where S: for<'a> Streamer<'a, Item = (&'a [u8], u64)>
+{
+    let mut build = MapBuilder::new(io::BufWriter::new(File::create(path)?))?;
+    while let Some((key, value)) = stream.next() {
+        build.insert(key, value)?;
+    }
+    build.finish()
+}
+
+/// Insert the items of the records in a byte range of a run file into a map builder
+fn insert_records<W: io::Write>(ctx: *mut Context,
+                                builder: &mut MapBuilder<W>,
+                                path: &str,
+                                start: u64,
+                                end: u64)
+                                -> bool {
+    let mut records = with_context!(ctx, false, RecordReader::open(path, start, end, true));
+    while let Some((key, val)) = with_context!(ctx, false, records.next_record()) {
+        with_context!(ctx, false, builder.insert(key, val));
+    }
+    true
+}
+
+/// Insert the lines of a text file into a map builder, one `<key><sep><value>` item per line
+///
+/// Lines are split at the last occurrence of the separator, so keys may contain it. Empty lines
+/// are skipped. If `check_utf8` is set, keys that are not valid UTF-8 are rejected.
+fn insert_lines<W: io::Write>(ctx: *mut Context,
+                              builder: &mut MapBuilder<W>,
+                              path: &str,
+                              sep: &[u8],
+                              check_utf8: bool)
+                               -> bool {
+    let mut lines = with_context!(ctx, false, LineReader::open(path));
+    while let Some((line_no, line)) = with_context!(ctx, false, lines.next_line()) {
+        if line.is_empty() {
+            continue;
+        }
+        let pos = match rfind(line, sep) {
+            Some(pos) => pos,
+            None => {
+                set_error(ctx, ErrorKind::Value, &format!("line {}: missing separator", line_no));
+                return false;
+            }
+        };
+        let key = &line[..pos];
+        let raw_val = &line[pos + sep.len()..];
+        if check_utf8 && str::from_utf8(key).is_err() {
+            set_error(ctx, ErrorKind::Value, &format!("line {}: key is not valid UTF-8", line_no));
+            return false;
+        }
+        let val = match str::from_utf8(raw_val).ok().and_then(|v| v.trim().parse::<u64>().ok()) {
+            Some(val) => val,
+            None => {
+                set_error(ctx, ErrorKind::Value,
+                          &format!("line {}: invalid value '{}'", line_no,
+                                   String::from_utf8_lossy(raw_val)));
+                return false;
+            }
+        };
+        with_line_context!(ctx, line_no, false, builder.insert(key, val));
+    }
+    true
+}
+
 #[no_mangle]
 pub extern "C" fn fst_filemapbuilder_new(ctx: *mut Context,
                                          wtr_ptr: *mut io::BufWriter<File>)
@@ -56,14 +176,53 @@ pub extern "C" fn fst_filemapbuilder_new(ctx: *mut Context,
 #[no_mangle]
 pub extern "C" fn fst_filemapbuilder_insert(ctx: *mut Context,
                                             ptr: *mut FileMapBuilder,
-                                            key: *mut libc::c_char,
+                                            key: *const libc::c_char,
+                                            key_len: libc::size_t,
                                             val: u64)
                                             -> bool {
     let builder = mutref_from_ptr!(ptr);
-    with_context!(ctx, false, builder.insert(cstr_to_str(key), val));
+    with_context!(ctx, false, builder.insert(bytes_from_ptr(key, key_len), val));
     true
 }
 
+#[no_mangle]
+pub extern "C" fn fst_filemapbuilder_insert_many(ctx: *mut Context,
+                                                 ptr: *mut FileMapBuilder,
+                                                 buf: *const libc::c_char,
+                                                 offsets: *const libc::size_t,
+                                                 vals: *const u64,
+                                                 num_items: libc::size_t)
+                                                 -> bool {
+    let builder = mutref_from_ptr!(ptr);
+    let vals = unsafe { slice::from_raw_parts(vals, num_items) };
+    for (key, val) in packed_keys(buf, offsets, num_items).zip(vals) {
+        with_context!(ctx, false, builder.insert(key, *val));
+    }
+    true
+}
+
+#[no_mangle]
+pub extern "C" fn fst_filemapbuilder_insert_file(ctx: *mut Context,
+                                                 ptr: *mut FileMapBuilder,
+                                                 path: *mut libc::c_char,
+                                                 sep: *const libc::c_char,
+                                                 sep_len: libc::size_t,
+                                                 check_utf8: bool)
+                                                 -> bool {
+    insert_lines(ctx, mutref_from_ptr!(ptr), cstr_to_str(path), bytes_from_ptr(sep, sep_len),
+                 check_utf8)
+}
+
+#[no_mangle]
+pub extern "C" fn fst_filemapbuilder_insert_records(ctx: *mut Context,
+                                                    ptr: *mut FileMapBuilder,
+                                                    path: *mut libc::c_char,
+                                                    start: u64,
+                                                    end: u64)
+                                                    -> bool {
+    insert_records(ctx, mutref_from_ptr!(ptr), cstr_to_str(path), start, end)
+}
+
 #[no_mangle]
 pub extern "C" fn fst_filemapbuilder_finish(ctx: *mut Context, ptr: *mut FileMapBuilder) -> bool {
     let builder = val_from_ptr!(ptr);
@@ -79,14 +238,53 @@ pub extern "C" fn fst_memmapbuilder_new() -> *mut MemMapBuilder {
 #[no_mangle]
 pub extern "C" fn fst_memmapbuilder_insert(ctx: *mut Context,
                                            ptr: *mut MemMapBuilder,
-                                           key: *mut libc::c_char,
+                                           key: *const libc::c_char,
+                                           key_len: libc::size_t,
                                            val: u64)
                                            -> bool {
     let builder = mutref_from_ptr!(ptr);
-    with_context!(ctx, false, builder.insert(cstr_to_str(key), val));
+    with_context!(ctx, false, builder.insert(bytes_from_ptr(key, key_len), val));
+    true
+}
+
+#[no_mangle]
+pub extern "C" fn fst_memmapbuilder_insert_many(ctx: *mut Context,
+                                                ptr: *mut MemMapBuilder,
+                                                buf: *const libc::c_char,
+                                                offsets: *const libc::size_t,
+                                                vals: *const u64,
+                                                num_items: libc::size_t)
+                                                -> bool {
+    let builder = mutref_from_ptr!(ptr);
+    let vals = unsafe { slice::from_raw_parts(vals, num_items) };
+    for (key, val) in packed_keys(buf, offsets, num_items).zip(vals) {
+        with_context!(ctx, false, builder.insert(key, *val));
+    }
     true
 }
 
+#[no_mangle]
+pub extern "C" fn fst_memmapbuilder_insert_file(ctx: *mut Context,
+                                                ptr: *mut MemMapBuilder,
+                                                path: *mut libc::c_char,
+                                                sep: *const libc::c_char,
+                                                sep_len: libc::size_t,
+                                                check_utf8: bool)
+                                                -> bool {
+    insert_lines(ctx, mutref_from_ptr!(ptr), cstr_to_str(path), bytes_from_ptr(sep, sep_len),
+                 check_utf8)
+}
+
+#[no_mangle]
+pub extern "C" fn fst_memmapbuilder_insert_records(ctx: *mut Context,
+                                                   ptr: *mut MemMapBuilder,
+                                                   path: *mut libc::c_char,
+                                                   start: u64,
+                                                   end: u64)
+                                                   -> bool {
+    insert_records(ctx, mutref_from_ptr!(ptr), cstr_to_str(path), start, end)
+}
+
 #[no_mangle]
 pub extern "C" fn fst_memmapbuilder_finish(ctx: *mut Context, ptr: *mut MemMapBuilder) -> *mut Map {
     let builder = val_from_ptr!(ptr);
@@ -104,14 +302,51 @@ pub unsafe extern "C" fn fst_map_open(ctx: *mut Context, path: *mut libc::c_char
 }
 make_free_fn!(fst_map_free, *mut Map);
 
+/// Create a map that borrows its data from a buffer owned by the caller, without copying it.
+///
+/// The buffer must stay alive and unmodified for as long as the map and its streams are in use.
+#[no_mangle]
+pub extern "C" fn fst_map_from_buffer(ctx: *mut Context,
+                                      buf: *const libc::c_char,
+                                      len: libc::size_t)
+                                      -> *mut Map {
+    let data: &'static [u8] = bytes_from_ptr(buf, len);
+    let map = with_context!(ctx, ptr::null_mut(), Map::from_static_slice(data));
+    to_raw_ptr(map)
+}
+
+#[no_mangle]
+pub extern "C" fn fst_map_to_bytes(ptr: *mut Map, len: *mut libc::size_t) -> *mut libc::c_char {
+    vec_to_raw(ref_from_ptr!(ptr).as_fst().to_vec(), len)
+}
+
 #[no_mangle]
 pub extern "C" fn fst_map_len(ptr: *mut Map) -> libc::size_t {
     ref_from_ptr!(ptr).len()
 }
 
 #[no_mangle]
-pub extern "C" fn fst_map_contains(ptr: *mut Map, key: *mut libc::c_char) -> bool {
-    ref_from_ptr!(ptr).contains_key(cstr_to_str(key))
+pub extern "C" fn fst_map_contains(ptr: *mut Map,
+                                   key: *const libc::c_char,
+                                   key_len: libc::size_t)
+                                   -> bool {
+    ref_from_ptr!(ptr).contains_key(bytes_from_ptr(key, key_len))
+}
+
+/// Check for each of `num_keys` packed keys if it is contained in the map and write the result to
+/// the corresponding element of `out`, which must have room for `num_keys` bytes
+#[no_mangle]
+pub extern "C" fn fst_map_contains_many(ptr: *mut Map,
+                                        buf: *const libc::c_char,
+                                        offsets: *const libc::size_t,
+                                        num_keys: libc::size_t,
+                                        out: *mut u8) {
+    let map = ref_from_ptr!(ptr);
+    assert!(!out.is_null());
+    let out = unsafe { slice::from_raw_parts_mut(out, num_keys) };
+    for (key, found) in packed_keys(buf, offsets, num_keys).zip(out.iter_mut()) {
+        *found = map.contains_key(key) as u8;
+    }
 }
 
 #[no_mangle]
@@ -120,24 +355,62 @@ pub extern "C" fn fst_map_stream(ptr: *mut Map) -> *mut map::Stream<'static> {
 }
 make_free_fn!(fst_mapstream_free, *mut map::Stream);
 map_make_next_fn!(fst_mapstream_next, *mut map::Stream);
-make_free_fn!(fst_mapitem_free, *mut MapItem);
-
-#[no_mangle]
-pub extern "C" fn fst_map_get(ctx: *mut Context,
-                              ptr: *mut Map,
-                              key: *mut libc::c_char)
-                              -> u64 {
-    let key = cstr_to_str(key);
-    let ctx = mutref_from_ptr!(ctx);
-    ctx.clear();
-    match ref_from_ptr!(ptr).get(key) {
-        Some(val) => val,
-        None => {
-            let msg = str_to_cstr(&format!("Key '{}' not in map.", key));
-            ctx.has_error = true;
-            ctx.error_type = str_to_cstr("py::KeyError");
-            ctx.error_display = msg;
-            return 0;
+map_make_batch_fn!(fst_mapstream_batch, *mut map::Stream);
+make_count_fn!(fst_mapstream_count, *mut map::Stream);
+map_make_value_fns!(fst_mapstream_values, fst_mapstream_stats, fst_mapstream_histogram,
+                   *mut map::Stream);
+
+/// Look up the value for a key
+///
+/// Returns whether the key is in the map and if so, writes its value to `value`. Missing keys are
+/// not treated as errors, so no error message has to be built for them.
+#[no_mangle]
+pub extern "C" fn fst_map_get(ptr: *mut Map,
+                              key: *const libc::c_char,
+                              key_len: libc::size_t,
+                              value: *mut u64)
+                              -> bool {
+    match ref_from_ptr!(ptr).get(bytes_from_ptr(key, key_len)) {
+        Some(val) => {
+            unsafe { *value = val };
+            true
+        },
+        None => false
+    }
+}
+
+/// Look up the values of `num_keys` packed keys and write them to the corresponding elements of
+/// `out`, using `default` for missing keys. If `found` is not null, it receives a byte for every
+/// key that is 1 if the key is in the map and 0 otherwise.
+#[no_mangle]
+pub extern "C" fn fst_map_get_many(ptr: *mut Map,
+                                   buf: *const libc::c_char,
+                                   offsets: *const libc::size_t,
+                                   num_keys: libc::size_t,
+                                   default: u64,
+                                   out: *mut u64,
+                                   found: *mut u8) {
+    let map = ref_from_ptr!(ptr);
+    assert!(!out.is_null());
+    let out = unsafe { slice::from_raw_parts_mut(out, num_keys) };
+    if found.is_null() {
+        for (key, val) in packed_keys(buf, offsets, num_keys).zip(out.iter_mut()) {
+            *val = map.get(key).unwrap_or(default);
+        }
+    } else {
+        let found = unsafe { slice::from_raw_parts_mut(found, num_keys) };
+        let keys = packed_keys(buf, offsets, num_keys);
+        for ((key, val), is_found) in keys.zip(out.iter_mut()).zip(found.iter_mut()) {
+            match map.get(key) {
+                Some(v) => {
+                    *val = v;
+                    *is_found = 1;
+                },
+                None => {
+                    *val = default;
+                    *is_found = 0;
+                }
+            }
         }
     }
 }
@@ -148,6 +421,8 @@ pub extern "C" fn fst_map_keys(ptr: *mut Map) -> *mut map::Keys<'static> {
 }
 make_free_fn!(fst_mapkeys_free, *mut map::Keys);
 set_make_next_fn!(fst_mapkeys_next, *mut map::Keys);
+set_make_batch_fn!(fst_mapkeys_batch, *mut map::Keys);
+make_count_fn!(fst_mapkeys_count, *mut map::Keys);
 
 #[no_mangle]
 pub extern "C" fn fst_map_values(ptr: *mut Map) -> *mut map::Values<'static> {
@@ -156,42 +431,89 @@ pub extern "C" fn fst_map_values(ptr: *mut Map) -> *mut map::Values<'static> {
 make_free_fn!(fst_mapvalues_free, *mut map::Values);
 
 #[no_mangle]
-pub extern "C" fn fst_mapvalues_next(ctx: *mut Context, ptr: *mut map::Values) -> u64 {
-    let ctx = mutref_from_ptr!(ctx);
-    ctx.clear();
+pub extern "C" fn fst_mapvalues_next(ptr: *mut map::Values, value: *mut u64) -> bool {
     match mutref_from_ptr!(ptr).next() {
-        Some(val) => val,
-        None => {
-            let msg = str_to_cstr("No more values.");
-            ctx.has_error = true;
-            ctx.error_type = str_to_cstr("StopIteration");
-            ctx.error_display = msg;
-            return 0;
+        Some(val) => {
+            unsafe { *value = val };
+            true
+        },
+        None => false
+    }
+}
+
+/// Skip `offset` values and copy up to `limit` of the following values into a batch with empty keys
+#[no_mangle]
+pub extern "C" fn fst_mapvalues_batch(ptr: *mut map::Values,
+                                      offset: libc::size_t,
+                                      limit: libc::size_t)
+                                      -> *mut StreamBatch {
+    let stream = mutref_from_ptr!(ptr);
+    let mut batch = BatchBuilder::new(true);
+    for _ in 0..offset {
+        if stream.next().is_none() {
+            break;
+        }
+    }
+    while batch.len() < limit {
+        match stream.next() {
+            Some(value) => batch.push_item(&[], value),
+            None => break,
         }
     }
+    batch.finish()
 }
 
+map_make_value_fns!(fst_mapvalues_values, fst_mapvalues_stats, fst_mapvalues_histogram,
+                   *mut map::Values);
+
 #[no_mangle]
 pub extern "C" fn fst_map_levsearch(map_ptr: *mut Map,
                                     lev_ptr: *mut Levenshtein)
                                     -> *mut MapLevStream {
-    let map = mutref_from_ptr!(map_ptr);
+    let map = ref_from_ptr!(map_ptr);
     let lev = ref_from_ptr!(lev_ptr);
     to_raw_ptr(map.search(lev).into_stream())
 }
 make_free_fn!(fst_map_levstream_free, *mut MapLevStream);
 map_make_next_fn!(fst_map_levstream_next, *mut MapLevStream);
+map_make_batch_fn!(fst_map_levstream_batch, *mut MapLevStream);
+make_count_fn!(fst_map_levstream_count, *mut MapLevStream);
+map_make_value_fns!(fst_map_levstream_values, fst_map_levstream_stats,
+                   fst_map_levstream_histogram, *mut MapLevStream);
+
+/// Search with a Levenshtein automaton and return the `k` best matches with their edit distance
+/// to `term`, ranked by distance, then by descending value and then by key
+#[no_mangle]
+pub extern "C" fn fst_map_levsearch_ranked(map_ptr: *mut Map,
+                                           lev_ptr: *mut Levenshtein,
+                                           c_term: *mut libc::c_char,
+                                           k: libc::size_t)
+                                           -> *mut StreamBatch {
+    let map = ref_from_ptr!(map_ptr);
+    let lev = ref_from_ptr!(lev_ptr);
+    let term: Vec<char> = cstr_to_str(c_term).chars().collect();
+    let mut top = TopK::new(k);
+    let mut stream = map.search(lev).into_stream();
+    while let Some((key, value)) = stream.next() {
+        top.push(key, value, levenshtein_distance(&term, key));
+    }
+    top.finish(true)
+}
 
 
 #[no_mangle]
 pub extern "C" fn fst_map_regexsearch(map_ptr: *mut Map, regex_ptr: *mut Regex)
                                       -> *mut MapRegexStream {
-    let map = mutref_from_ptr!(map_ptr);
+    let map = ref_from_ptr!(map_ptr);
     let regex = ref_from_ptr!(regex_ptr);
     to_raw_ptr(map.search(regex).into_stream())
 }
 make_free_fn!(fst_map_regexstream_free, *mut MapRegexStream);
 map_make_next_fn!(fst_map_regexstream_next, *mut MapRegexStream);
+map_make_batch_fn!(fst_map_regexstream_batch, *mut MapRegexStream);
+make_count_fn!(fst_map_regexstream_count, *mut MapRegexStream);
+map_make_value_fns!(fst_map_regexstream_values, fst_map_regexstream_stats,
+                   fst_map_regexstream_histogram, *mut MapRegexStream);
 
 
 #[no_mangle]
@@ -201,7 +523,27 @@ pub extern "C" fn fst_map_make_opbuilder(ptr: *mut Map) -> *mut map::OpBuilder<'
     to_raw_ptr(ob)
 }
 make_free_fn!(fst_map_opbuilder_free, *mut map::OpBuilder);
-make_free_fn!(fst_map_opitem_free, *mut MapOpItem);
+
+#[no_mangle]
+pub extern "C" fn fst_map_opitem_free(ptr: *mut MapOpItem) {
+    let item = val_from_ptr!(ptr);
+    unsafe {
+        Box::from_raw(slice::from_raw_parts_mut(item.values, item.num_values));
+    }
+}
+
+#[no_mangle]
+pub extern "C" fn fst_map_opitembatch_free(ptr: *mut MapOpItemBatch) {
+    let batch = val_from_ptr!(ptr);
+    unsafe {
+        let keys_len = *batch.offsets.offset(batch.num_items as isize);
+        let num_values = *batch.value_offsets.offset(batch.num_items as isize);
+        Box::from_raw(slice::from_raw_parts_mut(batch.keys, keys_len));
+        Box::from_raw(slice::from_raw_parts_mut(batch.offsets, batch.num_items + 1));
+        Box::from_raw(slice::from_raw_parts_mut(batch.value_offsets, batch.num_items + 1));
+        Box::from_raw(slice::from_raw_parts_mut(batch.values, num_values));
+    }
+}
 
 #[no_mangle]
 pub extern "C" fn fst_map_opbuilder_push(ptr: *mut map::OpBuilder, map_ptr: *mut Map) {
@@ -218,6 +560,15 @@ pub extern "C" fn fst_map_opbuilder_union(ptr: *mut map::OpBuilder)
 }
 make_free_fn!(fst_map_union_free, *mut map::Union);
 mapop_make_next_fn!(fst_map_union_next, *mut map::Union);
+mapop_make_batch_fn!(fst_map_union_batch, *mut map::Union);
+make_count_fn!(fst_map_union_count, *mut map::Union);
+
+#[no_mangle]
+pub extern "C" fn fst_map_union_reduce(ptr: *mut map::Union<'static>,
+                                       reducer: u32)
+                                       -> *mut ReducedStream {
+    to_raw_ptr(ReducedStream::new(val_from_ptr!(ptr), Reducer::from_code(reducer)))
+}
 
 #[no_mangle]
 pub extern "C" fn fst_map_opbuilder_intersection(ptr: *mut map::OpBuilder)
@@ -227,6 +578,15 @@ pub extern "C" fn fst_map_opbuilder_intersection(ptr: *mut map::OpBuilder)
 }
 make_free_fn!(fst_map_intersection_free, *mut map::Intersection);
 mapop_make_next_fn!(fst_map_intersection_next, *mut map::Intersection);
+mapop_make_batch_fn!(fst_map_intersection_batch, *mut map::Intersection);
+make_count_fn!(fst_map_intersection_count, *mut map::Intersection);
+
+#[no_mangle]
+pub extern "C" fn fst_map_intersection_reduce(ptr: *mut map::Intersection<'static>,
+                                              reducer: u32)
+                                              -> *mut ReducedStream {
+    to_raw_ptr(ReducedStream::new(val_from_ptr!(ptr), Reducer::from_code(reducer)))
+}
 
 #[no_mangle]
 pub extern "C" fn fst_map_opbuilder_difference(ptr: *mut map::OpBuilder)
@@ -236,6 +596,15 @@ pub extern "C" fn fst_map_opbuilder_difference(ptr: *mut map::OpBuilder)
 }
 make_free_fn!(fst_map_difference_free, *mut map::Difference);
 mapop_make_next_fn!(fst_map_difference_next, *mut map::Difference);
+mapop_make_batch_fn!(fst_map_difference_batch, *mut map::Difference);
+make_count_fn!(fst_map_difference_count, *mut map::Difference);
+
+#[no_mangle]
+pub extern "C" fn fst_map_difference_reduce(ptr: *mut map::Difference<'static>,
+                                            reducer: u32)
+                                            -> *mut ReducedStream {
+    to_raw_ptr(ReducedStream::new(val_from_ptr!(ptr), Reducer::from_code(reducer)))
+}
 
 #[no_mangle]
 pub extern "C" fn fst_map_opbuilder_symmetricdifference
@@ -246,6 +615,35 @@ pub extern "C" fn fst_map_opbuilder_symmetricdifference
 }
 make_free_fn!(fst_map_symmetricdifference_free, *mut map::SymmetricDifference);
 mapop_make_next_fn!(fst_map_symmetricdifference_next, *mut map::SymmetricDifference);
+mapop_make_batch_fn!(fst_map_symmetricdifference_batch, *mut map::SymmetricDifference);
+make_count_fn!(fst_map_symmetricdifference_count, *mut map::SymmetricDifference);
+
+#[no_mangle]
+pub extern "C" fn fst_map_symmetricdifference_reduce(ptr: *mut map::SymmetricDifference<'static>,
+                                                     reducer: u32)
+                                                     -> *mut ReducedStream {
+    to_raw_ptr(ReducedStream::new(val_from_ptr!(ptr), Reducer::from_code(reducer)))
+}
+
+make_free_fn!(fst_map_reducedstream_free, *mut ReducedStream);
+map_make_next_fn!(fst_map_reducedstream_next, *mut ReducedStream);
+map_make_batch_fn!(fst_map_reducedstream_batch, *mut ReducedStream);
+make_count_fn!(fst_map_reducedstream_count, *mut ReducedStream);
+map_make_into_fn!(fst_map_reducedstream_into, *mut ReducedStream);
+
+/// Write the keys of a reduced stream, which is consumed, into a new set file
+#[no_mangle]
+pub extern "C" fn fst_map_reducedstream_into_set(ctx: *mut Context,
+                                                 ptr: *mut ReducedStream,
+                                                 c_path: *mut libc::c_char)
+                                                 -> bool {
+    let mut stream = val_from_ptr!(ptr);
+    let path = cstr_to_str(c_path);
+    with_context!(ctx, false, ::set::write_item_keys(&mut *stream, path));
+    true
+}
+map_make_value_fns!(fst_map_reducedstream_values, fst_map_reducedstream_stats,
+                   fst_map_reducedstream_histogram, *mut ReducedStream);
 
 
 #[no_mangle]
@@ -256,18 +654,35 @@ pub extern "C" fn fst_map_streambuilder_new(ptr: *mut Map) -> *mut map::StreamBu
 
 #[no_mangle]
 pub extern "C" fn fst_map_streambuilder_add_ge(ptr: *mut map::StreamBuilder<'static>,
-                                               c_bound: *mut libc::c_char)
+                                               c_bound: *const libc::c_char,
+                                               bound_len: libc::size_t)
                                                -> *mut map::StreamBuilder<'static> {
     let sb = val_from_ptr!(ptr);
-    to_raw_ptr(sb.ge(cstr_to_str(c_bound)))
+    to_raw_ptr(sb.ge(bytes_from_ptr(c_bound, bound_len)))
 }
 
 #[no_mangle]
 pub extern "C" fn fst_map_streambuilder_add_lt(ptr: *mut map::StreamBuilder<'static>,
-                                               c_bound: *mut libc::c_char)
+                                               c_bound: *const libc::c_char,
+                                               bound_len: libc::size_t)
                                                -> *mut map::StreamBuilder<'static> {
     let sb = val_from_ptr!(ptr);
-    to_raw_ptr(sb.lt(cstr_to_str(c_bound)))
+    to_raw_ptr(sb.lt(bytes_from_ptr(c_bound, bound_len)))
+}
+
+/// Restrict a range to the keys that start with a prefix
+#[no_mangle]
+pub extern "C" fn fst_map_streambuilder_add_prefix(ptr: *mut map::StreamBuilder<'static>,
+                                                   c_prefix: *const libc::c_char,
+                                                   prefix_len: libc::size_t)
+                                                   -> *mut map::StreamBuilder<'static> {
+    let sb = val_from_ptr!(ptr);
+    let prefix = bytes_from_ptr(c_prefix, prefix_len);
+    let sb = sb.ge(prefix);
+    to_raw_ptr(match prefix_successor(prefix) {
+        Some(succ) => sb.lt(succ),
+        None => sb,
+    })
 }
 
 #[no_mangle]
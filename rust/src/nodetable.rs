@@ -0,0 +1,117 @@
+use std::collections::HashMap;
+use std::fs::File;
+use std::io;
+use std::io::{Read, Write};
+use fst::raw::{CompiledAddr, Fst, Node};
+
+
+/// Compute a number for every node of an FST from the numbers of its children
+///
+/// `f` is called for every node with a lookup function for the numbers of its children, which have
+/// already been computed.
+pub fn fold_nodes<F>(fst: &Fst, mut f: F) -> HashMap<CompiledAddr, u64>
+    where F: FnMut(&Node, &Fn(CompiledAddr) -> u64) -> u64
+{
+    let mut numbers: HashMap<CompiledAddr, u64> = HashMap::new();
+    // Iterative post-order traversal, since keys can be too long for recursion
+    let mut stack = vec![(fst.root().addr(), false)];
+    while let Some((addr, visited)) = stack.pop() {
+        if numbers.contains_key(&addr) {
+            continue;
+        }
+        let node = fst.node(addr);
+        if visited {
+            let number = f(&node, &|child| numbers[&child]);
+            numbers.insert(addr, number);
+        } else {
+            stack.push((addr, true));
+            for trans in node.transitions() {
+                if !numbers.contains_key(&trans.addr) {
+                    stack.push((trans.addr, false));
+                }
+            }
+        }
+    }
+    numbers
+}
+
+/// A number for some or all nodes of an FST, which can be stored in a side file
+///
+/// The file consists of magic bytes identifying the kind of table, the size of the FST and the
+/// address of its root node, which identify the FST the table was built for, the number of
+/// entries and an `(address, number)` pair for every entry, sorted by address. All numbers are
+/// stored as little-endian `u64`.
+pub struct NodeTable {
+    fst_size: u64,
+    root_addr: u64,
+    entries: Vec<(u64, u64)>,
+}
+
+impl NodeTable {
+    pub fn new<I>(fst: &Fst, entries: I) -> Self
+        where I: IntoIterator<Item = (CompiledAddr, u64)>
+    {
+        let mut entries: Vec<(u64, u64)> = entries.into_iter()
+            .map(|(addr, number)| (addr as u64, number))
+            .collect();
+        entries.sort();
+        NodeTable {
+            fst_size: fst.size() as u64,
+            root_addr: fst.root().addr() as u64,
+            entries: entries,
+        }
+    }
+
+    pub fn get(&self, addr: CompiledAddr) -> Option<u64> {
+        self.entries.binary_search_by_key(&(addr as u64), |&(a, _)| a)
+            .ok()
+            .map(|idx| self.entries[idx].1)
+    }
+
+    /// Check if the table was built for an FST
+    pub fn matches(&self, fst: &Fst) -> bool {
+        self.fst_size == fst.size() as u64 && self.root_addr == fst.root().addr() as u64
+    }
+
+    pub fn save(&self, path: &str, magic: &[u8; 8]) -> io::Result<()> {
+        let mut writer = io::BufWriter::new(File::create(path)?);
+        writer.write_all(magic)?;
+        for &num in &[self.fst_size, self.root_addr, self.entries.len() as u64] {
+            writer.write_all(&num.to_le_bytes())?;
+        }
+        for &(addr, number) in &self.entries {
+            writer.write_all(&addr.to_le_bytes())?;
+            writer.write_all(&number.to_le_bytes())?;
+        }
+        writer.flush()
+    }
+
+    pub fn open(path: &str, magic: &[u8; 8]) -> io::Result<Self> {
+        let mut reader = io::BufReader::new(File::open(path)?);
+        let mut file_magic = [0; 8];
+        reader.read_exact(&mut file_magic)?;
+        if &file_magic != magic {
+            return Err(io::Error::new(io::ErrorKind::InvalidData,
+                                      format!("{}: unexpected file format", path)));
+        }
+        let fst_size = read_u64(&mut reader)?;
+        let root_addr = read_u64(&mut reader)?;
+        let num_entries = read_u64(&mut reader)? as usize;
+        let mut entries = Vec::with_capacity(num_entries);
+        for _ in 0..num_entries {
+            let addr = read_u64(&mut reader)?;
+            entries.push((addr, read_u64(&mut reader)?));
+        }
+        Ok(NodeTable {
+            fst_size: fst_size,
+            root_addr: root_addr,
+            entries: entries,
+        })
+    }
+}
+
+fn read_u64<R: Read>(reader: &mut R) -> io::Result<u64> {
+    let mut buf = [0; 8];
+    reader.read_exact(&mut buf)?;
+    Ok(u64::from_le_bytes(buf))
+}
@@ -0,0 +1,220 @@
+extern crate libc;
+
+use fst::{Automaton, IntoStreamer, Map, Set, Streamer};
+use fst::{map, set};
+use fst_levenshtein::Levenshtein;
+use fst_regex::Regex;
+
+use util::{bytes_from_ptr, to_raw_ptr};
+
+
+pub type SetQueryStream = set::Stream<'static, &'static Query>;
+pub type MapQueryStream = map::Stream<'static, &'static Query>;
+
+/// Automaton of a query term, all of which have an `Option<usize>` state that is `None` once no
+/// more matches are possible
+enum TermKind {
+    Levenshtein(&'static Levenshtein),
+    Regex(&'static Regex),
+    Prefix(Vec<u8>),
+}
+
+/// A term of a query, whose matches are excluded from the results if it is negated
+struct Term {
+    kind: TermKind,
+    negated: bool,
+}
+
+impl Term {
+    fn start(&self) -> Option<usize> {
+        match self.kind {
+            TermKind::Levenshtein(lev) => lev.start(),
+            TermKind::Regex(regex) => regex.start(),
+            TermKind::Prefix(_) => Some(0),
+        }
+    }
+
+    fn is_match(&self, state: &Option<usize>) -> bool {
+        match self.kind {
+            TermKind::Levenshtein(lev) => lev.is_match(state),
+            TermKind::Regex(regex) => regex.is_match(state),
+            TermKind::Prefix(ref prefix) => *state == Some(prefix.len()),
+        }
+    }
+
+    fn can_match(&self, state: &Option<usize>) -> bool {
+        match self.kind {
+            TermKind::Levenshtein(lev) => lev.can_match(state),
+            TermKind::Regex(regex) => regex.can_match(state),
+            TermKind::Prefix(_) => state.is_some(),
+        }
+    }
+
+    fn will_always_match(&self, state: &Option<usize>) -> bool {
+        match self.kind {
+            TermKind::Levenshtein(lev) => lev.will_always_match(state),
+            TermKind::Regex(regex) => regex.will_always_match(state),
+            TermKind::Prefix(ref prefix) => *state == Some(prefix.len()),
+        }
+    }
+
+    fn accept(&self, state: &Option<usize>, byte: u8) -> Option<usize> {
+        match self.kind {
+            TermKind::Levenshtein(lev) => lev.accept(state, byte),
+            TermKind::Regex(regex) => regex.accept(state, byte),
+            TermKind::Prefix(ref prefix) => state.and_then(|pos| {
+                if pos == prefix.len() {
+                    Some(pos)
+                } else if prefix[pos] == byte {
+                    Some(pos + 1)
+                } else {
+                    None
+                }
+            }),
+        }
+    }
+}
+
+enum Bound {
+    Included(Vec<u8>),
+    Excluded(Vec<u8>),
+}
+
+/// Intersection of any number of automata and complements of automata, restricted to a key range
+///
+/// The terms are combined like `fst::automaton::Intersection` and `fst::automaton::Complement`
+/// would, which only support a fixed number of statically typed automata. Since the combined
+/// automaton reports when no term can match anymore, a search only visits the parts of the FST
+/// that can contain results.
+pub struct Query {
+    terms: Vec<Term>,
+    lower: Option<Bound>,
+    upper: Option<Bound>,
+}
+
+impl Automaton for Query {
+    type State = Vec<Option<usize>>;
+
+    fn start(&self) -> Self::State {
+        self.terms.iter().map(|term| term.start()).collect()
+    }
+
+    fn is_match(&self, state: &Self::State) -> bool {
+        self.terms.iter().zip(state).all(|(term, s)| term.is_match(s) != term.negated)
+    }
+
+    fn can_match(&self, state: &Self::State) -> bool {
+        self.terms.iter().zip(state).all(|(term, s)| {
+            if term.negated { !term.will_always_match(s) } else { term.can_match(s) }
+        })
+    }
+
+    fn will_always_match(&self, state: &Self::State) -> bool {
+        self.terms.iter().zip(state).all(|(term, s)| {
+            if term.negated { !term.can_match(s) } else { term.will_always_match(s) }
+        })
+    }
+
+    fn accept(&self, state: &Self::State, byte: u8) -> Self::State {
+        self.terms.iter().zip(state).map(|(term, s)| term.accept(s, byte)).collect()
+    }
+}
+
+/// Apply the bounds of a query to a set or map stream builder
+macro_rules! with_bounds {
+    ($sb:expr, $query:expr) => ({
+        let sb = match $query.lower {
+            Some(Bound::Included(ref key)) => $sb.ge(key),
+            Some(Bound::Excluded(ref key)) => $sb.gt(key),
+            None => $sb,
+        };
+        match $query.upper {
+            Some(Bound::Included(ref key)) => sb.le(key),
+            Some(Bound::Excluded(ref key)) => sb.lt(key),
+            None => sb,
+        }
+    })
+}
+
+
+#[no_mangle]
+pub extern "C" fn fst_query_new() -> *mut Query {
+    to_raw_ptr(Query {
+        terms: Vec::new(),
+        lower: None,
+        upper: None,
+    })
+}
+make_free_fn!(fst_query_free, *mut Query);
+
+#[no_mangle]
+pub extern "C" fn fst_query_add_levenshtein(ptr: *mut Query,
+                                            lev_ptr: *mut Levenshtein,
+                                            negated: bool) {
+    let query = mutref_from_ptr!(ptr);
+    let lev = ref_from_ptr!(lev_ptr);
+    query.terms.push(Term { kind: TermKind::Levenshtein(lev), negated: negated });
+}
+
+#[no_mangle]
+pub extern "C" fn fst_query_add_regex(ptr: *mut Query, regex_ptr: *mut Regex, negated: bool) {
+    let query = mutref_from_ptr!(ptr);
+    let regex = ref_from_ptr!(regex_ptr);
+    query.terms.push(Term { kind: TermKind::Regex(regex), negated: negated });
+}
+
+#[no_mangle]
+pub extern "C" fn fst_query_add_prefix(ptr: *mut Query,
+                                       c_prefix: *const libc::c_char,
+                                       prefix_len: libc::size_t,
+                                       negated: bool) {
+    let query = mutref_from_ptr!(ptr);
+    let prefix = bytes_from_ptr(c_prefix, prefix_len).to_vec();
+    query.terms.push(Term { kind: TermKind::Prefix(prefix), negated: negated });
+}
+
+/// Set the lower bound of a query, which is excluded from the results unless `inclusive` is set
+#[no_mangle]
+pub extern "C" fn fst_query_set_lower(ptr: *mut Query,
+                                      c_bound: *const libc::c_char,
+                                      bound_len: libc::size_t,
+                                      inclusive: bool) {
+    let query = mutref_from_ptr!(ptr);
+    let bound = bytes_from_ptr(c_bound, bound_len).to_vec();
+    query.lower = Some(if inclusive { Bound::Included(bound) } else { Bound::Excluded(bound) });
+}
+
+/// Set the upper bound of a query, which is excluded from the results unless `inclusive` is set
+#[no_mangle]
+pub extern "C" fn fst_query_set_upper(ptr: *mut Query,
+                                      c_bound: *const libc::c_char,
+                                      bound_len: libc::size_t,
+                                      inclusive: bool) {
+    let query = mutref_from_ptr!(ptr);
+    let bound = bytes_from_ptr(c_bound, bound_len).to_vec();
+    query.upper = Some(if inclusive { Bound::Included(bound) } else { Bound::Excluded(bound) });
+}
+
+#[no_mangle]
+pub extern "C" fn fst_set_querysearch(set_ptr: *mut Set, ptr: *mut Query) -> *mut SetQueryStream {
+    let set = ref_from_ptr!(set_ptr);
+    let query = ref_from_ptr!(ptr);
+    to_raw_ptr(with_bounds!(set.search(query), query).into_stream())
+}
+make_free_fn!(fst_set_querystream_free, *mut SetQueryStream);
+set_make_next_fn!(fst_set_querystream_next, *mut SetQueryStream);
+set_make_batch_fn!(fst_set_querystream_batch, *mut SetQueryStream);
+make_count_fn!(fst_set_querystream_count, *mut SetQueryStream);
+
+#[no_mangle]
+pub extern "C" fn fst_map_querysearch(map_ptr: *mut Map, ptr: *mut Query) -> *mut MapQueryStream {
+    let map = ref_from_ptr!(map_ptr);
+    let query = ref_from_ptr!(ptr);
+    to_raw_ptr(with_bounds!(map.search(query), query).into_stream())
+}
+make_free_fn!(fst_map_querystream_free, *mut MapQueryStream);
+map_make_next_fn!(fst_map_querystream_next, *mut MapQueryStream);
+map_make_batch_fn!(fst_map_querystream_batch, *mut MapQueryStream);
+make_count_fn!(fst_map_querystream_count, *mut MapQueryStream);
+map_make_value_fns!(fst_map_querystream_values, fst_map_querystream_stats,
+                   fst_map_querystream_histogram, *mut MapQueryStream);
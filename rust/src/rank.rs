@@ -0,0 +1,229 @@
+extern crate libc;
+
+use std::io;
+use std::ptr;
+use fst::{Map, Set};
+use fst::raw::{CompiledAddr, Fst};
+
+use nodetable::{NodeTable, fold_nodes};
+use util::{BatchBuilder, Context, StreamBatch, bytes_from_ptr, cstr_to_str, to_raw_ptr};
+
+
+/// Identifies rank index files, including the version of the format
+const MAGIC: &'static [u8; 8] = b"fstrank1";
+
+/// Nodes with fewer keys below them are not stored in the index, but counted when needed
+const MIN_SAMPLED_COUNT: u64 = 32;
+
+/// Number of keys below the nodes of an FST, used to find the position of a key and the key at a
+/// position without iterating over the preceding keys
+///
+/// Only nodes with at least `MIN_SAMPLED_COUNT` keys below them are sampled. This keeps the index
+/// a fraction of the size of the FST, while counting the keys of the other nodes visits at most
+/// `MIN_SAMPLED_COUNT` paths.
+pub struct RankIndex {
+    counts: NodeTable,
+}
+
+impl RankIndex {
+    pub fn build(fst: &Fst) -> Self {
+        let counts = fold_nodes(fst, |node, child_count| {
+            let mut count = if node.is_final() { 1 } else { 0 };
+            for trans in node.transitions() {
+                count += child_count(trans.addr);
+            }
+            count
+        });
+        let sampled = counts.into_iter().filter(|&(_, count)| count >= MIN_SAMPLED_COUNT);
+        RankIndex { counts: NodeTable::new(fst, sampled) }
+    }
+
+    pub fn matches(&self, fst: &Fst) -> bool {
+        self.counts.matches(fst)
+    }
+
+    pub fn save(&self, path: &str) -> io::Result<()> {
+        self.counts.save(path, MAGIC)
+    }
+
+    pub fn open(path: &str) -> io::Result<Self> {
+        Ok(RankIndex { counts: NodeTable::open(path, MAGIC)? })
+    }
+
+    /// Count the keys below a node
+    fn count(&self, fst: &Fst, addr: CompiledAddr) -> usize {
+        let mut count = 0;
+        let mut stack = vec![addr];
+        while let Some(addr) = stack.pop() {
+            if let Some(sampled) = self.counts.get(addr) {
+                count += sampled as usize;
+                continue;
+            }
+            let node = fst.node(addr);
+            if node.is_final() {
+                count += 1;
+            }
+            stack.extend(node.transitions().map(|trans| trans.addr));
+        }
+        count
+    }
+
+    /// Count the keys that are lexicographically smaller than `key`
+    pub fn rank(&self, fst: &Fst, key: &[u8]) -> usize {
+        let mut rank = 0;
+        let mut node = fst.root();
+        for &byte in key {
+            // A key that ends here is a proper prefix of `key`
+            if node.is_final() {
+                rank += 1;
+            }
+            let mut next = None;
+            for trans in node.transitions() {
+                if trans.inp >= byte {
+                    if trans.inp == byte {
+                        next = Some(trans.addr);
+                    }
+                    break;
+                }
+                rank += self.count(fst, trans.addr);
+            }
+            match next {
+                Some(addr) => node = fst.node(addr),
+                None => return rank,
+            }
+        }
+        rank
+    }
+
+    /// Find the key with `rank` smaller keys and its value, or `None` if there are not enough keys
+    pub fn select(&self, fst: &Fst, rank: usize) -> Option<(Vec<u8>, u64)> {
+        let mut remaining = rank;
+        let mut key = Vec::new();
+        let mut value = 0;
+        let mut node = fst.root();
+        loop {
+            if node.is_final() {
+                if remaining == 0 {
+                    return Some((key, value + node.final_output().value()));
+                }
+                remaining -= 1;
+            }
+            let mut next = None;
+            for trans in node.transitions() {
+                let count = self.count(fst, trans.addr);
+                if remaining < count {
+                    next = Some(trans);
+                    break;
+                }
+                remaining -= count;
+            }
+            match next {
+                Some(trans) => {
+                    key.push(trans.inp);
+                    value += trans.out.value();
+                    node = fst.node(trans.addr);
+                }
+                None => return None,
+            }
+        }
+    }
+}
+
+/// Hand the result of `RankIndex::select` over as a batch of zero or one items
+fn select_batch(result: Option<(Vec<u8>, u64)>, with_values: bool) -> *mut StreamBatch {
+    let mut batch = BatchBuilder::new(with_values);
+    if let Some((key, value)) = result {
+        batch.push_item(&key, value);
+    }
+    batch.finish()
+}
+
+
+#[no_mangle]
+pub extern "C" fn fst_set_rankindex_build(set_ptr: *mut Set) -> *mut RankIndex {
+    let set = ref_from_ptr!(set_ptr);
+    to_raw_ptr(RankIndex::build(set.as_fst()))
+}
+
+#[no_mangle]
+pub extern "C" fn fst_map_rankindex_build(map_ptr: *mut Map) -> *mut RankIndex {
+    let map = ref_from_ptr!(map_ptr);
+    to_raw_ptr(RankIndex::build(map.as_fst()))
+}
+
+#[no_mangle]
+pub extern "C" fn fst_rankindex_open(ctx: *mut Context,
+                                     c_path: *mut libc::c_char)
+                                     -> *mut RankIndex {
+    let path = cstr_to_str(c_path);
+    let index = with_context!(ctx, ptr::null_mut(), RankIndex::open(path));
+    to_raw_ptr(index)
+}
+
+#[no_mangle]
+pub extern "C" fn fst_rankindex_save(ctx: *mut Context,
+                                     ptr: *mut RankIndex,
+                                     c_path: *mut libc::c_char)
+                                     -> bool {
+    let index = ref_from_ptr!(ptr);
+    let path = cstr_to_str(c_path);
+    with_context!(ctx, false, index.save(path));
+    true
+}
+
+#[no_mangle]
+pub extern "C" fn fst_set_rankindex_matches(ptr: *mut RankIndex, set_ptr: *mut Set) -> bool {
+    let index = ref_from_ptr!(ptr);
+    let set = ref_from_ptr!(set_ptr);
+    index.matches(set.as_fst())
+}
+
+#[no_mangle]
+pub extern "C" fn fst_map_rankindex_matches(ptr: *mut RankIndex, map_ptr: *mut Map) -> bool {
+    let index = ref_from_ptr!(ptr);
+    let map = ref_from_ptr!(map_ptr);
+    index.matches(map.as_fst())
+}
+make_free_fn!(fst_rankindex_free, *mut RankIndex);
+
+#[no_mangle]
+pub extern "C" fn fst_set_rank(set_ptr: *mut Set,
+                               ptr: *mut RankIndex,
+                               c_key: *const libc::c_char,
+                               key_len: libc::size_t)
+                               -> libc::size_t {
+    let set = ref_from_ptr!(set_ptr);
+    let index = ref_from_ptr!(ptr);
+    index.rank(set.as_fst(), bytes_from_ptr(c_key, key_len))
+}
+
+#[no_mangle]
+pub extern "C" fn fst_map_rank(map_ptr: *mut Map,
+                               ptr: *mut RankIndex,
+                               c_key: *const libc::c_char,
+                               key_len: libc::size_t)
+                               -> libc::size_t {
+    let map = ref_from_ptr!(map_ptr);
+    let index = ref_from_ptr!(ptr);
+    index.rank(map.as_fst(), bytes_from_ptr(c_key, key_len))
+}
+
+#[no_mangle]
+pub extern "C" fn fst_set_select(set_ptr: *mut Set,
+                                 ptr: *mut RankIndex,
+                                 rank: libc::size_t)
+                                 -> *mut StreamBatch {
+    let set = ref_from_ptr!(set_ptr);
+    let index = ref_from_ptr!(ptr);
+    select_batch(index.select(set.as_fst(), rank), false)
+}
+
+#[no_mangle]
+pub extern "C" fn fst_map_select(map_ptr: *mut Map,
+                                 ptr: *mut RankIndex,
+                                 rank: libc::size_t)
+                                 -> *mut StreamBatch {
+    let map = ref_from_ptr!(map_ptr);
+    let index = ref_from_ptr!(ptr);
+    select_batch(index.select(map.as_fst(), rank), true)
+}
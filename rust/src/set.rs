@@ -1,15 +1,18 @@
 extern crate libc;
 
-use std::error::Error;
 use std::fs::File;
 use std::io;
 use std::ptr;
-use fst::{IntoStreamer, Streamer, Set, SetBuilder};
+use std::slice;
+use std::str;
+use fst::{self, IntoStreamer, Streamer, Set, SetBuilder};
 use fst::set;
 use fst_levenshtein::Levenshtein;
 use fst_regex::Regex;
 
-use util::{Context, cstr_to_str, to_raw_ptr};
+use util::{Context, ErrorKind, LineReader, RecordReader, StreamBatch, TopK, bytes_from_ptr,
+           cstr_to_str, levenshtein_distance, packed_keys, prefix_successor, set_error,
+           to_raw_ptr, vec_to_raw};
 
 
 pub type FileSetBuilder = SetBuilder<&'static mut io::BufWriter<File>>;
@@ -18,6 +21,64 @@ pub type SetLevStream = set::Stream<'static, &'static Levenshtein>;
 pub type SetRegexStream = set::Stream<'static, &'static Regex>;
 
 
+/// Insert the lines of a text file into a set builder, one key per line
+///
+/// Empty lines are skipped. If `check_utf8` is set, lines that are not valid UTF-8 are rejected.
+fn insert_lines<W: io::Write>(ctx: *mut Context,
+                              build: &mut SetBuilder<W>,
+                              path: &str,
+                              check_utf8: bool)
+                               -> bool {
+    let mut lines = with_context!(ctx, false, LineReader::open(path));
+    while let Some((line_no, key)) = with_context!(ctx, false, lines.next_line()) {
+        if key.is_empty() {
+            continue;
+        }
+        if check_utf8 && str::from_utf8(key).is_err() {
+            set_error(ctx, ErrorKind::Value, &format!("line {}: key is not valid UTF-8", line_no));
+            return false;
+        }
+        with_line_context!(ctx, line_no, false, build.insert(key));
+    }
+    true
+}
+
+/// Insert the keys of the records in a byte range of a run file into a set builder
+fn insert_records<W: io::Write>(ctx: *mut Context,
+                                build: &mut SetBuilder<W>,
+                                path: &str,
+                                start: u64,
+                                end: u64)
+                                -> bool {
+    let mut records = with_context!(ctx, false, RecordReader::open(path, start, end, false));
+    while let Some((key, _)) = with_context!(ctx, false, records.next_record()) {
+        with_context!(ctx, false, build.insert(key));
+    }
+    true
+}
+
+/// Write the remaining keys of a stream into a new set file
+pub fn write_stream<S>(stream: &mut S, path: &str) -> Result<(), fst::Error>
+    where S: for<'a> Streamer<'a, Item = &'a [u8]>
+{
+    let mut build = SetBuilder::new(io::BufWriter::new(File::create(path)?))?;
+    while let Some(key) = stream.next() {
+        build.insert(key)?;
+    }
+    build.finish()
+}
+
+/// Write the keys of the remaining items of a map stream into a new set file
+pub fn write_item_keys<S>(stream: &mut S, path: &str) -> Result<(), fst::Error>
+    where S: for<'a> Streamer<'a, Item = (&'a [u8], u64)>
+{
+    let mut build = SetBuilder::new(io::BufWriter::new(File::create(path)?))?;
+    while let Some((key, _)) = stream.next() {
+        build.insert(key)?;
+    }
+    build.finish()
+}
+
 #[no_mangle]
 pub extern "C" fn fst_filesetbuilder_new(ctx: *mut Context,
                                          wtr_ptr: *mut io::BufWriter<File>)
@@ -29,13 +90,47 @@ pub extern "C" fn fst_filesetbuilder_new(ctx: *mut Context,
 #[no_mangle]
 pub extern "C" fn fst_filesetbuilder_insert(ctx: *mut Context,
                                             ptr: *mut FileSetBuilder,
-                                            s: *mut libc::c_char)
+                                            s: *const libc::c_char,
+                                            len: libc::size_t)
                                             -> bool {
     let build = mutref_from_ptr!(ptr);
-    with_context!(ctx, false, build.insert(cstr_to_str(s)));
+    with_context!(ctx, false, build.insert(bytes_from_ptr(s, len)));
+    true
+}
+
+#[no_mangle]
+pub extern "C" fn fst_filesetbuilder_insert_many(ctx: *mut Context,
+                                                 ptr: *mut FileSetBuilder,
+                                                 buf: *const libc::c_char,
+                                                 offsets: *const libc::size_t,
+                                                 num_keys: libc::size_t)
+                                                 -> bool {
+    let build = mutref_from_ptr!(ptr);
+    for key in packed_keys(buf, offsets, num_keys) {
+        with_context!(ctx, false, build.insert(key));
+    }
     true
 }
 
+#[no_mangle]
+pub extern "C" fn fst_filesetbuilder_insert_file(ctx: *mut Context,
+                                                 ptr: *mut FileSetBuilder,
+                                                 path: *mut libc::c_char,
+                                                 check_utf8: bool)
+                                                 -> bool {
+    insert_lines(ctx, mutref_from_ptr!(ptr), cstr_to_str(path), check_utf8)
+}
+
+#[no_mangle]
+pub extern "C" fn fst_filesetbuilder_insert_records(ctx: *mut Context,
+                                                    ptr: *mut FileSetBuilder,
+                                                    path: *mut libc::c_char,
+                                                    start: u64,
+                                                    end: u64)
+                                                    -> bool {
+    insert_records(ctx, mutref_from_ptr!(ptr), cstr_to_str(path), start, end)
+}
+
 #[no_mangle]
 pub extern "C" fn fst_filesetbuilder_finish(ctx: *mut Context, ptr: *mut FileSetBuilder) -> bool {
     let build = val_from_ptr!(ptr);
@@ -51,13 +146,47 @@ pub extern "C" fn fst_memsetbuilder_new() -> *mut MemSetBuilder {
 #[no_mangle]
 pub extern "C" fn fst_memsetbuilder_insert(ctx: *mut Context,
                                            ptr: *mut MemSetBuilder,
-                                           s: *mut libc::c_char)
+                                           s: *const libc::c_char,
+                                           len: libc::size_t)
                                            -> bool {
     let build = mutref_from_ptr!(ptr);
-    with_context!(ctx, false, build.insert(cstr_to_str(s)));
+    with_context!(ctx, false, build.insert(bytes_from_ptr(s, len)));
+    true
+}
+
+#[no_mangle]
+pub extern "C" fn fst_memsetbuilder_insert_many(ctx: *mut Context,
+                                                ptr: *mut MemSetBuilder,
+                                                buf: *const libc::c_char,
+                                                offsets: *const libc::size_t,
+                                                num_keys: libc::size_t)
+                                                -> bool {
+    let build = mutref_from_ptr!(ptr);
+    for key in packed_keys(buf, offsets, num_keys) {
+        with_context!(ctx, false, build.insert(key));
+    }
     true
 }
 
+#[no_mangle]
+pub extern "C" fn fst_memsetbuilder_insert_file(ctx: *mut Context,
+                                                ptr: *mut MemSetBuilder,
+                                                path: *mut libc::c_char,
+                                                check_utf8: bool)
+                                                -> bool {
+    insert_lines(ctx, mutref_from_ptr!(ptr), cstr_to_str(path), check_utf8)
+}
+
+#[no_mangle]
+pub extern "C" fn fst_memsetbuilder_insert_records(ctx: *mut Context,
+                                                   ptr: *mut MemSetBuilder,
+                                                   path: *mut libc::c_char,
+                                                   start: u64,
+                                                   end: u64)
+                                                   -> bool {
+    insert_records(ctx, mutref_from_ptr!(ptr), cstr_to_str(path), start, end)
+}
+
 #[no_mangle]
 pub extern "C" fn fst_memsetbuilder_finish(ctx: *mut Context, ptr: *mut MemSetBuilder) -> *mut Set {
     let build = val_from_ptr!(ptr);
@@ -75,24 +204,63 @@ pub unsafe extern "C" fn fst_set_open(ctx: *mut Context, cpath: *mut libc::c_cha
 }
 make_free_fn!(fst_set_free, *mut Set);
 
+/// Create a set that borrows its data from a buffer owned by the caller, without copying it.
+///
+/// The buffer must stay alive and unmodified for as long as the set and its streams are in use.
+#[no_mangle]
+pub extern "C" fn fst_set_from_buffer(ctx: *mut Context,
+                                      buf: *const libc::c_char,
+                                      len: libc::size_t)
+                                      -> *mut Set {
+    let data: &'static [u8] = bytes_from_ptr(buf, len);
+    let set = with_context!(ctx, ptr::null_mut(), Set::from_static_slice(data));
+    to_raw_ptr(set)
+}
+
+#[no_mangle]
+pub extern "C" fn fst_set_to_bytes(ptr: *mut Set, len: *mut libc::size_t) -> *mut libc::c_char {
+    vec_to_raw(ref_from_ptr!(ptr).as_fst().to_vec(), len)
+}
+
+
+#[no_mangle]
+pub extern "C" fn fst_set_contains(ptr: *mut Set,
+                                   s: *const libc::c_char,
+                                   len: libc::size_t)
+                                   -> bool {
+    let set = ref_from_ptr!(ptr);
+    set.contains(bytes_from_ptr(s, len))
+}
 
+/// Check for each of `num_keys` packed keys if it is contained in the set and write the result to
+/// the corresponding element of `out`, which must have room for `num_keys` bytes
 #[no_mangle]
-pub extern "C" fn fst_set_contains(ptr: *mut Set, s: *mut libc::c_char) -> bool {
-    let set = mutref_from_ptr!(ptr);
-    set.contains(cstr_to_str(s))
+pub extern "C" fn fst_set_contains_many(ptr: *mut Set,
+                                        buf: *const libc::c_char,
+                                        offsets: *const libc::size_t,
+                                        num_keys: libc::size_t,
+                                        out: *mut u8) {
+    let set = ref_from_ptr!(ptr);
+    assert!(!out.is_null());
+    let out = unsafe { slice::from_raw_parts_mut(out, num_keys) };
+    for (key, found) in packed_keys(buf, offsets, num_keys).zip(out.iter_mut()) {
+        *found = set.contains(key) as u8;
+    }
 }
 
 #[no_mangle]
 pub extern "C" fn fst_set_stream(ptr: *mut Set) -> *mut set::Stream<'static> {
-    let set = mutref_from_ptr!(ptr);
+    let set = ref_from_ptr!(ptr);
     to_raw_ptr(set.stream())
 }
 make_free_fn!(fst_set_stream_free, *mut set::Stream);
 set_make_next_fn!(fst_set_stream_next, *mut set::Stream);
+set_make_batch_fn!(fst_set_stream_batch, *mut set::Stream);
+make_count_fn!(fst_set_stream_count, *mut set::Stream);
 
 #[no_mangle]
 pub extern "C" fn fst_set_len(ptr: *mut Set) -> libc::size_t {
-    let set = mutref_from_ptr!(ptr);
+    let set = ref_from_ptr!(ptr);
     set.len()
 }
 
@@ -121,22 +289,45 @@ pub extern "C" fn fst_set_issuperset(self_ptr: *mut Set, oth_ptr: *mut Set) -> b
 pub extern "C" fn fst_set_levsearch(set_ptr: *mut Set,
                                     lev_ptr: *mut Levenshtein)
                                     -> *mut SetLevStream {
-    let set = mutref_from_ptr!(set_ptr);
+    let set = ref_from_ptr!(set_ptr);
     let lev = ref_from_ptr!(lev_ptr);
     to_raw_ptr(set.search(lev).into_stream())
 }
 make_free_fn!(fst_set_levstream_free, *mut SetLevStream);
 set_make_next_fn!(fst_set_levstream_next, *mut SetLevStream);
+set_make_batch_fn!(fst_set_levstream_batch, *mut SetLevStream);
+make_count_fn!(fst_set_levstream_count, *mut SetLevStream);
+
+/// Search with a Levenshtein automaton and return the `k` best matches with their edit distance
+/// to `term`, ranked by distance and then by key
+#[no_mangle]
+pub extern "C" fn fst_set_levsearch_ranked(set_ptr: *mut Set,
+                                           lev_ptr: *mut Levenshtein,
+                                           c_term: *mut libc::c_char,
+                                           k: libc::size_t)
+                                           -> *mut StreamBatch {
+    let set = ref_from_ptr!(set_ptr);
+    let lev = ref_from_ptr!(lev_ptr);
+    let term: Vec<char> = cstr_to_str(c_term).chars().collect();
+    let mut top = TopK::new(k);
+    let mut stream = set.search(lev).into_stream();
+    while let Some(key) = stream.next() {
+        top.push(key, 0, levenshtein_distance(&term, key));
+    }
+    top.finish(false)
+}
 
 #[no_mangle]
 pub extern "C" fn fst_set_regexsearch(set_ptr: *mut Set, regex_ptr: *mut Regex)
                                       -> *mut SetRegexStream {
-    let set = mutref_from_ptr!(set_ptr);
+    let set = ref_from_ptr!(set_ptr);
     let regex = ref_from_ptr!(regex_ptr);
     to_raw_ptr(set.search(regex).into_stream())
 }
 make_free_fn!(fst_set_regexstream_free, *mut SetRegexStream);
 set_make_next_fn!(fst_set_regexstream_next, *mut SetRegexStream);
+set_make_batch_fn!(fst_set_regexstream_batch, *mut SetRegexStream);
+make_count_fn!(fst_set_regexstream_count, *mut SetRegexStream);
 
 #[no_mangle]
 pub extern "C" fn fst_set_make_opbuilder(ptr: *mut Set) -> *mut set::OpBuilder<'static> {
@@ -161,6 +352,9 @@ pub extern "C" fn fst_set_opbuilder_union(ptr: *mut set::OpBuilder)
 }
 make_free_fn!(fst_set_union_free, *mut set::Union);
 set_make_next_fn!(fst_set_union_next, *mut set::Union);
+set_make_batch_fn!(fst_set_union_batch, *mut set::Union);
+make_count_fn!(fst_set_union_count, *mut set::Union);
+set_make_into_fn!(fst_set_union_into, *mut set::Union);
 
 #[no_mangle]
 pub extern "C" fn fst_set_opbuilder_intersection(ptr: *mut set::OpBuilder)
@@ -170,6 +364,9 @@ pub extern "C" fn fst_set_opbuilder_intersection(ptr: *mut set::OpBuilder)
 }
 make_free_fn!(fst_set_intersection_free, *mut set::Intersection);
 set_make_next_fn!(fst_set_intersection_next, *mut set::Intersection);
+set_make_batch_fn!(fst_set_intersection_batch, *mut set::Intersection);
+make_count_fn!(fst_set_intersection_count, *mut set::Intersection);
+set_make_into_fn!(fst_set_intersection_into, *mut set::Intersection);
 
 #[no_mangle]
 pub extern "C" fn fst_set_opbuilder_difference(ptr: *mut set::OpBuilder)
@@ -179,6 +376,9 @@ pub extern "C" fn fst_set_opbuilder_difference(ptr: *mut set::OpBuilder)
 }
 make_free_fn!(fst_set_difference_free, *mut set::Difference);
 set_make_next_fn!(fst_set_difference_next, *mut set::Difference);
+set_make_batch_fn!(fst_set_difference_batch, *mut set::Difference);
+make_count_fn!(fst_set_difference_count, *mut set::Difference);
+set_make_into_fn!(fst_set_difference_into, *mut set::Difference);
 
 #[no_mangle]
 pub extern "C" fn fst_set_opbuilder_symmetricdifference
@@ -189,6 +389,9 @@ pub extern "C" fn fst_set_opbuilder_symmetricdifference
 }
 make_free_fn!(fst_set_symmetricdifference_free, *mut set::SymmetricDifference);
 set_make_next_fn!(fst_set_symmetricdifference_next, *mut set::SymmetricDifference);
+set_make_batch_fn!(fst_set_symmetricdifference_batch, *mut set::SymmetricDifference);
+make_count_fn!(fst_set_symmetricdifference_count, *mut set::SymmetricDifference);
+set_make_into_fn!(fst_set_symmetricdifference_into, *mut set::SymmetricDifference);
 
 
 #[no_mangle]
@@ -199,18 +402,35 @@ pub extern "C" fn fst_set_streambuilder_new(ptr: *mut Set) -> *mut set::StreamBu
 
 #[no_mangle]
 pub extern "C" fn fst_set_streambuilder_add_ge(ptr: *mut set::StreamBuilder<'static>,
-                                               c_bound: *mut libc::c_char)
+                                               c_bound: *const libc::c_char,
+                                               bound_len: libc::size_t)
                                                -> *mut set::StreamBuilder<'static> {
     let sb = val_from_ptr!(ptr);
-    to_raw_ptr(sb.ge(cstr_to_str(c_bound)))
+    to_raw_ptr(sb.ge(bytes_from_ptr(c_bound, bound_len)))
 }
 
 #[no_mangle]
 pub extern "C" fn fst_set_streambuilder_add_lt(ptr: *mut set::StreamBuilder<'static>,
-                                               c_bound: *mut libc::c_char)
+                                               c_bound: *const libc::c_char,
+                                               bound_len: libc::size_t)
                                                -> *mut set::StreamBuilder<'static> {
     let sb = val_from_ptr!(ptr);
-    to_raw_ptr(sb.lt(cstr_to_str(c_bound)))
+    to_raw_ptr(sb.lt(bytes_from_ptr(c_bound, bound_len)))
+}
+
+/// Restrict a range to the keys that start with a prefix
+#[no_mangle]
+pub extern "C" fn fst_set_streambuilder_add_prefix(ptr: *mut set::StreamBuilder<'static>,
+                                                   c_prefix: *const libc::c_char,
+                                                   prefix_len: libc::size_t)
+                                                   -> *mut set::StreamBuilder<'static> {
+    let sb = val_from_ptr!(ptr);
+    let prefix = bytes_from_ptr(c_prefix, prefix_len);
+    let sb = sb.ge(prefix);
+    to_raw_ptr(match prefix_successor(prefix) {
+        Some(succ) => sb.lt(succ),
+        None => sb,
+    })
 }
 
 #[no_mangle]
@@ -1,74 +1,437 @@
 extern crate libc;
+extern crate fst;
 extern crate fst_levenshtein;
 extern crate fst_regex;
 
 
-use std::error::Error;
+use std::cmp::{self, Reverse};
+use std::collections::{BinaryHeap, HashSet};
 use std::ffi::{CStr, CString};
+use std::fmt;
 use std::fs::File;
-use std::intrinsics;
 use std::io;
+use std::io::{BufRead, Read, Seek};
+use std::mem;
 use std::ptr;
+use std::slice;
+use fst::Automaton;
 use fst_regex::Regex;
 use fst_levenshtein::Levenshtein;
 
 
+/// Kinds of errors that are reported over the ABI
+///
+/// The values must be kept in sync with the `ERROR_*` constants in `rust_fst/lib.py`, which maps
+/// them to Python exceptions.
+#[derive(Clone, Copy, Debug, PartialEq)]
+pub enum ErrorKind {
+    Io = 1,
+    Transducer = 2,
+    FstIo = 3,
+    Regex = 4,
+    Levenshtein = 5,
+    Value = 6,
+}
+
+/// Errors that can be reported over the ABI
+pub trait AbiError: fmt::Display {
+    fn error_kind(&self) -> ErrorKind;
+}
+
+impl AbiError for io::Error {
+    fn error_kind(&self) -> ErrorKind {
+        ErrorKind::Io
+    }
+}
+
+impl AbiError for fst::Error {
+    fn error_kind(&self) -> ErrorKind {
+        match *self {
+            fst::Error::Fst(_) => ErrorKind::Transducer,
+            fst::Error::Io(_) => ErrorKind::FstIo,
+        }
+    }
+}
+
+impl AbiError for fst_regex::Error {
+    fn error_kind(&self) -> ErrorKind {
+        ErrorKind::Regex
+    }
+}
+
+impl AbiError for fst_levenshtein::Error {
+    fn error_kind(&self) -> ErrorKind {
+        ErrorKind::Levenshtein
+    }
+}
+
 /// Exposes information about errors over the ABI
+///
+/// `error_kind` is 0 as long as no error occurred. Successful calls never touch the context, so
+/// the caller has to reset `error_kind` after handling an error. The message is only formatted
+/// when an error occurs and is owned by the context.
 #[repr(C)]
 pub struct Context {
-    pub has_error: bool,
-    pub error_type: *mut libc::c_char,
-    pub error_debug: *mut libc::c_char,
-    pub error_display: *mut libc::c_char,
-    pub error_description: *mut libc::c_char,
+    pub error_kind: u32,
+    pub error_msg: *mut libc::c_char,
 }
 
 impl Context {
+    pub fn set_error(&mut self, kind: ErrorKind, msg: &str) {
+        self.clear();
+        self.error_kind = kind as u32;
+        self.error_msg = str_to_cstr(&msg.replace('\0', "\\0"));
+    }
+
     pub fn clear(&mut self) {
-        self.has_error = false;
-        if !self.error_type.is_null() {
-            fst_string_free(self.error_type);
-        }
-        if !self.error_debug.is_null() {
-            fst_string_free(self.error_debug);
-        }
-        if !self.error_display.is_null() {
-            fst_string_free(self.error_display);
-        }
-        if !self.error_description.is_null() {
-            fst_string_free(self.error_description);
+        self.error_kind = 0;
+        if !self.error_msg.is_null() {
+            fst_string_free(self.error_msg);
+            self.error_msg = ptr::null_mut();
         }
     }
 }
 
+impl Drop for Context {
+    fn drop(&mut self) {
+        self.clear();
+    }
+}
+
+/// Store an error in the context behind a raw pointer
+pub fn set_error(ctx_ptr: *mut Context, kind: ErrorKind, msg: &str) {
+    mutref_from_ptr!(ctx_ptr).set_error(kind, msg);
+}
+
 
 pub fn cstr_to_str<'a>(s: *mut libc::c_char) -> &'a str {
     let cstr = unsafe { CStr::from_ptr(s) };
     cstr.to_str().unwrap()
 }
 
+/// Get a byte slice from a raw pointer and an explicit length
+pub fn bytes_from_ptr<'a>(s: *const libc::c_char, len: libc::size_t) -> &'a [u8] {
+    if len == 0 {
+        return &[];
+    }
+    assert!(!s.is_null());
+    unsafe { slice::from_raw_parts(s as *const u8, len) }
+}
+
 pub fn str_to_cstr(string: &str) -> *mut libc::c_char {
     CString::new(string).unwrap().into_raw()
 }
 
-pub fn to_raw_ptr<T>(v: T) -> *mut T {
-    Box::into_raw(Box::new(v))
+/// Iterator over keys that were packed into a contiguous buffer, delimited
+/// by an array of `num_keys + 1` offsets.
+pub struct PackedKeys<'a> {
+    buf: &'a [u8],
+    offsets: &'a [libc::size_t],
+    idx: usize,
+}
+
+impl<'a> Iterator for PackedKeys<'a> {
+    type Item = &'a [u8];
+
+    fn next(&mut self) -> Option<&'a [u8]> {
+        if self.idx + 1 >= self.offsets.len() {
+            return None;
+        }
+        let key = &self.buf[self.offsets[self.idx]..self.offsets[self.idx + 1]];
+        self.idx += 1;
+        Some(key)
+    }
+}
+
+pub fn packed_keys<'a>(buf: *const libc::c_char,
+                       offsets: *const libc::size_t,
+                       num_keys: libc::size_t)
+                       -> PackedKeys<'a> {
+    assert!(!offsets.is_null());
+    let offsets = unsafe { slice::from_raw_parts(offsets, num_keys + 1) };
+    PackedKeys { buf: bytes_from_ptr(buf, offsets[num_keys]), offsets: offsets, idx: 0 }
+}
+
+/// Size of the read buffer for ingesting text files
+pub const READ_BUFFER_SIZE: usize = 1 << 20;
+
+/// Reader over the lines of a text file with the line terminators (`\n` or `\r\n`) stripped
+pub struct LineReader {
+    rdr: io::BufReader<File>,
+    buf: Vec<u8>,
+    line_no: usize,
+}
+
+impl LineReader {
+    pub fn open(path: &str) -> io::Result<LineReader> {
+        let file = File::open(path)?;
+        Ok(LineReader {
+            rdr: io::BufReader::with_capacity(READ_BUFFER_SIZE, file),
+            buf: Vec::new(),
+            line_no: 0,
+        })
+    }
+
+    /// Read the next line, returning its 1-based line number and contents
+    ///
+    /// The contents point into a buffer owned by the reader, i.e. they are only valid until the
+    /// next call.
+    pub fn next_line(&mut self) -> io::Result<Option<(usize, &[u8])>> {
+        self.buf.clear();
+        if self.rdr.read_until(b'\n', &mut self.buf)? == 0 {
+            return Ok(None);
+        }
+        self.line_no += 1;
+        let mut end = self.buf.len();
+        if end > 0 && self.buf[end - 1] == b'\n' {
+            end -= 1;
+            if end > 0 && self.buf[end - 1] == b'\r' {
+                end -= 1;
+            }
+        }
+        Ok(Some((self.line_no, &self.buf[..end])))
+    }
+}
+
+/// Reader over a byte range of a run file, as written by `rust_fst/extsort.py`
+///
+/// Every record consists of the length of its key as a little-endian `u32`, the key and, if the
+/// records have values, the value as a little-endian `u64`.
+pub struct RecordReader {
+    rdr: io::Take<io::BufReader<File>>,
+    key: Vec<u8>,
+    with_values: bool,
+}
+
+impl RecordReader {
+    pub fn open(path: &str, start: u64, end: u64, with_values: bool) -> io::Result<RecordReader> {
+        let mut file = File::open(path)?;
+        file.seek(io::SeekFrom::Start(start))?;
+        let rdr = io::BufReader::with_capacity(READ_BUFFER_SIZE, file);
+        Ok(RecordReader {
+            rdr: rdr.take(end.saturating_sub(start)),
+            key: Vec::new(),
+            with_values: with_values,
+        })
+    }
+
+    /// Read the next record, returning its key and its value, which is zero for records without
+    /// values
+    ///
+    /// The key points into a buffer owned by the reader, i.e. it is only valid until the next
+    /// call. A record that is cut off by the end of the range or file is an error.
+    pub fn next_record(&mut self) -> io::Result<Option<(&[u8], u64)>> {
+        if self.rdr.limit() == 0 {
+            return Ok(None);
+        }
+        let mut len_buf = [0; 4];
+        self.rdr.read_exact(&mut len_buf)?;
+        self.key.resize(u32::from_le_bytes(len_buf) as usize, 0);
+        self.rdr.read_exact(&mut self.key)?;
+        let mut value = 0;
+        if self.with_values {
+            let mut value_buf = [0; 8];
+            self.rdr.read_exact(&mut value_buf)?;
+            value = u64::from_le_bytes(value_buf);
+        }
+        Ok(Some((&self.key, value)))
+    }
+}
+
+/// Find the position of the last occurrence of `needle` in `haystack`
+pub fn rfind(haystack: &[u8], needle: &[u8]) -> Option<usize> {
+    if needle.is_empty() || needle.len() > haystack.len() {
+        return None;
+    }
+    (0..haystack.len() - needle.len() + 1).rev()
+        .find(|&idx| &haystack[idx..idx + needle.len()] == needle)
+}
+
+/// Get the smallest byte string that is greater than every string starting with `prefix`
+///
+/// Returns `None` if there is no such string, i.e. if the prefix is empty or consists only of
+/// `0xff` bytes.
+pub fn prefix_successor(prefix: &[u8]) -> Option<Vec<u8>> {
+    let mut succ = prefix.to_vec();
+    while let Some(last) = succ.pop() {
+        if last < 0xff {
+            succ.push(last + 1);
+            return Some(succ);
+        }
+    }
+    None
 }
 
-// FIXME: This requires the nightly channel, isn't there a better way to
-//        get this information?
-pub fn get_typename<T>(_: &T) -> &'static str {
-    unsafe { intrinsics::type_name::<T>() }
+/// Hand a byte vector over to the caller, who has to free it with `fst_bytes_free`
+pub fn vec_to_raw(data: Vec<u8>, len: *mut libc::size_t) -> *mut libc::c_char {
+    let mut boxed = data.into_boxed_slice();
+    unsafe { *len = boxed.len() };
+    let data_ptr = boxed.as_mut_ptr() as *mut libc::c_char;
+    mem::forget(boxed);
+    data_ptr
+}
+
+/// Hand a vector over to the caller as a pointer to its first element
+pub fn slice_to_raw<T>(data: Vec<T>) -> *mut T {
+    let mut boxed = data.into_boxed_slice();
+    let data_ptr = boxed.as_mut_ptr();
+    mem::forget(boxed);
+    data_ptr
+}
+
+/// Items copied out of a stream in a single call
+///
+/// The keys are concatenated in `keys`, where the key of the n-th item spans
+/// `offsets[n]..offsets[n + 1]`. `values` is null for streams without values and `distances` is
+/// null unless the batch holds ranked search results.
+#[repr(C)]
+pub struct StreamBatch {
+    num_items: libc::size_t,
+    keys: *mut libc::c_char,
+    offsets: *mut libc::size_t,
+    values: *mut u64,
+    distances: *mut u32,
+}
+
+/// Collects the items of a stream into a `StreamBatch`
+pub struct BatchBuilder {
+    keys: Vec<u8>,
+    offsets: Vec<usize>,
+    values: Option<Vec<u64>>,
+    distances: Option<Vec<u32>>,
+}
+
+impl BatchBuilder {
+    pub fn new(with_values: bool) -> Self {
+        BatchBuilder {
+            keys: Vec::new(),
+            offsets: vec![0],
+            values: if with_values { Some(Vec::new()) } else { None },
+            distances: None,
+        }
+    }
+
+    /// Also collect an edit distance for every item
+    pub fn with_distances(mut self) -> Self {
+        self.distances = Some(Vec::new());
+        self
+    }
+
+    pub fn len(&self) -> usize {
+        self.offsets.len() - 1
+    }
+
+    pub fn push_key(&mut self, key: &[u8]) {
+        self.keys.extend_from_slice(key);
+        self.offsets.push(self.keys.len());
+    }
+
+    pub fn push_item(&mut self, key: &[u8], value: u64) {
+        self.push_key(key);
+        if let Some(ref mut values) = self.values {
+            values.push(value);
+        }
+    }
+
+    pub fn push_distance(&mut self, distance: u32) {
+        if let Some(ref mut distances) = self.distances {
+            distances.push(distance);
+        }
+    }
+
+    /// Hand the batch over to the caller, who has to free it with `fst_streambatch_free`
+    pub fn finish(self) -> *mut StreamBatch {
+        to_raw_ptr(StreamBatch {
+            num_items: self.len(),
+            keys: slice_to_raw(self.keys) as *mut libc::c_char,
+            offsets: slice_to_raw(self.offsets),
+            values: self.values.map_or(ptr::null_mut(), slice_to_raw),
+            distances: self.distances.map_or(ptr::null_mut(), slice_to_raw),
+        })
+    }
+}
+
+#[no_mangle]
+pub extern "C" fn fst_streambatch_free(ptr: *mut StreamBatch) {
+    let batch = val_from_ptr!(ptr);
+    unsafe {
+        let keys_len = *batch.offsets.offset(batch.num_items as isize);
+        Box::from_raw(slice::from_raw_parts_mut(batch.keys, keys_len));
+        Box::from_raw(slice::from_raw_parts_mut(batch.offsets, batch.num_items + 1));
+        if !batch.values.is_null() {
+            Box::from_raw(slice::from_raw_parts_mut(batch.values, batch.num_items));
+        }
+        if !batch.distances.is_null() {
+            Box::from_raw(slice::from_raw_parts_mut(batch.distances, batch.num_items));
+        }
+    }
+}
+
+/// Compute the Levenshtein distance between a term and a key
+///
+/// Like the Levenshtein automaton, this counts edits of Unicode scalar values, not of bytes.
+pub fn levenshtein_distance(term: &[char], key: &[u8]) -> u32 {
+    let mut prev: Vec<u32> = (0..term.len() as u32 + 1).collect();
+    let mut cur = vec![0; term.len() + 1];
+    for (i, key_char) in String::from_utf8_lossy(key).chars().enumerate() {
+        cur[0] = i as u32 + 1;
+        for (j, &term_char) in term.iter().enumerate() {
+            let substitution = prev[j] + if term_char == key_char { 0 } else { 1 };
+            cur[j + 1] = cmp::min(substitution, cmp::min(prev[j + 1], cur[j]) + 1);
+        }
+        mem::swap(&mut prev, &mut cur);
+    }
+    prev[term.len()]
+}
+
+/// Keeps the `k` best search results, ranked by edit distance, then by descending value and
+/// finally by key
+pub struct TopK {
+    k: usize,
+    heap: BinaryHeap<(u32, Reverse<u64>, Vec<u8>)>,
+}
+
+impl TopK {
+    pub fn new(k: usize) -> Self {
+        TopK { k: k, heap: BinaryHeap::new() }
+    }
+
+    pub fn push(&mut self, key: &[u8], value: u64, distance: u32) {
+        if self.k == 0 {
+            return;
+        }
+        if self.heap.len() == self.k {
+            {
+                let worst = self.heap.peek().unwrap();
+                if (distance, Reverse(value), key) >= (worst.0, worst.1, &worst.2[..]) {
+                    return;
+                }
+            }
+            self.heap.pop();
+        }
+        self.heap.push((distance, Reverse(value), key.to_vec()));
+    }
+
+    /// Hand the results over to the caller in rank order, see `BatchBuilder::finish`
+    pub fn finish(self, with_values: bool) -> *mut StreamBatch {
+        let mut batch = BatchBuilder::new(with_values).with_distances();
+        for (distance, Reverse(value), key) in self.heap.into_sorted_vec() {
+            batch.push_item(&key, value);
+            batch.push_distance(distance);
+        }
+        batch.finish()
+    }
+}
+
+pub fn to_raw_ptr<T>(v: T) -> *mut T {
+    Box::into_raw(Box::new(v))
 }
 
 #[no_mangle]
 pub extern "C" fn fst_context_new() -> *mut Context {
     to_raw_ptr(Context {
-        has_error: false,
-        error_type: ptr::null_mut(),
-        error_description: ptr::null_mut(),
-        error_display: ptr::null_mut(),
-        error_debug: ptr::null_mut(),
+        error_kind: 0,
+        error_msg: ptr::null_mut(),
     })
 }
 make_free_fn!(fst_context_free, *mut Context);
@@ -78,6 +441,12 @@ pub extern "C" fn fst_string_free(s: *mut libc::c_char) {
     unsafe { CString::from_raw(s) };
 }
 
+#[no_mangle]
+pub extern "C" fn fst_bytes_free(data: *mut libc::c_char, len: libc::size_t) {
+    assert!(!data.is_null());
+    unsafe { Box::from_raw(slice::from_raw_parts_mut(data as *mut u8, len)) };
+}
+
 #[no_mangle]
 pub extern "C" fn fst_bufwriter_new(ctx: *mut Context,
                                     s: *mut libc::c_char)
@@ -101,6 +470,11 @@ pub extern "C" fn fst_levenshtein_new(ctx: *mut Context,
 }
 make_free_fn!(fst_levenshtein_free, *mut Levenshtein);
 
+#[no_mangle]
+pub extern "C" fn fst_levenshtein_heapsize(ptr: *mut Levenshtein) -> libc::size_t {
+    dfa_heap_size(ref_from_ptr!(ptr))
+}
+
 #[no_mangle]
 pub extern "C" fn fst_regex_new(ctx: *mut Context, c_pat: *mut libc::c_char) -> *mut Regex {
     let pat = cstr_to_str(c_pat);
@@ -108,3 +482,28 @@ pub extern "C" fn fst_regex_new(ctx: *mut Context, c_pat: *mut libc::c_char) ->
     to_raw_ptr(re)
 }
 make_free_fn!(fst_regex_free, *mut Regex);
+
+#[no_mangle]
+pub extern "C" fn fst_regex_heapsize(ptr: *mut Regex) -> libc::size_t {
+    dfa_heap_size(ref_from_ptr!(ptr))
+}
+
+/// Estimate the memory used by a compiled DFA by counting its reachable states.
+///
+/// Both the Levenshtein and the regex automata store a transition table with one entry per
+/// input byte for every state, which dominates their size.
+fn dfa_heap_size<A: Automaton<State = Option<usize>>>(aut: &A) -> usize {
+    let mut seen = HashSet::new();
+    let mut stack: Vec<usize> = aut.start().into_iter().collect();
+    seen.extend(stack.iter().cloned());
+    while let Some(state) = stack.pop() {
+        for byte in 0..256u16 {
+            if let Some(next) = aut.accept(&Some(state), byte as u8) {
+                if seen.insert(next) {
+                    stack.push(next);
+                }
+            }
+        }
+    }
+    seen.len() * 256 * mem::size_of::<Option<usize>>()
+}
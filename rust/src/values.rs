@@ -0,0 +1,180 @@
+extern crate libc;
+
+use std::cmp;
+use std::slice;
+use fst::{Automaton, Streamer};
+use fst::map::{self, IndexedValue};
+
+use util::slice_to_raw;
+
+
+/// A stream of map items or values whose values can be reduced natively
+pub trait ValueStream {
+    fn next_value(&mut self) -> Option<u64>;
+}
+
+impl<'m, A: Automaton> ValueStream for map::Stream<'m, A> {
+    fn next_value(&mut self) -> Option<u64> {
+        self.next().map(|(_, value)| value)
+    }
+}
+
+impl<'m> ValueStream for map::Values<'m> {
+    fn next_value(&mut self) -> Option<u64> {
+        self.next()
+    }
+}
+
+/// Combines the values of a key in the maps of a set operation into a single value
+#[derive(Clone, Copy)]
+pub enum Reducer {
+    /// Sum of the values, saturating at the largest `u64`
+    Sum,
+    Min,
+    Max,
+    /// Value of the map with the lowest index
+    First,
+    /// Value of the map with the highest index
+    Last,
+    /// Number of maps that contain the key
+    Count,
+}
+
+impl Reducer {
+    /// Get a reducer from its code, which is its position in the declaration
+    pub fn from_code(code: u32) -> Self {
+        match code {
+            0 => Reducer::Sum,
+            1 => Reducer::Min,
+            2 => Reducer::Max,
+            3 => Reducer::First,
+            4 => Reducer::Last,
+            5 => Reducer::Count,
+            _ => panic!("Invalid reducer code: {}", code),
+        }
+    }
+
+    /// Combine the values of a key, of which set operations always yield at least one
+    pub fn reduce(self, values: &[IndexedValue]) -> u64 {
+        let mut iter = values.iter();
+        match self {
+            Reducer::Sum => iter.fold(0, |sum: u64, iv| sum.saturating_add(iv.value)),
+            Reducer::Min => iter.map(|iv| iv.value).min().unwrap_or(0),
+            Reducer::Max => iter.map(|iv| iv.value).max().unwrap_or(0),
+            Reducer::First => iter.min_by_key(|iv| iv.index).map_or(0, |iv| iv.value),
+            Reducer::Last => iter.max_by_key(|iv| iv.index).map_or(0, |iv| iv.value),
+            Reducer::Count => values.len() as u64,
+        }
+    }
+}
+
+/// A map set operation stream whose values are combined into a single value per key
+///
+/// This turns any of the operation streams into a regular map stream, so that batches, value
+/// reductions etc. work without copying out the values of the individual maps.
+pub struct ReducedStream {
+    stream: Box<for<'a> Streamer<'a, Item = (&'a [u8], &'a [IndexedValue])>>,
+    reducer: Reducer,
+}
+
+impl ReducedStream {
+    pub fn new<S>(stream: Box<S>, reducer: Reducer) -> Self
+        where S: for<'a> Streamer<'a, Item = (&'a [u8], &'a [IndexedValue])> + 'static
+    {
+        ReducedStream { stream: stream, reducer: reducer }
+    }
+}
+
+impl<'a> Streamer<'a> for ReducedStream {
+    type Item = (&'a [u8], u64);
+
+    fn next(&'a mut self) -> Option<Self::Item> {
+        let reducer = self.reducer;
+        self.stream.next().map(|(key, values)| (key, reducer.reduce(values)))
+    }
+}
+
+impl ValueStream for ReducedStream {
+    fn next_value(&mut self) -> Option<u64> {
+        self.next().map(|(_, value)| value)
+    }
+}
+
+/// Count, sum, minimum and maximum of the values of a stream
+///
+/// The sum is exact, its lower and upper 64 bits are stored separately since C has no portable
+/// 128 bit integer type. `min` and `max` are zero if there are no values.
+#[repr(C)]
+pub struct ValueStats {
+    count: u64,
+    sum_low: u64,
+    sum_high: u64,
+    min: u64,
+    max: u64,
+}
+
+/// Copy the remaining values of a stream into an array, which the caller has to free with
+/// `fst_values_free`
+pub fn collect_values<S: ValueStream>(stream: &mut S, len: *mut libc::size_t) -> *mut u64 {
+    let mut values = Vec::new();
+    while let Some(value) = stream.next_value() {
+        values.push(value);
+    }
+    unsafe { *len = values.len() };
+    slice_to_raw(values)
+}
+
+pub fn value_stats<S: ValueStream>(stream: &mut S) -> ValueStats {
+    let mut count = 0;
+    let mut sum: u128 = 0;
+    let mut min = u64::max_value();
+    let mut max = 0;
+    while let Some(value) = stream.next_value() {
+        count += 1;
+        sum += value as u128;
+        min = cmp::min(min, value);
+        max = cmp::max(max, value);
+    }
+    ValueStats {
+        count: count,
+        sum_low: sum as u64,
+        sum_high: (sum >> 64) as u64,
+        min: if count > 0 { min } else { 0 },
+        max: max,
+    }
+}
+
+/// Count the remaining values of a stream per bucket
+///
+/// `bins` are the strictly increasing edges of the buckets, bucket `i` holds the values in
+/// `bins[i]..bins[i + 1]` and the last bucket also the values equal to its upper edge. Values
+/// outside of all buckets are not counted.
+pub fn value_histogram<S: ValueStream>(stream: &mut S, bins: &[u64], counts: &mut [u64]) {
+    let last = bins.len() - 1;
+    while let Some(value) = stream.next_value() {
+        let bucket = match bins.binary_search(&value) {
+            Ok(idx) if idx < last => idx,
+            Ok(_) => last - 1,
+            Err(idx) if idx > 0 && idx <= last => idx - 1,
+            Err(_) => continue,
+        };
+        counts[bucket] += 1;
+    }
+}
+
+/// Wrap the arguments of a histogram function into slices
+pub fn histogram_args<'a>(bins: *const u64,
+                          num_bins: libc::size_t,
+                          counts: *mut u64)
+                          -> (&'a [u64], &'a mut [u64]) {
+    assert!(num_bins >= 2);
+    unsafe {
+        (slice::from_raw_parts(bins, num_bins), slice::from_raw_parts_mut(counts, num_bins - 1))
+    }
+}
+
+#[no_mangle]
+pub extern "C" fn fst_values_free(values: *mut u64, len: libc::size_t) {
+    assert!(!values.is_null());
+    unsafe { Box::from_raw(slice::from_raw_parts_mut(values, len)) };
+}
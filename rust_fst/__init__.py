@@ -1,4 +1,9 @@
+from .automaton import AutomatonCache, Levenshtein, Regex
 from .set import Set
 from .map import Map
+from .query import Query
+from .sharded import ShardedSet, ShardedMap
+from .mutable import MutableSet, MutableMap
 
-__all__ = ["Set", "Map"]
+__all__ = ["Set", "Map", "ShardedSet", "ShardedMap", "MutableSet",
+           "MutableMap", "Levenshtein", "Regex", "AutomatonCache", "Query"]
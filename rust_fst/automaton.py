@@ -0,0 +1,203 @@
+""" Reusable compiled automata for searching sets and maps.
+
+Compiling a Levenshtein or regular expression automaton is usually far more
+expensive than running it over an FST. The automata in this module are
+compiled once and can then be used for any number of searches on any number
+of sets and maps, including from multiple threads.
+
+Searches that are passed a plain term or pattern look up the compiled
+automaton in :py:data:`cache`, a bounded LRU cache shared by all sets and
+maps.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+from .lib import ffi, lib, checked_call
+
+#: Default maximum number of automata kept in the cache
+DEFAULT_MAX_ENTRIES = 128
+
+#: Marks limits that :py:meth:`AutomatonCache.configure` should not change
+_UNCHANGED = object()
+
+CacheInfo = namedtuple("CacheInfo", ("hits", "misses", "entries", "memory",
+                                     "max_entries", "max_memory"))
+
+
+class Automaton(object):
+    """ Base class for compiled automata. """
+    def __init__(self, ptr, free_fn, heapsize_fn):
+        self._ptr = ffi.gc(ptr, free_fn)
+        self._heapsize_fn = heapsize_fn
+        self._memory = None
+
+    @property
+    def memory(self):
+        """ Approximate size of the compiled automaton in bytes. """
+        if self._memory is None:
+            self._memory = self._heapsize_fn(self._ptr)
+        return self._memory
+
+
+class Levenshtein(Automaton):
+    """ A compiled automaton that matches all keys within a maximum
+        Levenshtein edit distance of a term.
+
+    Pass it to :py:meth:`rust_fst.Set.search` or
+    :py:meth:`rust_fst.Map.search` instead of a term and a distance.
+
+    :param term:        The search term
+    :param max_dist:    The maximum edit distance for matches
+    :raises LevenshteinError: If the automaton has too many states
+    """
+    def __init__(self, term, max_dist):
+        ptr = checked_call(lib.fst_levenshtein_new,
+                           ffi.new("char[]", term.encode('utf8')), max_dist)
+        super(Levenshtein, self).__init__(ptr, lib.fst_levenshtein_free,
+                                          lib.fst_levenshtein_heapsize)
+        self.term = term
+        self.max_dist = max_dist
+
+    def __repr__(self):
+        return "Levenshtein({!r}, {!r})".format(self.term, self.max_dist)
+
+
+class Regex(Automaton):
+    """ A compiled regular expression automaton.
+
+    Pass it to :py:meth:`rust_fst.Set.search_re` or
+    :py:meth:`rust_fst.Map.search_re` instead of a pattern. See
+    :py:meth:`rust_fst.Set.search_re` for the supported syntax.
+
+    :param pattern:     A regular expression
+    :raises RegexError: If the pattern is invalid or not supported
+    """
+    def __init__(self, pattern):
+        ptr = checked_call(lib.fst_regex_new,
+                           ffi.new("char[]", pattern.encode('utf8')))
+        super(Regex, self).__init__(ptr, lib.fst_regex_free,
+                                    lib.fst_regex_heapsize)
+        self.pattern = pattern
+
+    def __repr__(self):
+        return "Regex({!r})".format(self.pattern)
+
+
+class AutomatonCache(object):
+    """ A thread-safe LRU cache of compiled automata.
+
+    The least recently used automata are evicted when either limit is
+    exceeded. Automata that fail to compile are not cached.
+
+    :param max_entries: Maximum number of cached automata, `None` for no
+                        limit. `0` disables the cache.
+    :param max_memory:  Maximum approximate memory of all cached automata in
+                        bytes, `None` for no limit
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_memory=None):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.configure(max_entries, max_memory)
+
+    def configure(self, max_entries=_UNCHANGED, max_memory=_UNCHANGED):
+        """ Change the limits of the cache, evicting automata as needed.
+
+        Only the limits that are passed are changed. See
+        :py:class:`AutomatonCache` for a description of the parameters.
+        """
+        with self._lock:
+            if max_entries is not _UNCHANGED:
+                self.max_entries = max_entries
+            if max_memory is not _UNCHANGED:
+                self.max_memory = max_memory
+            self._evict()
+
+    def clear(self):
+        """ Remove all automata from the cache and reset the counters. """
+        with self._lock:
+            self._entries.clear()
+            self._memory = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """ Get the statistics and limits of the cache.
+
+        :rtype:     :py:class:`CacheInfo`
+        """
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, len(self._entries),
+                             self._memory, self.max_entries, self.max_memory)
+
+    def levenshtein(self, term, max_dist):
+        """ Get a compiled Levenshtein automaton from the cache, compiling it
+            on a miss.
+
+        :rtype:     :py:class:`Levenshtein`
+        """
+        return self._get(('levenshtein', term, max_dist),
+                         lambda: Levenshtein(term, max_dist))
+
+    def regex(self, pattern):
+        """ Get a compiled regular expression automaton from the cache,
+            compiling it on a miss.
+
+        :rtype:     :py:class:`Regex`
+        """
+        return self._get(('regex', pattern), lambda: Regex(pattern))
+
+    def _get(self, key, compile_fn):
+        with self._lock:
+            automaton = self._entries.pop(key, None)
+            if automaton is not None:
+                self._entries[key] = automaton
+                self.hits += 1
+                return automaton
+            self.misses += 1
+        # Compile without holding the lock, so that misses in other threads
+        # are not serialized
+        automaton = compile_fn()
+        memory = automaton.memory
+        with self._lock:
+            if key in self._entries:
+                # Another thread compiled the same automaton in the meantime
+                return self._entries[key]
+            self._entries[key] = automaton
+            self._memory += memory
+            self._evict()
+        return automaton
+
+    def _evict(self):
+        while self._entries and (
+                (self.max_entries is not None
+                 and len(self._entries) > self.max_entries) or
+                (self.max_memory is not None
+                 and self._memory > self.max_memory)):
+            _, automaton = self._entries.popitem(last=False)
+            self._memory -= automaton.memory
+
+
+#: Cache used by searches that are passed a term or pattern
+cache = AutomatonCache()
+
+
+def get_levenshtein(term, max_dist=None):
+    """ Resolve the arguments of a Levenshtein search to an automaton. """
+    if isinstance(term, Levenshtein):
+        if max_dist is not None:
+            raise ValueError("max_dist must not be passed with a compiled "
+                             "automaton")
+        return term
+    if max_dist is None:
+        raise ValueError("max_dist is required when searching for a term")
+    return cache.levenshtein(term, max_dist)
+
+
+def get_regex(pattern):
+    """ Resolve the argument of a regex search to an automaton. """
+    if isinstance(pattern, Regex):
+        return pattern
+    return cache.regex(pattern)
@@ -1,30 +1,532 @@
+import array
+import bisect
 from collections import namedtuple
+from itertools import islice
 
-from .lib import ffi, lib
+from .lib import ffi, lib, checked_call
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+#: Number of keys that are sent to the native library per call when building
+#: from an iterator
+BATCH_SIZE = 4096
+
+#: Default number of items that are fetched from the native library per call
+#: when iterating over a stream
+STREAM_BATCH_SIZE = 1024
+
+
+def _encode_utf8(val):
+    return val.encode('utf8')
+
+
+def _decode_utf8(val):
+    return val.decode('utf8')
+
+
+def _identity(val):
+    return val
+
+
+#: Functions to encode keys for and decode keys from the native library,
+#: by key type
+KEY_CODECS = {
+    'str': (_encode_utf8, _decode_utf8),
+    'bytes': (_identity, _identity),
+}
+
+
+def get_key_codec(keys):
+    """ Get the `(encode, decode)` functions for a key type.
+
+    :param keys:    Key type, either `'str'` for unicode keys or `'bytes'`
+                    for raw byte string keys
+    """
+    try:
+        return KEY_CODECS[keys]
+    except KeyError:
+        raise ValueError("Key type must be one of {}, not {!r}".format(
+            ", ".join(repr(k) for k in sorted(KEY_CODECS)), keys))
+
+
+def chunked(it, size):
+    """ Split an iterable into lists of at most `size` elements. """
+    it = iter(it)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def pack_keys(keys):
+    """ Pack a sequence of encoded keys into a contiguous buffer.
+
+    :returns:   A tuple of the buffer and an array of `len(keys) + 1` offsets
+                that delimit the individual keys in the buffer
+    """
+    offsets = [0] * (len(keys) + 1)
+    pos = 0
+    for idx, key in enumerate(keys, 1):
+        pos += len(key)
+        offsets[idx] = pos
+    return (ffi.from_buffer(b''.join(keys)),
+            ffi.new("size_t[]", offsets))
+
+
+def new_bool_array(size):
+    """ Create a zero-initialized array of booleans.
+
+    :returns:   A NumPy `bool` array if NumPy is installed, otherwise a
+                `bytearray` with one 0/1 byte per element
+    """
+    if np is not None:
+        return np.zeros(size, dtype=np.bool_)
+    return bytearray(size)
+
+
+#: Type code of unsigned 64 bit integers for `array.array`, Python 2 has no
+#: `'Q'` type code, but `'L'` is 64 bits wide on the supported platforms
+UINT64_TYPECODE = 'Q' if 'Q' in getattr(array, 'typecodes', '') else 'L'
+
+
+def new_uint64_array(size):
+    """ Create a zero-initialized array of unsigned 64 bit integers.
+
+    :returns:   A NumPy `uint64` array if NumPy is installed, otherwise an
+                `array.array`
+    """
+    if np is not None:
+        return np.zeros(size, dtype=np.uint64)
+    return array.array(UINT64_TYPECODE, [0]) * size
+
+
+#: Type code of signed 64 bit integers for `array.array`, see
+#: :py:data:`UINT64_TYPECODE`
+INT64_TYPECODE = 'q' if 'q' in getattr(array, 'typecodes', '') else 'l'
+
+#: Columnar contents of a set, map or query result. `data` holds the
+#: concatenated encoded keys, the key at position `i` is
+#: `data[offsets[i]:offsets[i + 1]]`. `values` is `None` for sets.
+Arrays = namedtuple("Arrays", ("offsets", "data", "values"))
+
+
+def _borrowed_buffer(owner, ptr, size):
+    """ Get a buffer over native memory that keeps `owner` alive for as
+        long as the buffer is referenced.
+    """
+    # The destructor does nothing, it only holds a reference to the owner
+    ptr = ffi.gc(ptr, lambda _, owner=owner: None)
+    return ffi.buffer(ptr, size)
+
+
+def batch_to_arrays(batch):
+    """ Convert a `StreamBatch` to :py:class:`Arrays`, taking ownership of
+        the batch.
+
+    With NumPy, the arrays share the memory of the batch, which is freed
+    once all of them are garbage collected. Otherwise the batch is copied to
+    `array.array` objects and a `bytes` object, and freed.
+    """
+    num_items = batch.num_items
+    with_values = batch.values != ffi.NULL
+    if np is None:
+        try:
+            offsets = array.array(INT64_TYPECODE,
+                                  ffi.unpack(batch.offsets, num_items + 1))
+            data = ffi.unpack(batch.keys, offsets[-1])
+            values = None
+            if with_values:
+                values = array.array(UINT64_TYPECODE,
+                                     ffi.unpack(batch.values, num_items))
+            return Arrays(offsets, data, values)
+        finally:
+            lib.fst_streambatch_free(batch)
+    owner = ffi.gc(batch, lib.fst_streambatch_free)
+    offsets = np.frombuffer(
+        _borrowed_buffer(owner, batch.offsets, 8 * (num_items + 1)),
+        dtype=np.int64)
+    data = np.frombuffer(
+        _borrowed_buffer(owner, batch.keys, int(offsets[-1])), dtype=np.uint8)
+    values = None
+    if with_values:
+        values = np.frombuffer(
+            _borrowed_buffer(owner, batch.values, 8 * num_items),
+            dtype=np.uint64)
+    return Arrays(offsets, data, values)
+
+
+def concat_arrays(head, tail):
+    """ Concatenate the columns of two :py:class:`Arrays`. """
+    offsets = head.offsets[:-1]
+    if np is None:
+        offsets.extend(off + head.offsets[-1] for off in tail.offsets)
+        data = head.data + tail.data
+        values = head.values
+        if values is not None:
+            values.extend(tail.values)
+        return Arrays(offsets, data, values)
+    values = None
+    if head.values is not None:
+        values = np.concatenate((head.values, tail.values))
+    return Arrays(np.concatenate((offsets, tail.offsets + head.offsets[-1])),
+                  np.concatenate((head.data, tail.data)), values)
+
+
+def make_arrays(keys, values=None):
+    """ Build :py:class:`Arrays` from a list of encoded keys and an optional
+        list of values.
+    """
+    offsets = [0]
+    for key in keys:
+        offsets.append(offsets[-1] + len(key))
+    data = b''.join(keys)
+    if np is None:
+        if values is not None:
+            values = array.array(UINT64_TYPECODE, values)
+        return Arrays(array.array(INT64_TYPECODE, offsets), data, values)
+    if values is not None:
+        values = np.array(values, dtype=np.uint64)
+    return Arrays(np.array(offsets, dtype=np.int64),
+                  np.frombuffer(data, dtype=np.uint8), values)
+
+
+#: Native functions that reduce the values of a map stream
+ValueFns = namedtuple("ValueFns", ("values", "stats", "histogram"))
+
+#: Number, exact sum, minimum and maximum of values, `min` and `max` are
+#: `None` if there are no values
+ValueStats = namedtuple("ValueStats", ("count", "sum", "min", "max"))
+
+
+def take_values(c_values, num_values, head=()):
+    """ Convert a native array of values into an array, taking ownership of
+        it.
+
+    With NumPy and without `head`, the returned array shares the native
+    memory, which is freed once the array is garbage collected.
+
+    :param head:    Values to put in front of the native values
+    :returns:       An array as returned by :py:func:`new_uint64_array`
+    """
+    if np is not None and not head:
+        def free(ptr):
+            lib.fst_values_free(ptr, num_values)
+        owner = ffi.gc(c_values, free)
+        return np.frombuffer(ffi.buffer(owner, 8 * num_values),
+                             dtype=np.uint64)
+    try:
+        values = new_uint64_array(len(head) + num_values)
+        for idx, value in enumerate(head):
+            values[idx] = value
+        c_out = ffi.cast("uint64_t*", ffi.from_buffer(values))
+        ffi.memmove(c_out + len(head), c_values, 8 * num_values)
+        return values
+    finally:
+        lib.fst_values_free(c_values, num_values)
+
+
+def packed_chunks(keys, encode, batch_size=BATCH_SIZE):
+    """ Encode and pack a sequence of keys in batches.
+
+    :returns:   Iterator over `(start, c_buf, c_offsets, num_keys)` tuples,
+                where `start` is the index of the first key of the batch
+    """
+    start = 0
+    for chunk in chunked(keys, batch_size):
+        c_buf, c_offsets = pack_keys([encode(k) for k in chunk])
+        yield start, c_buf, c_offsets, len(chunk)
+        start += len(chunk)
+
+
+def contains_many(contains_fn, ptr, keys, encode, batch_size=BATCH_SIZE):
+    """ Check many keys for membership with one native call per batch.
+
+    :param contains_fn: Native function that checks a batch of packed keys
+    :param ptr:         Pointer to the set or map
+    :param keys:        Sequence of keys, e.g. a list or a NumPy array
+    :param encode:      Function to encode the keys
+    :returns:           Array with the result for each key, see
+                        :py:func:`new_bool_array`
+    """
+    if not hasattr(keys, '__len__'):
+        keys = list(keys)
+    out = new_bool_array(len(keys))
+    if not len(keys):
+        return out
+    c_out = ffi.from_buffer(out)
+    for start, c_buf, c_offsets, num_keys in packed_chunks(keys, encode,
+                                                          batch_size):
+        contains_fn(ptr, c_buf, c_offsets, num_keys, c_out + start)
+    return out
+
+
+def take_bytes(fn, *args):
+    """ Call a native function that hands over an owned byte buffer and copy
+        it into a `bytes` object.
+
+    The function is called with `args` and a pointer for the buffer length.
+    """
+    len_p = ffi.new("size_t*")
+    data = fn(*(args + (len_p,)))
+    try:
+        return ffi.unpack(data, len_p[0])
+    finally:
+        lib.fst_bytes_free(data, len_p[0])
+
+
+def unpack_keys(batch, decode):
+    """ Decode the keys of a `StreamBatch` into a list. """
+    num_items = batch.num_items
+    offsets = ffi.unpack(batch.offsets, num_items + 1)
+    data = ffi.unpack(batch.keys, offsets[-1])
+    return [decode(data[offsets[idx]:offsets[idx + 1]])
+            for idx in range(num_items)]
+
+
+def unpack_items(batch, decode):
+    """ Decode the (key, value) pairs of a `StreamBatch` into a list. """
+    values = ffi.unpack(batch.values, batch.num_items)
+    return list(zip(unpack_keys(batch, decode), values))
+
+
+def take_batch(decode, fn, *args):
+    """ Call a native function that returns a `StreamBatch`, decode its keys
+        or (key, value) pairs and free the batch.
+    """
+    batch = fn(*args)
+    try:
+        if batch.values == ffi.NULL:
+            return unpack_keys(batch, decode)
+        return unpack_items(batch, decode)
+    finally:
+        lib.fst_streambatch_free(batch)
+
+
+def build_side_index(build_fn, save_fn, free_fn, fst_ptr, path=None):
+    """ Build an index over a set or map and optionally store it in a side
+        file.
+    """
+    index = ffi.gc(build_fn(fst_ptr), free_fn)
+    if path:
+        checked_call(save_fn, index, ffi.new("char[]", path.encode('utf8')))
+    return index
+
+
+def load_side_index(open_fn, matches_fn, free_fn, fst_ptr, path):
+    """ Load an index from a side file and check that it was built for a set
+        or map.
+
+    :raises ValueError: If the index was built for a different set or map
+    """
+    index = checked_call(open_fn, ffi.new("char[]", path.encode('utf8')))
+    index = ffi.gc(index, free_fn)
+    if not matches_fn(index, fst_ptr):
+        raise ValueError("The index at {!r} was built for a different set or "
+                         "map".format(path))
+    return index
+
+
+def ranked_search(search_fn, ptr, lev, k, decode):
+    """ Run a native ranked Levenshtein search.
+
+    :returns:   List of `(key, distance)` pairs for sets and of
+                `(key, value, distance)` triples for maps, in rank order
+    """
+    term = ffi.new("char[]", lev.term.encode('utf8'))
+    batch = search_fn(ptr, lev._ptr, term, k)
+    try:
+        keys = unpack_keys(batch, decode)
+        distances = ffi.unpack(batch.distances, batch.num_items)
+        if batch.values == ffi.NULL:
+            return list(zip(keys, distances))
+        values = ffi.unpack(batch.values, batch.num_items)
+        return list(zip(keys, values, distances))
+    finally:
+        lib.fst_streambatch_free(batch)
 
 
 class StreamIterator(object):
-    def __init__(self, stream_ptr, next_fn, free_fn, autom_ptr=None,
-                 autom_free_fn=None, ctx_ptr=None):
+    """ Iterator over the items of a native stream.
+
+    Items are fetched from the stream in batches of :py:attr:`batch_size`,
+    so the cost of crossing the FFI boundary is paid once per batch instead
+    of once per item. Set :py:attr:`batch_size` on an iterator, or on this
+    class to change the default, to trade memory for fewer native calls.
+    """
+    #: Maximum number of items fetched per native call when iterating
+    batch_size = STREAM_BATCH_SIZE
+
+    def __init__(self, stream_ptr, next_fn, free_fn, automaton=None,
+                 count_fn=None, batch_fn=None, keys='str'):
+        self._encode, self._decode = get_key_codec(keys)
+        self._key_p = ffi.new("char**")
+        self._len_p = ffi.new("size_t*")
         self._free_fn = free_fn
         self._ptr = ffi.gc(stream_ptr, free_fn)
         self._next_fn = next_fn
-        if autom_ptr:
-            self._autom_ptr = ffi.gc(autom_ptr, autom_free_fn)
-            self._autom_free_fn = autom_free_fn
-        else:
-            self._autom_ptr = None
-        self._ctx = ctx_ptr
+        self._count_fn = count_fn
+        self._batch_fn = batch_fn
+        # The stream borrows the automaton, so it must outlive the stream
+        self._automaton = automaton
+        # Items that were fetched from the stream, but not yet returned
+        self._buffer = []
+        self._pos = 0
 
     def _free(self):
         self._free_fn(self._ptr)
         # Clear GC hook to prevent double-free
         ffi.gc(self._ptr, None)
         self._ptr = None
-        if self._autom_ptr:
-            self._autom_free_fn(self._autom_ptr)
-            ffi.gc(self._autom_ptr, None)
-            self._autom_ptr = None
+        self._automaton = None
+
+    def _take_buffered(self, limit, offset=0):
+        """ Get up to `limit` buffered items after skipping `offset` items.
+
+        :returns:   The items and the number of items that are still to be
+                    skipped in the stream
+        """
+        start = min(self._pos + offset, len(self._buffer))
+        items = self._buffer[start:start + limit]
+        offset -= start - self._pos
+        self._pos = start + len(items)
+        if self._pos == len(self._buffer):
+            self._buffer = []
+            self._pos = 0
+        return items, offset
+
+    def _fetch(self, limit, offset=0):
+        """ Skip `offset` items of the stream and fetch up to `limit` of the
+            following items in a single native call.
+        """
+        if self._batch_fn is None:
+            return list(islice(self._iter_single(), offset, offset + limit))
+        batch = self._batch_fn(self._ptr, offset, limit)
+        try:
+            items = self._unpack_batch(batch)
+        finally:
+            self._free_batch(batch)
+        if len(items) < limit:
+            self._free()
+        return items
+
+    def _iter_single(self):
+        while self._ptr is not None:
+            item = self._next_single()
+            if item is None:
+                self._free()
+                return
+            yield item
+
+    def next_batch(self, n=None):
+        """ Get up to `n` next items.
+
+        :param n:   Maximum number of items, defaults to :py:attr:`batch_size`
+        :returns:   A list of items, which is empty once the iterator is
+                    exhausted
+        """
+        if n is None:
+            n = self.batch_size
+        items, _ = self._take_buffered(n)
+        if len(items) < n and self._ptr is not None:
+            items.extend(self._fetch(n - len(items)))
+        return items
+
+    def count(self):
+        """ Count the remaining items, exhausting the iterator.
+
+        Query results are counted natively, without passing each item over
+        the FFI boundary.
+
+        :rtype:     int
+        """
+        count = len(self._buffer) - self._pos
+        self._buffer = []
+        self._pos = 0
+        if self._ptr is None:
+            return count
+        if self._count_fn is None:
+            return count + sum(1 for _ in self)
+        count += self._count_fn(self._ptr)
+        self._free()
+        return count
+
+    def take(self, limit, offset=0):
+        """ Get the next `limit` items after skipping `offset` items, and
+            close the iterator.
+
+        For query results, the items are skipped and copied natively in a
+        single call, so the work per call is bounded by `offset + limit`.
+
+        :param limit:   Maximum number of items to return
+        :param offset:  Number of items to skip
+        :rtype:         list
+        """
+        items, offset = self._take_buffered(limit, offset)
+        if len(items) < limit and self._ptr is not None:
+            items.extend(self._fetch(limit - len(items), offset))
+        self.close()
+        return items
+
+    def to_arrays(self):
+        """ Get the remaining items as columns, exhausting the iterator.
+
+        The columns are filled natively in a single pass over the stream,
+        without creating Python objects for the items. With NumPy, the
+        returned arrays share the native memory, so the peak memory use is
+        about the size of the result. The `offsets` and `data` columns have
+        the layout of an Arrow `large_binary` or `large_string` array,
+        e.g. `pyarrow.LargeStringArray.from_buffers(len(offsets) - 1,
+        pyarrow.py_buffer(offsets), pyarrow.py_buffer(data))`.
+
+        :returns:   The keys and, for maps, the values
+        :rtype:     :py:class:`Arrays` of `int64` offsets, `uint8` data and
+                    `uint64` values, as NumPy arrays if NumPy is installed,
+                    otherwise as `array.array` objects and `bytes`
+        """
+        buffered = self._buffer[self._pos:]
+        self._buffer = []
+        self._pos = 0
+        if self._ptr is None or self._batch_fn is None:
+            tail = self._pack_items(buffered + list(self))
+        else:
+            tail = batch_to_arrays(
+                self._batch_fn(self._ptr, 0, ffi.cast("size_t", -1)))
+            self._free()
+            if buffered:
+                tail = concat_arrays(self._pack_items(buffered), tail)
+        return tail
+
+    def _pack_items(self, items):
+        """ Build :py:class:`Arrays` from decoded items. """
+        raise NotImplementedError
+
+    def close(self):
+        """ Free the underlying stream without exhausting it.
+
+        Use this to release an abandoned iterator immediately instead of
+        waiting for the garbage collector.
+        """
+        self._buffer = []
+        self._pos = 0
+        if self._ptr is not None:
+            self._free()
+
+    def _unpack_batch(self, batch):
+        raise NotImplementedError
+
+    def _free_batch(self, batch):
+        lib.fst_streambatch_free(batch)
+
+    def _next_single(self):
+        """ Get the next item with the stream's `next_fn`, or `None` if the
+            stream is exhausted.
+        """
+        raise NotImplementedError
 
     def __iter__(self):
         return self
@@ -33,56 +535,311 @@ class StreamIterator(object):
         return self.__next__()
 
     def __next__(self):
-        raise NotImplementedError
+        if self._pos == len(self._buffer):
+            if self._ptr is None:
+                raise StopIteration
+            self._buffer = self._fetch(self.batch_size)
+            self._pos = 0
+            if not self._buffer:
+                raise StopIteration
+        item = self._buffer[self._pos]
+        self._pos += 1
+        return item
 
 
 class KeyStreamIterator(StreamIterator):
-    def __next__(self):
-        c_str = self._next_fn(self._ptr)
-        if c_str == ffi.NULL:
-            self._free()
-            raise StopIteration
-        py_str = ffi.string(c_str).decode('utf8')
-        lib.fst_string_free(c_str)
-        return py_str
+    def _unpack_batch(self, batch):
+        return unpack_keys(batch, self._decode)
 
+    def _pack_items(self, items):
+        return make_arrays([self._encode(key) for key in items])
 
-class ValueStreamIterator(StreamIterator):
-    def __next__(self):
-        val = self._next_fn(self._ctx, self._ptr)
-        if val == 0 and self._ctx.has_error:
+    def _next_single(self):
+        if not self._next_fn(self._ptr, self._key_p, self._len_p):
+            return None
+        return self._decode(ffi.unpack(self._key_p[0], self._len_p[0]))
+
+
+class ValueReductionMixin(object):
+    """ Reductions over the remaining values of an iterator over map items
+        or values, computed natively without creating Python objects for
+        the values.
+
+    All of them exhaust the iterator.
+    """
+    def _value_of(self, item):
+        raise NotImplementedError
+
+    def _take_values(self):
+        """ Remove the buffered items, or all remaining items if the stream
+            has no native reductions, and get their values.
+        """
+        items = self._buffer[self._pos:]
+        self._buffer = []
+        self._pos = 0
+        if self._value_fns is None:
+            items.extend(self)
+        return [self._value_of(item) for item in items]
+
+    def values_array(self):
+        """ Get the remaining values as an array.
+
+        With NumPy, the array is filled natively and shares its memory with
+        the native library.
+
+        :returns:   An array as returned by :py:func:`new_uint64_array`
+        """
+        head = self._take_values()
+        if self._ptr is None:
+            values = new_uint64_array(len(head))
+            for idx, value in enumerate(head):
+                values[idx] = value
+            return values
+        len_p = ffi.new("size_t*")
+        c_values = self._value_fns.values(self._ptr, len_p)
+        self._free()
+        return take_values(c_values, len_p[0], head)
+
+    def stats(self):
+        """ Get the number, exact sum, minimum and maximum of the remaining
+            values in a single pass.
+
+        :rtype:     :py:class:`ValueStats`
+        """
+        head = self._take_values()
+        count, total = len(head), sum(head)
+        low, high = (min(head), max(head)) if head else (None, None)
+        if self._ptr is not None:
+            c_stats = ffi.new("ValueStats*")
+            self._value_fns.stats(self._ptr, c_stats)
             self._free()
-            raise StopIteration
-        return val
+            if c_stats.count:
+                count += c_stats.count
+                total += (c_stats.sum_high << 64) | c_stats.sum_low
+                low = c_stats.min if low is None else min(low, c_stats.min)
+                high = c_stats.max if high is None else max(high, c_stats.max)
+        return ValueStats(count, total, low, high)
 
+    def sum(self):
+        """ Get the exact sum of the remaining values.
 
-class MapItemStreamIterator(StreamIterator):
-    def __next__(self):
-        itm = self._next_fn(self._ptr)
-        if itm == ffi.NULL:
+        :rtype:     int
+        """
+        return self.stats().sum
+
+    def min(self):
+        """ Get the smallest of the remaining values.
+
+        :raises ValueError: If there are no values
+        """
+        stats = self.stats()
+        if not stats.count:
+            raise ValueError("min() of an empty stream")
+        return stats.min
+
+    def max(self):
+        """ Get the largest of the remaining values.
+
+        :raises ValueError: If there are no values
+        """
+        stats = self.stats()
+        if not stats.count:
+            raise ValueError("max() of an empty stream")
+        return stats.max
+
+    def histogram(self, bins):
+        """ Count the remaining values per bucket.
+
+        Like :py:func:`numpy.histogram`, bucket `i` holds the values in
+        `[bins[i], bins[i + 1])` and the last bucket also the values equal to
+        its upper edge. Values outside of all buckets are not counted.
+
+        :param bins:        Strictly increasing edges of the buckets
+        :returns:           The counts, in an array as returned by
+                            :py:func:`new_uint64_array`
+        :raises ValueError: If there are less than two edges, they are not
+                            strictly increasing or not integers that fit
+                            into an unsigned 64 bit value
+        """
+        bins = [_histogram_edge(edge) for edge in bins]
+        if len(bins) < 2 or any(lo >= hi for lo, hi in zip(bins, bins[1:])):
+            raise ValueError(
+                "bins must be at least two strictly increasing edges")
+        counts = new_uint64_array(len(bins) - 1)
+        for value in self._take_values():
+            if value == bins[-1]:
+                counts[-1] += 1
+            elif bins[0] <= value < bins[-1]:
+                counts[bisect.bisect_right(bins, value) - 1] += 1
+        if self._ptr is not None:
+            self._value_fns.histogram(
+                self._ptr, ffi.new("uint64_t[]", bins), len(bins),
+                ffi.cast("uint64_t*", ffi.from_buffer(counts)))
             self._free()
-            raise StopIteration
-        key = ffi.string(itm.key).decode('utf8')
-        value = itm.value
-        lib.fst_string_free(itm.key)
-        lib.fst_mapitem_free(itm)
-        return (key, value)
+        return counts
+
+
+def _histogram_edge(edge):
+    try:
+        value = int(edge)
+    except (OverflowError, ValueError):
+        value = None
+    if value is None or value != edge or not 0 <= value <= MAX_VALUE:
+        raise ValueError(
+            "bins must be integers between 0 and 2**64 - 1, not {!r}"
+            .format(edge))
+    return value
+
+
+class ValueStreamIterator(ValueReductionMixin, StreamIterator):
+    def __init__(self, *args, **kwargs):
+        self._value_fns = kwargs.pop('value_fns', None)
+        super(ValueStreamIterator, self).__init__(*args, **kwargs)
+        self._val_p = ffi.new("uint64_t*")
+
+    def _unpack_batch(self, batch):
+        return ffi.unpack(batch.values, batch.num_items)
+
+    def _pack_items(self, items):
+        return make_arrays([b''] * len(items), items)
+
+    def _value_of(self, item):
+        return item
+
+    def _next_single(self):
+        if not self._next_fn(self._ptr, self._val_p):
+            return None
+        return self._val_p[0]
+
+
+class MapItemStreamIterator(ValueReductionMixin, StreamIterator):
+    def __init__(self, *args, **kwargs):
+        self._value_fns = kwargs.pop('value_fns', None)
+        super(MapItemStreamIterator, self).__init__(*args, **kwargs)
+        self._val_p = ffi.new("uint64_t*")
+
+    def _unpack_batch(self, batch):
+        return unpack_items(batch, self._decode)
+
+    def _pack_items(self, items):
+        return make_arrays([self._encode(key) for key, _ in items],
+                           [value for _, value in items])
+
+    def _value_of(self, item):
+        return item[1]
+
+    def _next_single(self):
+        if not self._next_fn(self._ptr, self._key_p, self._len_p,
+                             self._val_p):
+            return None
+        key = self._decode(ffi.unpack(self._key_p[0], self._len_p[0]))
+        return (key, self._val_p[0])
 
 
 IndexedValue = namedtuple("IndexedValue", ("index", "value"))
 
+#: Largest value of a map
+MAX_VALUE = 2 ** 64 - 1
+
+#: Functions that combine the `IndexedValue` tuples of a key in the result of
+#: a map set operation into a single value, by name. The native library
+#: implements them with codes in the same order.
+REDUCERS = (
+    ('sum', lambda ivs: min(sum(iv.value for iv in ivs), MAX_VALUE)),
+    ('min', lambda ivs: min(iv.value for iv in ivs)),
+    ('max', lambda ivs: max(iv.value for iv in ivs)),
+    ('first', lambda ivs: min(ivs).value),
+    ('last', lambda ivs: max(ivs).value),
+    ('count', len),
+)
+
+
+def get_reducer(name):
+    """ Get the code of a reducer for map set operations.
+
+    :param name:        Name of the reducer, see :py:data:`REDUCERS`
+    :returns:           The code of the reducer, which is its index in
+                        :py:data:`REDUCERS`
+    :raises ValueError: If the reducer is unknown
+    """
+    for code, (reducer_name, _) in enumerate(REDUCERS):
+        if name == reducer_name:
+            return code
+    raise ValueError("Reducer must be one of {}, not {!r}".format(
+        ", ".join(repr(n) for n, _ in REDUCERS), name))
+
+
+def pop_reducer(kwargs, default=None):
+    """ Get the reducer passed as the `reduce` keyword argument of a map set
+        operation.
+
+    :param kwargs:      Keyword arguments of the operation, which must not
+                        contain any other arguments
+    :param default:     Name of the reducer to use if none was passed or it
+                        was passed as `None`
+    :returns:           The code of the reducer, or `None` if no reducer was
+                        passed and there is no default
+    :raises ValueError: If the reducer is unknown
+    """
+    name = kwargs.pop('reduce', None)
+    if kwargs:
+        raise TypeError("Unexpected keyword argument {!r}".format(
+            sorted(kwargs)[0]))
+    if name is None:
+        name = default
+    if name is None:
+        return None
+    return get_reducer(name)
+
 
 class MapOpItemStreamIterator(StreamIterator):
-    def __next__(self):
+    def _unpack_batch(self, batch):
+        keys = unpack_keys(batch, self._decode)
+        value_offsets = ffi.unpack(batch.value_offsets, batch.num_items + 1)
+        c_values = batch.values
+        values = [IndexedValue(c_values[n].index, c_values[n].value)
+                  for n in range(value_offsets[-1])]
+        return [(key, tuple(values[value_offsets[idx]:
+                                   value_offsets[idx + 1]]))
+                for idx, key in enumerate(keys)]
+
+    def _free_batch(self, batch):
+        lib.fst_map_opitembatch_free(batch)
+
+    def to_arrays(self):
+        """ Not supported, since every key can have any number of values.
+
+        :raises TypeError:  Always, pass `reduce` to the set operation to
+                            get a single value per key that can be exported
+        """
+        raise TypeError(
+            "Results with several values per key can not be exported as "
+            "columns, pass reduce= to the map set operation to combine them "
+            "into one value per key first")
+
+    def _next_single(self):
         itm = self._next_fn(self._ptr)
         if itm == ffi.NULL:
-            self._free()
-            raise StopIteration
-        key = ffi.string(itm.key).decode('utf8')
+            return None
+        key = self._decode(ffi.unpack(itm.key, itm.key_len))
         values = []
         for n in range(itm.num_values):
             rust_val = itm.values[n]
             values.append(IndexedValue(rust_val.index, rust_val.value))
-        lib.fst_string_free(itm.key)
         lib.fst_map_opitem_free(itm)
         return (key, tuple(values))
+
+
+class SourceStreamIterator(MapOpItemStreamIterator):
+    """ Iterator over keys from searches on many sets, each along with the
+        indices of the sets that contain it.
+    """
+    def _unpack_batch(self, batch):
+        items = super(SourceStreamIterator, self)._unpack_batch(batch)
+        return [(key, tuple(iv.index for iv in ivs)) for key, ivs in items]
+
+    def _next_single(self):
+        item = super(SourceStreamIterator, self)._next_single()
+        if item is None:
+            return None
+        return (item[0], tuple(iv.index for iv in item[1]))
@@ -0,0 +1,226 @@
+""" External merge sort for building sets and maps from unsorted input.
+
+Keys are sorted in runs that fit into a memory budget. Runs that exceed it
+are spilled to a temporary directory and k-way merged afterwards. Since
+UTF-8 preserves the code point order of strings, sorting unicode keys in
+Python yields the same order as sorting their encoded bytes, which is the
+order required by the builders.
+"""
+import heapq
+import operator
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from functools import reduce
+from itertools import chain, groupby
+
+from .common import BATCH_SIZE, MAX_VALUE, chunked, get_key_codec
+
+#: Default memory budget for in-memory runs, in bytes
+DEFAULT_MEMORY_LIMIT = 256 * 1024 * 1024
+
+#: Estimated memory overhead per buffered item on top of the key size
+ITEM_OVERHEAD = 64
+
+#: Functions to combine two values for the same key in a map, by policy name
+DUPLICATE_POLICIES = {
+    'first': lambda a, b: a,
+    'last': lambda a, b: b,
+    'sum': lambda a, b: min(a + b, MAX_VALUE),
+    'min': min,
+    'max': max,
+}
+
+_KEY_LEN = struct.Struct('<I')
+_VALUE = struct.Struct('<Q')
+
+
+def write_record(fp, key, val=None):
+    """ Write an encoded key and an optional value to a run file.
+
+    :returns:   Number of bytes written
+    """
+    fp.write(_KEY_LEN.pack(len(key)))
+    fp.write(key)
+    if val is None:
+        return _KEY_LEN.size + len(key)
+    fp.write(_VALUE.pack(val))
+    return _KEY_LEN.size + len(key) + _VALUE.size
+
+
+def write_records(fp, keys, vals=None):
+    """ Write many encoded keys and optional values to a run file at once.
+
+    The records are packed with a single write, without running Python code
+    per record.
+
+    :returns:   Number of bytes written
+    """
+    headers = map(_KEY_LEN.pack, map(len, keys))
+    if vals is None:
+        records = zip(headers, keys)
+    else:
+        records = zip(headers, keys, map(_VALUE.pack, vals))
+    data = b''.join(chain.from_iterable(records))
+    fp.write(data)
+    return len(data)
+
+
+def records_size(keys, with_values):
+    """ Get the number of bytes that the records of encoded keys take up in
+        a run file.
+    """
+    record_size = _KEY_LEN.size + (_VALUE.size if with_values else 0)
+    return sum(map(len, keys)) + record_size * len(keys)
+
+
+def read_records(fp, with_values, end=None):
+    """ Read encoded keys and values from a run file.
+
+    :param fp:          File object positioned at the first record to read
+    :param with_values: Whether the records contain values
+    :param end:         Offset to stop reading at, defaults to the end of the
+                        file
+    :returns:           Iterator over (key, value) pairs, where value is
+                        `None` if the records have no values
+    """
+    pos = fp.tell()
+    while end is None or pos < end:
+        header = fp.read(_KEY_LEN.size)
+        if not header:
+            return
+        key = fp.read(_KEY_LEN.unpack(header)[0])
+        pos += _KEY_LEN.size + len(key)
+        if with_values:
+            val = _VALUE.unpack(fp.read(_VALUE.size))[0]
+            pos += _VALUE.size
+        else:
+            val = None
+        yield key, val
+
+
+def _write_run(path, items, encode, with_values):
+    with open(path, 'wb') as fp:
+        for chunk in chunked(items, BATCH_SIZE):
+            keys = [encode(key) for key, _ in chunk]
+            vals = [val for _, val in chunk] if with_values else None
+            write_records(fp, keys, vals)
+
+
+def _read_run(path, run_idx, decode, with_values):
+    with open(path, 'rb') as fp:
+        for key, val in read_records(fp, with_values):
+            yield decode(key), run_idx, val
+
+
+def _dedupe(items, combine):
+    """ Collapse consecutive items with the same key, keeping their order. """
+    for key, group in groupby(items, key=operator.itemgetter(0)):
+        yield key, reduce(combine, (val for _, val in group))
+
+
+def _sort_run(run, combine):
+    """ Sort and deduplicate a run, emptying the list it was passed in. """
+    # `list.sort` is stable, so values for a key keep their order
+    run.sort(key=operator.itemgetter(0))
+    deduped = list(_dedupe(run, combine))
+    del run[:]
+    return deduped
+
+
+def _sorted_runs(it, memory_limit, combine):
+    """ Split the input into sorted and deduplicated runs.
+
+    Only one run is held in memory at a time, as long as the consumer
+    releases a run before it requests the next one.
+
+    :returns:   Iterator over `(run, is_last)` tuples
+    """
+    run = []
+    run_size = 0
+    for item in it:
+        run.append(item)
+        run_size += sys.getsizeof(item[0]) + ITEM_OVERHEAD
+        if run_size >= memory_limit:
+            run_size = 0
+            yield _sort_run(run, combine), False
+    yield _sort_run(run, combine), True
+
+
+def sort_items(it, keys='str', duplicates='last',
+               memory_limit=DEFAULT_MEMORY_LIMIT, tmpdir=None,
+               with_values=True):
+    """ Sort (key, value) pairs from an iterator with bounded memory.
+
+    The arguments are checked right away, the input is only consumed once
+    the returned iterator is.
+
+    :param it:              Iterator over (key, value) pairs in arbitrary
+                            order
+    :param keys:            Type of the keys, `'str'` or `'bytes'`
+    :param duplicates:      Policy to resolve values of duplicate keys, one
+                            of `'first'`, `'last'`, `'sum'`, `'min'` or
+                            `'max'`. Sums are capped at `2 ** 64 - 1`.
+    :param memory_limit:    Approximate memory budget in bytes for the
+                            items that are sorted in memory at a time
+    :param tmpdir:          Directory to create the temporary directory for
+                            spilled runs in, defaults to the system default
+    :param with_values:     Whether the items carry values. If `False`, the
+                            values are ignored and not written to disk.
+    :returns:               Iterator over the lexicographically sorted pairs
+                            with unique keys
+    """
+    if duplicates not in DUPLICATE_POLICIES:
+        raise ValueError("Duplicate policy must be one of {}, not {!r}"
+                         .format(", ".join(sorted(DUPLICATE_POLICIES)),
+                                 duplicates))
+    return _sort_items(it, get_key_codec(keys),
+                       DUPLICATE_POLICIES[duplicates], memory_limit, tmpdir,
+                       with_values)
+
+
+def _sort_items(it, codec, combine, memory_limit, tmpdir, with_values):
+    encode, decode = codec
+    runs = _sorted_runs(it, memory_limit, combine)
+    run, is_last = next(runs)
+    if is_last:
+        # Everything fit into memory, no need to spill
+        for item in run:
+            yield item
+        return
+    spill_dir = tempfile.mkdtemp(prefix='rust_fst-', dir=tmpdir)
+    try:
+        paths = []
+        while True:
+            paths.append(os.path.join(spill_dir, 'run-{}'.format(len(paths))))
+            _write_run(paths[-1], run, encode, with_values)
+            if is_last:
+                break
+            # Release the spilled run before the next one is materialized
+            run = None
+            run, is_last = next(runs)
+        run = None
+        # Ties between runs are broken by the run index, so values are
+        # combined in the order in which they were read from the input
+        merged = heapq.merge(*(_read_run(p, idx, decode, with_values)
+                               for idx, p in enumerate(paths)))
+        for item in _dedupe(((key, val) for key, _, val in merged), combine):
+            yield item
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+def sort_keys(it, keys='str', memory_limit=DEFAULT_MEMORY_LIMIT,
+              tmpdir=None):
+    """ Sort and deduplicate keys from an iterator with bounded memory.
+
+    See :py:func:`sort_items` for a description of the parameters.
+
+    :returns:   Iterator over the unique keys in lexicographical order
+    """
+    items = sort_items(((key, None) for key in it), keys=keys,
+                       duplicates='first', memory_limit=memory_limit,
+                       tmpdir=tmpdir, with_values=False)
+    return (key for key, _ in items)
@@ -0,0 +1,220 @@
+""" Searches over many sets or maps at once.
+
+Each function runs the same search on every set or map of a collection and
+combines the results with a native union, so every matching key is returned
+once, in lexicographical order, along with the positions of the sets or maps
+that contain it. The automaton of a search is compiled once for all of
+them::
+
+    matches = fanout.search_re(customer_sets, r'.*@example\\.com')
+    for key, indices in matches:
+        ...
+
+For sets, each key comes with a tuple of the indices of the sets that
+contain it. For maps, it comes with a tuple of
+:py:class:`rust_fst.common.IndexedValue`, like the results of
+:py:meth:`rust_fst.Map.union`, unless a `reduce` function is passed to
+combine them into a single value.
+"""
+from . import automaton
+from .common import (MapItemStreamIterator, MapOpItemStreamIterator,
+                     SourceStreamIterator, ValueFns, get_reducer)
+from .lib import lib
+from .map import Map
+from .set import Set
+
+
+def _check_sources(sources, reduce):
+    """ Check that the sources are all sets or all maps with the same key
+        type.
+
+    :returns:   Whether the sources are maps, their key type and the code of
+                the reducer or `None`
+    """
+    sources = list(sources)
+    if not sources:
+        raise ValueError("At least one set or map must be passed")
+    is_map = isinstance(sources[0], Map)
+    cls = Map if is_map else Set
+    if not all(isinstance(src, cls) for src in sources):
+        raise ValueError("Sources must either all be sets or all be maps")
+    keys = sources[0]._keys
+    if any(src._keys != keys for src in sources):
+        raise ValueError("Sources must all have the same key type")
+    if reduce is not None and not is_map:
+        raise ValueError("Results can only be reduced for maps")
+    reducer = get_reducer(reduce) if reduce is not None else None
+    return sources, is_map, keys, reducer
+
+
+def _union(sources, is_map, keys, reducer, stream_ptrs, borrowed):
+    """ Combine one stream per source with a native union.
+
+    :param stream_ptrs: `(push function, stream)` tuples, the streams are
+                        consumed
+    :param borrowed:    Objects that the streams borrow
+    """
+    ob_ptr = lib.fst_opbuilder_new()
+    for push_fn, stream_ptr in stream_ptrs:
+        push_fn(ob_ptr, stream_ptr)
+    union_ptr = lib.fst_map_opbuilder_union(ob_ptr)
+    # The streams borrow the sources as well
+    borrowed = (borrowed, sources)
+    if reducer is not None:
+        return MapItemStreamIterator(
+            lib.fst_map_union_reduce(union_ptr, reducer),
+            lib.fst_map_reducedstream_next, lib.fst_map_reducedstream_free,
+            borrowed, count_fn=lib.fst_map_reducedstream_count,
+            batch_fn=lib.fst_map_reducedstream_batch, keys=keys,
+            value_fns=ValueFns(lib.fst_map_reducedstream_values,
+                               lib.fst_map_reducedstream_stats,
+                               lib.fst_map_reducedstream_histogram))
+    iterator_cls = MapOpItemStreamIterator if is_map else SourceStreamIterator
+    return iterator_cls(union_ptr, lib.fst_map_union_next,
+                        lib.fst_map_union_free, borrowed,
+                        count_fn=lib.fst_map_union_count,
+                        batch_fn=lib.fst_map_union_batch, keys=keys)
+
+
+def search(sources, term, max_dist=None, reduce=None):
+    """ Search many sets or maps with a Levenshtein automaton.
+
+    :param sources:     Sets or maps to search
+    :param term:        The search term or a compiled
+                        :py:class:`rust_fst.Levenshtein`
+    :param max_dist:    The maximum edit distance for search results, must
+                        be omitted for a compiled automaton
+    :param reduce:      Name of the function to combine the values of each
+                        key in maps with, see :py:meth:`rust_fst.Map.union`
+    :returns:           Iterator over the matching keys and their sources
+    """
+    sources, is_map, keys, reducer = _check_sources(sources, reduce)
+    lev = automaton.get_levenshtein(term, max_dist)
+    if is_map:
+        stream_ptrs = [(lib.fst_opbuilder_push_maplevstream,
+                        lib.fst_map_levsearch(src._ptr, lev._ptr))
+                       for src in sources]
+    else:
+        stream_ptrs = [(lib.fst_opbuilder_push_setlevstream,
+                        lib.fst_set_levsearch(src._ptr, lev._ptr))
+                       for src in sources]
+    return _union(sources, is_map, keys, reducer, stream_ptrs, lev)
+
+
+def search_re(sources, pattern, reduce=None):
+    """ Search many sets or maps with a regular expression.
+
+    See :py:meth:`rust_fst.Set.search_re` for the supported syntax.
+
+    :param sources:     Sets or maps to search
+    :param pattern:     A regular expression or a compiled
+                        :py:class:`rust_fst.Regex`
+    :param reduce:      Name of the function to combine the values of each
+                        key in maps with, see :py:meth:`rust_fst.Map.union`
+    :returns:           Iterator over the matching keys and their sources
+    """
+    sources, is_map, keys, reducer = _check_sources(sources, reduce)
+    regex = automaton.get_regex(pattern)
+    if is_map:
+        stream_ptrs = [(lib.fst_opbuilder_push_mapregexstream,
+                        lib.fst_map_regexsearch(src._ptr, regex._ptr))
+                       for src in sources]
+    else:
+        stream_ptrs = [(lib.fst_opbuilder_push_setregexstream,
+                        lib.fst_set_regexsearch(src._ptr, regex._ptr))
+                       for src in sources]
+    return _union(sources, is_map, keys, reducer, stream_ptrs, regex)
+
+
+def query(sources, query, reduce=None):
+    """ Search many sets or maps with a composite query.
+
+    :param sources:     Sets or maps to search
+    :param query:       A :py:class:`rust_fst.Query`
+    :param reduce:      Name of the function to combine the values of each
+                        key in maps with, see :py:meth:`rust_fst.Map.union`
+    :returns:           Iterator over the matching keys and their sources
+    """
+    sources, is_map, keys, reducer = _check_sources(sources, reduce)
+    c_query, borrowed = query._compile(sources[0]._encode)
+    if is_map:
+        stream_ptrs = [(lib.fst_opbuilder_push_mapquerystream,
+                        lib.fst_map_querysearch(src._ptr, c_query))
+                       for src in sources]
+    else:
+        stream_ptrs = [(lib.fst_opbuilder_push_setquerystream,
+                        lib.fst_set_querysearch(src._ptr, c_query))
+                       for src in sources]
+    return _union(sources, is_map, keys, reducer, stream_ptrs,
+                  (c_query, borrowed))
+
+
+def _range_streams(sources, is_map, start=None, stop=None, prefix=None):
+    """ Create a stream over a key range or the keys with a prefix for each
+        source, from encoded keys.
+    """
+    if is_map:
+        fns = (lib.fst_map_streambuilder_new,
+               lib.fst_map_streambuilder_add_prefix,
+               lib.fst_map_streambuilder_add_ge,
+               lib.fst_map_streambuilder_add_lt,
+               lib.fst_map_streambuilder_finish,
+               lib.fst_opbuilder_push_mapstream)
+    else:
+        fns = (lib.fst_set_streambuilder_new,
+               lib.fst_set_streambuilder_add_prefix,
+               lib.fst_set_streambuilder_add_ge,
+               lib.fst_set_streambuilder_add_lt,
+               lib.fst_set_streambuilder_finish,
+               lib.fst_opbuilder_push_setstream)
+    new_fn, prefix_fn, ge_fn, lt_fn, finish_fn, push_fn = fns
+    stream_ptrs = []
+    for src in sources:
+        sb_ptr = new_fn(src._ptr)
+        if prefix is not None:
+            sb_ptr = prefix_fn(sb_ptr, prefix, len(prefix))
+        if start:
+            sb_ptr = ge_fn(sb_ptr, start, len(start))
+        if stop:
+            sb_ptr = lt_fn(sb_ptr, stop, len(stop))
+        stream_ptrs.append((push_fn, finish_fn(sb_ptr)))
+    return stream_ptrs
+
+
+def key_range(sources, start=None, stop=None, reduce=None):
+    """ Get the keys in a range of many sets or maps.
+
+    Like slicing a set or map, `stop` is exclusive.
+
+    :param sources:     Sets or maps to search
+    :param start:       The smallest key to return, of the key type of the
+                        sources
+    :param stop:        The key to stop before
+    :param reduce:      Name of the function to combine the values of each
+                        key in maps with, see :py:meth:`rust_fst.Map.union`
+    :returns:           Iterator over the keys and their sources
+    """
+    sources, is_map, keys, reducer = _check_sources(sources, reduce)
+    if start and stop and start > stop:
+        raise ValueError(
+            "Start key must be lexicographically smaller than stop.")
+    encode = sources[0]._encode
+    stream_ptrs = _range_streams(sources, is_map,
+                                 start=encode(start) if start else None,
+                                 stop=encode(stop) if stop else None)
+    return _union(sources, is_map, keys, reducer, stream_ptrs, None)
+
+
+def prefix(sources, prefix, reduce=None):
+    """ Get the keys that start with a prefix in many sets or maps.
+
+    :param sources:     Sets or maps to search
+    :param prefix:      The prefix, of the key type of the sources
+    :param reduce:      Name of the function to combine the values of each
+                        key in maps with, see :py:meth:`rust_fst.Map.union`
+    :returns:           Iterator over the keys and their sources
+    """
+    sources, is_map, keys, reducer = _check_sources(sources, reduce)
+    stream_ptrs = _range_streams(sources, is_map,
+                                 prefix=sources[0]._encode(prefix))
+    return _union(sources, is_map, keys, reducer, stream_ptrs, None)
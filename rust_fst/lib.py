@@ -1,6 +1,6 @@
 import os
-import re
 import sys
+import threading
 from ._native import ffi, lib
 
 
@@ -24,36 +24,64 @@ class IoError(FstError):
     pass
 
 
+#: Kinds of errors reported by the native library in `Context.error_kind`,
+#: must be kept in sync with `ErrorKind` in `rust/src/util.rs`
+ERROR_IO = 1
+ERROR_TRANSDUCER = 2
+ERROR_FST_IO = 3
+ERROR_REGEX = 4
+ERROR_LEVENSHTEIN = 5
+ERROR_VALUE = 6
+
 EXCEPTION_MAP = {
-    'std::io::error::Error': OSError,
-    'fst::error::Error': FstError,
-    'fst::error::Error::Fst': TransducerError,
-    'fst_regex::error::Error': RegexError,
-    'fst_levenshtein::error::Error': LevenshteinError,
-    'fst::error::Error::Io': IoError,
-    'py::KeyError': KeyError
+    ERROR_IO: OSError,
+    ERROR_TRANSDUCER: TransducerError,
+    ERROR_FST_IO: IoError,
+    ERROR_REGEX: RegexError,
+    ERROR_LEVENSHTEIN: LevenshteinError,
+    ERROR_VALUE: ValueError,
 }
 
 
-def checked_call(fn, ctx, *args):
-    res = fn(ctx, *args)
-    if not ctx.has_error:
-        return res
-    type_str = ffi.string(ctx.error_type).decode('utf8')
-    if ctx.error_display != ffi.NULL:
-        msg = ffi.string(ctx.error_display).decode('utf8').replace('\n', ' ')
+_local = threading.local()
+
+
+def get_context():
+    """ Get the error context of the current thread.
+
+    Every thread has its own context, so concurrent calls can never observe
+    each other's errors.
+    """
+    ctx = getattr(_local, 'ctx', None)
+    if ctx is None:
+        ctx = _local.ctx = ffi.gc(lib.fst_context_new(), lib.fst_context_free)
+    return ctx
+
+
+def raise_error(ctx):
+    """ Raise the error stored in a context as a Python exception.
+
+    The error kind is reset, so the context can be used for further calls.
+    The message is only decoded here, i.e. when an error is actually raised.
+    """
+    kind = ctx.error_kind
+    ctx.error_kind = 0
+    if ctx.error_msg != ffi.NULL:
+        msg = (ffi.string(ctx.error_msg).decode('utf8', 'replace')
+               .replace('\n', ' '))
     else:
         msg = None
-    err_type = EXCEPTION_MAP.get(type_str)
-    if err_type is FstError:
-        if ctx.error_description != ffi.NULL:
-            desc_str = ffi.string(ctx.error_description).decode('utf8')
-        else:
-            desc_str = None
-        enum_val = re.match(r'(\w+)\(.*?\)', desc_str, re.DOTALL).group(1)
-        err_type = EXCEPTION_MAP.get("{}::{}".format(type_str, enum_val))
-        if err_type is None:
-            msg = "{}: {}".format(enum_val, msg)
-    if err_type is None:
-        err_type = FstError
-    raise err_type(msg)
+    raise EXCEPTION_MAP.get(kind, FstError)(msg)
+
+
+def checked_call(fn, *args):
+    """ Call a native function that takes an error context as its first
+        argument and raise the error it reports, if any.
+
+    The context of the calling thread is passed to the function.
+    """
+    ctx = get_context()
+    res = fn(ctx, *args)
+    if ctx.error_kind:
+        raise_error(ctx)
+    return res
@@ -1,12 +1,53 @@
+import numbers
 from contextlib import contextmanager
 
-from .common import (KeyStreamIterator, ValueStreamIterator,
-                     MapItemStreamIterator, MapOpItemStreamIterator)
+from . import automaton, extsort, pagecache
+from .common import (BATCH_SIZE, MAX_VALUE, KeyStreamIterator, ValueFns,
+                     ValueStreamIterator, MapItemStreamIterator,
+                     MapOpItemStreamIterator, chunked, contains_many,
+                     get_key_codec, new_bool_array, new_uint64_array,
+                     pack_keys, packed_chunks, pop_reducer, ranked_search,
+                     take_batch, take_bytes, build_side_index,
+                     load_side_index)
 from .lib import ffi, lib, checked_call
 
 
+def _encode_separator(sep):
+    if not isinstance(sep, bytes):
+        sep = sep.encode('utf8')
+    if not sep:
+        raise ValueError("Separator must not be empty.")
+    return sep
+
+
+def _pack_values(vals, num_keys):
+    vals = list(vals)
+    if len(vals) != num_keys:
+        raise ValueError("Got {} values for {} keys".format(
+            len(vals), num_keys))
+    return ffi.new("uint64_t[]", vals)
+
+
 class MapBuilder(object):
-    def insert(self, val):
+    def insert(self, key, val):
+        raise NotImplementedError
+
+    def insert_many(self, keys, vals):
+        """ Insert many items at once.
+
+        :param keys:        Iterable over the keys, in lexicographical order
+        :param vals:        Iterable over the values, one for each key
+        :raises ValueError: If the number of keys and values differ
+        """
+        raise NotImplementedError
+
+    def insert_file(self, src, sep='\t'):
+        raise NotImplementedError
+
+    def insert_records(self, src, start, end):
+        """ Insert the items of a byte range of a run file, as written by
+            :py:func:`rust_fst.extsort.write_records`.
+        """
         raise NotImplementedError
 
     def finish(self):
@@ -14,80 +55,175 @@ class MapBuilder(object):
 
 
 class FileMapBuilder(MapBuilder):
-    def __init__(self, path):
-        self._ctx = lib.fst_context_new()
-        self._writer_p = checked_call(
-            lib.fst_bufwriter_new, self._ctx, path.encode('utf8'))
-        self._builder_p = checked_call(
-            lib.fst_filemapbuilder_new, self._ctx, self._writer_p)
+    def __init__(self, path, keys='str'):
+        self._keys = keys
+        self._encode = get_key_codec(keys)[0]
+        self._writer_p = checked_call(lib.fst_bufwriter_new,
+                                      path.encode('utf8'))
+        self._builder_p = checked_call(lib.fst_filemapbuilder_new,
+                                       self._writer_p)
 
     def insert(self, key, val):
-        c_key = ffi.new("char[]", key.encode('utf8'))
+        c_key = self._encode(key)
         checked_call(lib.fst_filemapbuilder_insert,
-                     self._ctx, self._builder_p, c_key, val)
+                     self._builder_p, c_key, len(c_key), val)
+
+    def insert_many(self, keys, vals):
+        c_keys = [self._encode(k) for k in keys]
+        c_vals = _pack_values(vals, len(c_keys))
+        if not c_keys:
+            return
+        c_buf, c_offsets = pack_keys(c_keys)
+        checked_call(lib.fst_filemapbuilder_insert_many,
+                     self._builder_p, c_buf, c_offsets, c_vals, len(c_keys))
+
+    def insert_file(self, src, sep='\t'):
+        c_sep = _encode_separator(sep)
+        checked_call(lib.fst_filemapbuilder_insert_file,
+                     self._builder_p, src.encode('utf8'), c_sep, len(c_sep),
+                     self._keys == 'str')
+
+    def insert_records(self, src, start, end):
+        checked_call(lib.fst_filemapbuilder_insert_records,
+                     self._builder_p, src.encode('utf8'), start, end)
 
     def finish(self):
-        checked_call(lib.fst_filemapbuilder_finish,
-                     self._ctx, self._builder_p)
+        checked_call(lib.fst_filemapbuilder_finish, self._builder_p)
         lib.fst_bufwriter_free(self._writer_p)
-        lib.fst_context_free(self._ctx)
 
 
 class MemMapBuilder(MapBuilder):
-    def __init__(self):
-        self._ctx = lib.fst_context_new()
+    def __init__(self, keys='str'):
+        self._keys = keys
+        self._encode = get_key_codec(keys)[0]
         self._ptr = lib.fst_memmapbuilder_new()
         self._map_ptr = None
 
     def insert(self, key, val):
-        c_key = ffi.new("char[]", key.encode('utf8'))
-        checked_call(lib.fst_memmapbuilder_insert, self._ctx, self._ptr,
-                     c_key, val)
+        c_key = self._encode(key)
+        checked_call(lib.fst_memmapbuilder_insert, self._ptr,
+                     c_key, len(c_key), val)
+
+    def insert_many(self, keys, vals):
+        c_keys = [self._encode(k) for k in keys]
+        c_vals = _pack_values(vals, len(c_keys))
+        if not c_keys:
+            return
+        c_buf, c_offsets = pack_keys(c_keys)
+        checked_call(lib.fst_memmapbuilder_insert_many, self._ptr,
+                     c_buf, c_offsets, c_vals, len(c_keys))
+
+    def insert_file(self, src, sep='\t'):
+        c_sep = _encode_separator(sep)
+        checked_call(lib.fst_memmapbuilder_insert_file, self._ptr,
+                     src.encode('utf8'), c_sep, len(c_sep),
+                     self._keys == 'str')
+
+    def insert_records(self, src, start, end):
+        checked_call(lib.fst_memmapbuilder_insert_records, self._ptr,
+                     src.encode('utf8'), start, end)
 
     def finish(self):
-        self._map_ptr = checked_call(lib.fst_memmapbuilder_finish,
-                                     self._ctx, self._ptr)
-        lib.fst_context_free(self._ctx)
-        self._ctx = None
+        self._map_ptr = checked_call(lib.fst_memmapbuilder_finish, self._ptr)
         self._ptr = None
 
     def get_map(self):
         if self._map_ptr is None:
             raise ValueError("The builder has to be finished first.")
-        return Map(_pointer=self._map_ptr)
+        return Map(keys=self._keys, _pointer=self._map_ptr)
 
 
 class OpBuilder(object):
-    def __init__(self, map_ptr):
+    def __init__(self, map_ptr, keys='str'):
         # NOTE: No need for `ffi.gc`, since the struct will be free'd
         #       once we call union/intersection/difference
         self._ptr = lib.fst_map_make_opbuilder(map_ptr)
+        self._keys = keys
 
     def push(self, map_ptr):
         lib.fst_map_opbuilder_push(self._ptr, map_ptr)
 
-    def union(self):
+    def _reduce(self, reduce_fn, stream_ptr, reducer):
+        """ Combine the values of each item of an operation stream, which is
+            consumed, with the reducer of the passed code.
+        """
+        return MapItemStreamIterator(
+            reduce_fn(stream_ptr, reducer), lib.fst_map_reducedstream_next,
+            lib.fst_map_reducedstream_free,
+            count_fn=lib.fst_map_reducedstream_count,
+            batch_fn=lib.fst_map_reducedstream_batch, keys=self._keys,
+            value_fns=ValueFns(lib.fst_map_reducedstream_values,
+                               lib.fst_map_reducedstream_stats,
+                               lib.fst_map_reducedstream_histogram))
+
+    def union(self, reducer=None):
         stream_ptr = lib.fst_map_opbuilder_union(self._ptr)
+        if reducer is not None:
+            return self._reduce(lib.fst_map_union_reduce, stream_ptr, reducer)
         return MapOpItemStreamIterator(
-                stream_ptr, lib.fst_map_union_next, lib.fst_map_union_free)
+                stream_ptr, lib.fst_map_union_next, lib.fst_map_union_free,
+                count_fn=lib.fst_map_union_count,
+                batch_fn=lib.fst_map_union_batch, keys=self._keys)
 
-    def intersection(self):
+    def intersection(self, reducer=None):
         stream_ptr = lib.fst_map_opbuilder_intersection(self._ptr)
+        if reducer is not None:
+            return self._reduce(lib.fst_map_intersection_reduce, stream_ptr,
+                                reducer)
         return MapOpItemStreamIterator(
                 stream_ptr, lib.fst_map_intersection_next,
-                lib.fst_map_intersection_free)
+                lib.fst_map_intersection_free,
+                count_fn=lib.fst_map_intersection_count,
+                batch_fn=lib.fst_map_intersection_batch, keys=self._keys)
 
-    def difference(self):
+    def difference(self, reducer=None):
         stream_ptr = lib.fst_map_opbuilder_difference(self._ptr)
+        if reducer is not None:
+            return self._reduce(lib.fst_map_difference_reduce, stream_ptr,
+                                reducer)
         return MapOpItemStreamIterator(
             stream_ptr, lib.fst_map_difference_next,
-            lib.fst_map_difference_free)
+            lib.fst_map_difference_free,
+            count_fn=lib.fst_map_difference_count,
+            batch_fn=lib.fst_map_difference_batch, keys=self._keys)
 
-    def symmetric_difference(self):
+    def symmetric_difference(self, reducer=None):
         stream_ptr = lib.fst_map_opbuilder_symmetricdifference(self._ptr)
+        if reducer is not None:
+            return self._reduce(lib.fst_map_symmetricdifference_reduce,
+                                stream_ptr, reducer)
         return MapOpItemStreamIterator(
             stream_ptr, lib.fst_map_symmetricdifference_next,
-            lib.fst_map_symmetricdifference_free)
+            lib.fst_map_symmetricdifference_free,
+            count_fn=lib.fst_map_symmetricdifference_count,
+            batch_fn=lib.fst_map_symmetricdifference_batch, keys=self._keys)
+
+    def _reduce_into(self, reduce_fn, stream_ptr, reducer, path):
+        """ Combine the values of each item of an operation stream, which is
+            consumed, and write the items into a new map file.
+        """
+        checked_call(lib.fst_map_reducedstream_into,
+                     reduce_fn(stream_ptr, reducer), path.encode('utf8'))
+
+    def union_into(self, path, reducer):
+        self._reduce_into(lib.fst_map_union_reduce,
+                          lib.fst_map_opbuilder_union(self._ptr), reducer,
+                          path)
+
+    def intersection_into(self, path, reducer):
+        self._reduce_into(lib.fst_map_intersection_reduce,
+                          lib.fst_map_opbuilder_intersection(self._ptr),
+                          reducer, path)
+
+    def difference_into(self, path, reducer):
+        self._reduce_into(lib.fst_map_difference_reduce,
+                          lib.fst_map_opbuilder_difference(self._ptr),
+                          reducer, path)
+
+    def symmetric_difference_into(self, path, reducer):
+        self._reduce_into(lib.fst_map_symmetricdifference_reduce,
+                          lib.fst_map_opbuilder_symmetricdifference(self._ptr),
+                          reducer, path)
 
 
 class Map(object):
@@ -100,7 +236,9 @@ class Map(object):
 
     To build a map, use the :py:meth:`from_iter` classmethod and pass it an
     iterator and (optionally) a path where the map should be stored. If the
-    latter is missing, the map will be built in memory.
+    latter is missing, the map will be built in memory. A map can be
+    serialized with :py:meth:`to_bytes` and loaded without copying from any
+    buffer with :py:meth:`from_buffer`.
 
     In addition to querying the map for single keys, the following operations
     are supported:
@@ -117,70 +255,294 @@ class Map(object):
 
     * Once constructed, a Map can never be modified.
     * Maps must be built with iterators of lexicographically sorted
-      (str/unicode, int) tuples, where the integer value must be positive.
+      (str/unicode, int) tuples, where the integer value must be positive,
+      unless they are built with :py:meth:`from_unsorted`
+
+    Maps can also use raw byte strings as keys instead of unicode strings. To
+    do so, pass `keys='bytes'` when building and opening the map. All keys
+    passed to and returned from the map will then be `bytes` objects that may
+    contain arbitrary (including non-UTF8 and NUL) bytes and are never
+    transcoded. Search terms and regular expressions are unicode strings in
+    both modes.
+
+    Maps are safe to share between threads: lookups, searches, range queries,
+    set operations and iteration can all be run concurrently on the same
+    map, since errors are reported through per-thread state. The native
+    calls release the GIL. Builders and the iterators returned by the
+    queries must not be shared between threads, though.
     """
 
     @staticmethod
     @contextmanager
-    def build(path=None):
+    def build(path=None, keys='str'):
         """ Context manager to build a new map.
 
         Call :py:meth:`insert` on the returned builder object to insert
         new items into the mapp. Keep in mind that insertion must happen in
         lexicographical order, otherwise an exception will be thrown.
 
+        When inserting many items, prefer :py:meth:`insert_many` with chunks
+        of keys and values, which only crosses the FFI boundary once per
+        chunk.
+
         :param path:    Path to build mapp in, or `None` if set should be built
                         in memory
+        :param keys:    Type of the keys, `'str'` for unicode strings or
+                        `'bytes'` for byte strings
         :returns:       :py:class:`MapBuilder`
         """
         if path:
-            builder = FileMapBuilder(path)
+            builder = FileMapBuilder(path, keys=keys)
         else:
-            builder = MemMapBuilder()
+            builder = MemMapBuilder(keys=keys)
         yield builder
         builder.finish()
 
     @classmethod
-    def from_iter(cls, it, path=None):
+    def from_iter(cls, it, path=None, batch_size=BATCH_SIZE, keys='str'):
         """ Build a new map from an iterator.
 
         Keep in mind that the iterator must return lexicographically sorted
         (key, value) pairs, where the keys are unicode strings and the values
         unsigned integers.
 
-        :param it:      Iterator to build map with
-        :type it:       iterator over (str/unicode, int) pairs, where int >= 0
-        :param path:    Path to build map in, or `None` if set should be built
+        :param it:          Iterator to build map with
+        :type it:           iterator over (str/unicode, int) pairs, where
+                            int >= 0
+        :param path:        Path to build map in, or `None` if set should be
+                            built in memory
+        :param batch_size:  Number of items to insert per native call
+        :param keys:        Type of the keys, `'str'` for unicode strings or
+                            `'bytes'` for byte strings
+        :returns:           The finished map
+        :rtype:             :py:class:`Map`
+        """
+        if isinstance(it, dict):
+            it = sorted(it.items(), key=lambda x: x[0])
+        with cls.build(path, keys=keys) as builder:
+            for chunk in chunked(it, batch_size):
+                chunk_keys, chunk_vals = zip(*chunk)
+                builder.insert_many(chunk_keys, chunk_vals)
+        if path:
+            return cls(path=path, keys=keys)
+        else:
+            return builder.get_map()
+
+    @classmethod
+    def from_file(cls, src, path=None, sep='\t', keys='str'):
+        """ Build a new map from a text file with one item per line.
+
+        Every line consists of a key and an unsigned integer value, delimited
+        by `sep`. Lines are split at the last occurrence of the separator, so
+        keys may contain it. The file is read and parsed by the native library
+        without any per-item work in Python, which makes this the fastest way
+        to build a map from sorted items on disk. Lines may be terminated by
+        `\\n` or `\\r\\n` and empty lines are skipped. Like with
+        :py:meth:`from_iter`, the keys must be in lexicographical order.
+
+        Errors are reported with the number of the offending line.
+
+        :param src:     Path to the text file with the items
+        :param path:    Path to build map in, or `None` if map should be built
                         in memory
+        :param sep:     Separator between key and value
+        :param keys:    Type of the keys. For `'str'`, the keys in the file
+                        must be UTF-8 encoded, for `'bytes'` they are used
+                        as-is
         :returns:       The finished map
         :rtype:         :py:class:`Map`
         """
-        if isinstance(it, dict):
-            it = sorted(it.items(), key=lambda x: x[0])
-        with cls.build(path) as builder:
-            for key, val in it:
-                builder.insert(key, val)
+        with cls.build(path, keys=keys) as builder:
+            builder.insert_file(src, sep=sep)
         if path:
-            return cls(path=path)
+            return cls(path=path, keys=keys)
         else:
             return builder.get_map()
 
-    def __init__(self, path=None, _pointer=None):
+    @classmethod
+    def from_unsorted(cls, it, path=None, keys='str', duplicates='last',
+                      memory_limit=extsort.DEFAULT_MEMORY_LIMIT, tmpdir=None):
+        """ Build a new map from an iterator over (key, value) pairs in
+            arbitrary order.
+
+        The items are sorted in runs of at most `memory_limit` bytes, which
+        are spilled to a temporary directory and merged into the map if the
+        input does not fit into a single run.
+
+        Values of duplicate keys are combined according to the `duplicates`
+        policy:
+
+        * `'first'`/`'last'`: Keep the value that came first/last in the input
+        * `'sum'`: Keep the sum of all values, capped at `2 ** 64 - 1`
+        * `'min'`/`'max'`: Keep the smallest/largest value
+
+        :param it:              Iterator to build map with
+        :type it:               iterator over (key, int) pairs, where int >= 0
+        :param path:            Path to build map in, or `None` if map should
+                                be built in memory
+        :param keys:            Type of the keys, `'str'` for unicode strings
+                                or `'bytes'` for byte strings
+        :param duplicates:      Policy for values of duplicate keys
+        :param memory_limit:    Approximate memory budget in bytes for sorting
+        :param tmpdir:          Directory to spill sorted runs to, defaults to
+                                the system's temporary directory
+        :returns:               The finished map
+        :rtype:                 :py:class:`Map`
+        """
+        if isinstance(it, dict):
+            it = it.items()
+        return cls.from_iter(
+            extsort.sort_items(it, keys=keys, duplicates=duplicates,
+                               memory_limit=memory_limit, tmpdir=tmpdir),
+            path=path, keys=keys)
+
+    @classmethod
+    def from_buffer(cls, obj, keys='str'):
+        """ Load a map from an object that supports the buffer protocol.
+
+        The map uses the memory of the buffer directly instead of copying
+        it, which allows embedding maps in other file formats or sharing a
+        single copy between processes, e.g. with `mmap.mmap` or
+        `multiprocessing.shared_memory`. A reference to `obj` is kept for
+        the lifetime of the map. The contents of the buffer must not be
+        modified while the map is in use.
+
+        :param obj:     Object with the serialized map, e.g. the result
+                        of :py:meth:`to_bytes`
+        :param keys:    Type of the keys, `'str'` for unicode strings or
+                        `'bytes'` for byte strings
+        :returns:       The loaded map
+        :rtype:         :py:class:`Map`
+        """
+        c_buf = ffi.from_buffer(obj)
+        ptr = checked_call(lib.fst_map_from_buffer, c_buf, len(c_buf))
+        return cls(None, keys=keys, _pointer=ptr, _buffer=c_buf)
+
+    def __init__(self, path=None, keys='str', prefetch='none',
+                 access=None, _pointer=None, _buffer=None):
         """ Load a map from a given file.
 
-        :param path:    Path to map on disk
+        The file is memory-mapped and by default only read from disk as it
+        is accessed, so the first queries after opening may be slow. Use
+        `prefetch` to load it ahead of time and `access` to tell the
+        operating system how the map will be queried.
+
+        :param path:        Path to map on disk
+        :param keys:        Type of the keys, `'str'` for unicode strings or
+                            `'bytes'` for byte strings
+        :param prefetch:    `'none'` to load the file lazily, `'full'` to
+                            load it completely before returning or `'async'`
+                            to load it in a background thread, see
+                            :py:meth:`warmup`
+        :param access:      Expected access pattern, `'random'`,
+                            `'sequential'` or `'normal'`, passed to the
+                            operating system with `madvise` where supported
         """
-        self._ctx = ffi.gc(lib.fst_context_new(), lib.fst_context_free)
-        if path:
-            s = checked_call(lib.fst_map_open, self._ctx,
+        self._keys = keys
+        self._encode, self._decode = get_key_codec(keys)
+        pagecache.check_options(prefetch, access)
+        if path and pagecache.needs_mapping(prefetch, access):
+            _buffer = ffi.from_buffer(
+                pagecache.open_mapping(path, prefetch, access))
+            s = checked_call(lib.fst_map_from_buffer, _buffer, len(_buffer))
+        elif path:
+            s = checked_call(lib.fst_map_open,
                              ffi.new("char[]", path.encode('utf8')))
         else:
             s = _pointer
         self._ptr = ffi.gc(s, lib.fst_map_free)
+        # Buffer that the map borrows its data from, if it was loaded with
+        # `from_buffer` or mapped with hints
+        self._buffer = _buffer
+        self._path = path
+        # Indexes for `top_completions` and `rank`/`select`, built or loaded
+        # on demand
+        self._completions = None
+        self._ranks = None
+        if prefetch == 'async':
+            self.warmup()
+
+    def warmup(self):
+        """ Load the map into memory in a background thread.
+
+        The file is read sequentially into the page cache without holding
+        the GIL, after which the pages of a mapping made with `prefetch` or
+        `access` hints are faulted in. Queries can be run while the warmup
+        is in progress.
+
+        :returns:   The started `threading.Thread`, join it to wait for the
+                    warmup to finish
+        """
+        buf = ffi.buffer(self._buffer) if self._buffer is not None else None
+        return pagecache.warmup(path=self._path, buf=buf)
 
     def __contains__(self, val):
-        return lib.fst_map_contains(
-            self._ptr, ffi.new("char[]", val.encode('utf8')))
+        key = self._encode(val)
+        return lib.fst_map_contains(self._ptr, key, len(key))
+
+    def contains_many(self, keys):
+        """ Check many keys for membership at once.
+
+        This is considerably faster than checking the keys one by one, since
+        the lookups are done in batches by the native library.
+
+        :param keys:    Sequence of keys, e.g. a list or a NumPy string or
+                        object array
+        :returns:       A NumPy `bool` array with the result for each key, or
+                        a `bytearray` with `0`/`1` bytes if NumPy is not
+                        installed
+        """
+        return contains_many(lib.fst_map_contains_many, self._ptr, keys,
+                             self._encode)
+
+    def get_many(self, keys, default=0, mask=False):
+        """ Get the values for many keys at once.
+
+        The lookups are done in batches by the native library. Missing keys
+        do not raise an exception, but get the `default` value, so the cost
+        of a lookup does not depend on whether the key is in the map. Since
+        any value can also be stored in the map, pass `mask=True` to tell
+        missing keys apart from keys with the default value.
+
+        :param keys:        Sequence of keys, e.g. a list or a NumPy string
+                            or object array
+        :param default:     Value for keys that are not in the map, an
+                            integer between 0 and `2 ** 64 - 1`
+        :param mask:        Whether to also return a mask of the keys that
+                            were found
+        :returns:           A NumPy `uint64` array with the value for each
+                            key, or an `array.array` if NumPy is not
+                            installed. If `mask` is set, a tuple of the
+                            values and a boolean array that is true for the
+                            keys that were found, see
+                            :py:meth:`contains_many`.
+        :raises TypeError:  If `default` is not an integer
+        :raises ValueError: If `default` does not fit into an unsigned 64
+                            bit integer
+        """
+        if not isinstance(default, numbers.Integral):
+            raise TypeError("default must be an integer, not {!r}".format(
+                default))
+        if not 0 <= default <= MAX_VALUE:
+            raise ValueError(
+                "default must be between 0 and 2**64 - 1, not {!r}".format(
+                    default))
+        if not hasattr(keys, '__len__'):
+            keys = list(keys)
+        values = new_uint64_array(len(keys))
+        found = new_bool_array(len(keys)) if mask else None
+        if len(keys):
+            c_values = ffi.cast("uint64_t*", ffi.from_buffer(values))
+            c_found = ffi.from_buffer(found) if mask else None
+            for start, c_buf, c_offsets, num_keys in packed_chunks(
+                    keys, self._encode):
+                lib.fst_map_get_many(
+                    self._ptr, c_buf, c_offsets, num_keys, default,
+                    c_values + start,
+                    c_found + start if mask else ffi.NULL)
+        if mask:
+            return values, found
+        return values
 
     def __getitem__(self, key):
         """ Get the value for a key or a range of (key, value) pairs.
@@ -194,7 +556,7 @@ class Map(object):
             return items whose key begins with 'a' or 'b', but **not** 'c'.
 
         :param key:     The key to retrieve the value for or a range of
-                        unicode strings
+                        keys
         :returns:       The value or an iterator over matching items
         """
         if isinstance(key, slice):
@@ -204,17 +566,47 @@ class Map(object):
                     "Start key must be lexicographically smaller than stop.")
             sb_ptr = lib.fst_map_streambuilder_new(self._ptr)
             if s.start:
-                c_start = ffi.new("char[]", s.start.encode('utf8'))
-                sb_ptr = lib.fst_map_streambuilder_add_ge(sb_ptr, c_start)
+                start = self._encode(s.start)
+                sb_ptr = lib.fst_map_streambuilder_add_ge(sb_ptr, start,
+                                                          len(start))
             if s.stop:
-                c_stop = ffi.new("char[]", s.stop.encode('utf8'))
-                sb_ptr = lib.fst_map_streambuilder_add_lt(sb_ptr, c_stop)
+                stop = self._encode(s.stop)
+                sb_ptr = lib.fst_map_streambuilder_add_lt(sb_ptr, stop,
+                                                          len(stop))
             stream_ptr = lib.fst_map_streambuilder_finish(sb_ptr)
+            value_fns = ValueFns(lib.fst_mapstream_values,
+                                 lib.fst_mapstream_stats,
+                                 lib.fst_mapstream_histogram)
             return MapItemStreamIterator(stream_ptr, lib.fst_mapstream_next,
-                                         lib.fst_mapstream_free)
+                                         lib.fst_mapstream_free,
+                                         count_fn=lib.fst_mapstream_count,
+                                         batch_fn=lib.fst_mapstream_batch,
+                                         value_fns=value_fns,
+                                         keys=self._keys)
         else:
-            return checked_call(lib.fst_map_get, self._ctx, self._ptr,
-                                ffi.new("char[]", key.encode('utf8')))
+            val_p = ffi.new("uint64_t*")
+            c_key = self._encode(key)
+            if not lib.fst_map_get(self._ptr, c_key, len(c_key), val_p):
+                raise KeyError(key)
+            return val_p[0]
+
+    def get(self, key, default=None):
+        """ Get the value for a key, or a default value if it is not in the
+            map.
+
+        Unlike :py:meth:`__getitem__`, missing keys are not treated as an
+        error, which makes this the cheapest way to look up keys that are
+        frequently missing.
+
+        :param key:     The key to retrieve the value for
+        :param default: Value to return if the key is not in the map
+        :returns:       The value for the key or `default`
+        """
+        val_p = ffi.new("uint64_t*")
+        c_key = self._encode(key)
+        if lib.fst_map_get(self._ptr, c_key, len(c_key), val_p):
+            return val_p[0]
+        return default
 
     def __iter__(self):
         return self.keys()
@@ -222,23 +614,82 @@ class Map(object):
     def __len__(self):
         return int(lib.fst_map_len(self._ptr))
 
+    def to_bytes(self):
+        """ Serialize the map.
+
+        The result has the same format as a map file on disk and can be
+        loaded again with :py:meth:`from_buffer`.
+
+        :returns:   The serialized map
+        :rtype:     bytes
+        """
+        return take_bytes(lib.fst_map_to_bytes, self._ptr)
+
     def keys(self):
         """ Get an iterator over all keys in the map. """
         stream_ptr = lib.fst_map_keys(self._ptr)
         return KeyStreamIterator(stream_ptr, lib.fst_mapkeys_next,
-                                 lib.fst_mapkeys_free)
+                                 lib.fst_mapkeys_free,
+                                 count_fn=lib.fst_mapkeys_count,
+                                 batch_fn=lib.fst_mapkeys_batch,
+                                 keys=self._keys)
 
     def values(self):
         """ Get an iterator over all values in the map. """
         stream_ptr = lib.fst_map_values(self._ptr)
+        value_fns = ValueFns(lib.fst_mapvalues_values,
+                             lib.fst_mapvalues_stats,
+                             lib.fst_mapvalues_histogram)
         return ValueStreamIterator(stream_ptr, lib.fst_mapvalues_next,
-                                   lib.fst_mapvalues_free, ctx_ptr=self._ctx)
+                                   lib.fst_mapvalues_free,
+                                   batch_fn=lib.fst_mapvalues_batch,
+                                   value_fns=value_fns)
 
     def items(self):
         """ Get an iterator over all (key, value) pairs in the map. """
         stream_ptr = lib.fst_map_stream(self._ptr)
+        value_fns = ValueFns(lib.fst_mapstream_values,
+                             lib.fst_mapstream_stats,
+                             lib.fst_mapstream_histogram)
         return MapItemStreamIterator(stream_ptr, lib.fst_mapstream_next,
-                                     lib.fst_mapstream_free)
+                                     lib.fst_mapstream_free,
+                                     count_fn=lib.fst_mapstream_count,
+                                     batch_fn=lib.fst_mapstream_batch,
+                                     value_fns=value_fns,
+                                     keys=self._keys)
+
+    def values_array(self, start=None, stop=None):
+        """ Get the values in a range of the map as an array.
+
+        The values are copied natively in a single pass. Other reductions,
+        e.g. sums or histograms, are available on the iterators returned by
+        :py:meth:`values`, slices and searches, see
+        :py:class:`rust_fst.common.ValueReductionMixin`. For example,
+        `m['a':'b'].sum()` or `m.search_re(pattern).values_array()`.
+
+        :param start:   Smallest key to include, defaults to the first key
+        :param stop:    Key to stop before (exclusive), defaults to the end of
+                        the map
+        :returns:       A NumPy `uint64` array if NumPy is installed,
+                        otherwise an `array.array`
+        """
+        if start is None and stop is None:
+            return self.values().values_array()
+        return self[start:stop].values_array()
+
+    def to_arrays(self, start=None, stop=None):
+        """ Get the items in a range of the map as columns.
+
+        See :py:meth:`rust_fst.common.StreamIterator.to_arrays` for the
+        format. Query results can be exported with their iterator's
+        `to_arrays` method, e.g. `m.search_re(pattern).to_arrays()`.
+
+        :param start:   Smallest key to include, defaults to the first key
+        :param stop:    Key to stop before (exclusive), defaults to the end of
+                        the map
+        :rtype:         :py:class:`rust_fst.common.Arrays`
+        """
+        return self[start:stop].to_arrays()
 
     def search_re(self, pattern):
         """ Search the map with a regular expression.
@@ -258,42 +709,250 @@ class Map(object):
         For background on these limitations, consult the documentation of
         the Rust crate: http://burntsushi.net/rustdoc/fst/struct.Regex.html
 
-        :param pattern:     A regular expression
+        Compiled automata are looked up in :py:data:`rust_fst.automaton.cache`
+        to avoid recompiling the pattern on repeated searches.
+
+        :param pattern:     A regular expression or a compiled
+                            :py:class:`rust_fst.Regex`
         :returns:           An iterator over all items with matching keys in
                             the set
         :rtype:             :py:class:`MapItemStreamIterator`
         """
-        re_ptr = checked_call(
-            lib.fst_regex_new, self._ctx,
-            ffi.new("char[]", pattern.encode('utf8')))
-        stream_ptr = lib.fst_map_regexsearch(self._ptr, re_ptr)
+        regex = automaton.get_regex(pattern)
+        stream_ptr = lib.fst_map_regexsearch(self._ptr, regex._ptr)
+        value_fns = ValueFns(lib.fst_map_regexstream_values,
+                             lib.fst_map_regexstream_stats,
+                             lib.fst_map_regexstream_histogram)
         return MapItemStreamIterator(stream_ptr, lib.fst_map_regexstream_next,
-                                     lib.fst_map_regexstream_free, re_ptr,
-                                     lib.fst_regex_free)
+                                     lib.fst_map_regexstream_free, regex,
+                                     count_fn=lib.fst_map_regexstream_count,
+                                     batch_fn=lib.fst_map_regexstream_batch,
+                                     value_fns=value_fns,
+                                     keys=self._keys)
 
-    def search(self, term, max_dist):
+    def search(self, term, max_dist=None):
         """ Search the map with a Levenshtein automaton.
 
-        :param term:        The search term
-        :param max_dist:    The maximum edit distance for search results
+        Compiled automata are looked up in :py:data:`rust_fst.automaton.cache`
+        to avoid recompiling them on repeated searches.
+
+        :param term:        The search term or a compiled
+                            :py:class:`rust_fst.Levenshtein`
+        :param max_dist:    The maximum edit distance for search results,
+                            must be omitted for a compiled automaton
         :returns:           Matching (key, value) items in the map
         :rtype:             :py:class:`MapItemStreamIterator`
         """
-        lev_ptr = checked_call(
-            lib.fst_levenshtein_new, self._ctx,
-            ffi.new("char[]", term.encode('utf8')), max_dist)
-        stream_ptr = lib.fst_map_levsearch(self._ptr, lev_ptr)
+        lev = automaton.get_levenshtein(term, max_dist)
+        stream_ptr = lib.fst_map_levsearch(self._ptr, lev._ptr)
+        value_fns = ValueFns(lib.fst_map_levstream_values,
+                             lib.fst_map_levstream_stats,
+                             lib.fst_map_levstream_histogram)
         return MapItemStreamIterator(stream_ptr, lib.fst_map_levstream_next,
-                                     lib.fst_map_levstream_free, lev_ptr,
-                                     lib.fst_levenshtein_free)
+                                     lib.fst_map_levstream_free, lev,
+                                     count_fn=lib.fst_map_levstream_count,
+                                     batch_fn=lib.fst_map_levstream_batch,
+                                     value_fns=value_fns,
+                                     keys=self._keys)
+
+    def query(self, query):
+        """ Search the map with a composite query.
+
+        All terms and bounds of the query are evaluated together in a single
+        traversal of the map, see :py:class:`rust_fst.Query`.
+
+        :param query:   A :py:class:`rust_fst.Query`
+        :returns:       Matching (key, value) items in the map
+        :rtype:         :py:class:`MapItemStreamIterator`
+        """
+        c_query, borrowed = query._compile(self._encode)
+        stream_ptr = lib.fst_map_querysearch(self._ptr, c_query)
+        value_fns = ValueFns(lib.fst_map_querystream_values,
+                             lib.fst_map_querystream_stats,
+                             lib.fst_map_querystream_histogram)
+        return MapItemStreamIterator(stream_ptr,
+                                     lib.fst_map_querystream_next,
+                                     lib.fst_map_querystream_free,
+                                     (c_query, borrowed),
+                                     count_fn=lib.fst_map_querystream_count,
+                                     batch_fn=lib.fst_map_querystream_batch,
+                                     value_fns=value_fns,
+                                     keys=self._keys)
+
+    def search_ranked(self, term, max_dist=None, k=None):
+        """ Search the map with a Levenshtein automaton and rank the
+            matches by their edit distance to the term.
+
+        Matches are ordered by edit distance, then by descending value and
+        finally by key. The distances are computed and the top `k` matches
+        are selected natively, so only the returned matches are passed to
+        Python.
+
+        :param term:        The search term or a compiled
+                            :py:class:`rust_fst.Levenshtein`
+        :param max_dist:    The maximum edit distance for search results,
+                            must be omitted for a compiled automaton
+        :param k:           Maximum number of matches to return, defaults to
+                            all matches
+        :returns:           List of `(key, value, distance)` tuples
+        """
+        lev = automaton.get_levenshtein(term, max_dist)
+        if k is None:
+            k = len(self)
+        return ranked_search(lib.fst_map_levsearch_ranked, self._ptr, lev, k,
+                             self._decode)
+
+    def prefix(self, prefix):
+        """ Get an iterator over all items whose key starts with a prefix.
+
+        The range of matching keys is computed natively on the encoded
+        prefix, which is also correct for non-ASCII input.
+
+        :param prefix:  The prefix, of the map's key type
+        :returns:       An iterator over the matching (key, value) pairs
+        :rtype:         :py:class:`MapItemStreamIterator`
+        """
+        prefix = self._encode(prefix)
+        sb_ptr = lib.fst_map_streambuilder_new(self._ptr)
+        sb_ptr = lib.fst_map_streambuilder_add_prefix(sb_ptr, prefix,
+                                                      len(prefix))
+        stream_ptr = lib.fst_map_streambuilder_finish(sb_ptr)
+        value_fns = ValueFns(lib.fst_mapstream_values,
+                             lib.fst_mapstream_stats,
+                             lib.fst_mapstream_histogram)
+        return MapItemStreamIterator(stream_ptr, lib.fst_mapstream_next,
+                                     lib.fst_mapstream_free,
+                                     count_fn=lib.fst_mapstream_count,
+                                     batch_fn=lib.fst_mapstream_batch,
+                                     value_fns=value_fns,
+                                     keys=self._keys)
+
+    def count_prefix(self, prefix):
+        """ Count the keys that start with a prefix.
+
+        Use the `count()` method of the iterators returned by ranges,
+        searches and set operations to count other queries.
+
+        :param prefix:  The prefix, of the map's key type
+        :rtype:         int
+        """
+        return self.prefix(prefix).count()
+
+    def build_completion_index(self, path=None):
+        """ Build the index used by :py:meth:`top_completions`.
+
+        The index stores the highest value below every node of the
+        transducer. Building it visits every node once, so for large maps
+        pass a `path` to store it in a side file and load it with
+        :py:meth:`load_completion_index` the next time the map is opened.
+
+        :param path:    Path to store the index at
+        """
+        self._completions = build_side_index(
+            lib.fst_map_completionindex_build, lib.fst_completionindex_save,
+            lib.fst_completionindex_free, self._ptr, path)
+
+    def load_completion_index(self, path):
+        """ Load an index built with :py:meth:`build_completion_index`.
+
+        :param path:        Path of the stored index
+        :raises ValueError: If the index was built for a different map
+        """
+        self._completions = load_side_index(
+            lib.fst_completionindex_open, lib.fst_completionindex_matches,
+            lib.fst_completionindex_free, self._ptr, path)
+
+    def top_completions(self, prefix, k):
+        """ Get the `k` items with the highest values whose keys start with a
+            prefix.
+
+        The items are found by a best-first traversal of the transducer
+        guided by the completion index, so the cost depends on `k` and the
+        length of the keys rather than on the number of keys with the
+        prefix. If no index was built or loaded, one is built in memory on
+        the first call, see :py:meth:`build_completion_index`.
+
+        :param prefix:  The prefix, of the map's key type
+        :param k:       Maximum number of items to return
+        :returns:       List of (key, value) pairs ordered by descending
+                        value and then by key
+        """
+        if self._completions is None:
+            self.build_completion_index()
+        prefix = self._encode(prefix)
+        return take_batch(self._decode, lib.fst_map_top_completions,
+                          self._ptr, self._completions, prefix, len(prefix),
+                          k)
+
+    def build_rank_index(self, path=None):
+        """ Build the index used by :py:meth:`rank` and :py:meth:`select`.
+
+        The index stores the number of keys below the nodes of the
+        transducer that lead to many keys. Building it visits every node
+        once, so for large maps pass a `path` to store it in a side file
+        and load it with :py:meth:`load_rank_index` the next time the map
+        is opened.
+
+        :param path:    Path to store the index at
+        """
+        self._ranks = build_side_index(
+            lib.fst_map_rankindex_build, lib.fst_rankindex_save,
+            lib.fst_rankindex_free, self._ptr, path)
+
+    def load_rank_index(self, path):
+        """ Load an index built with :py:meth:`build_rank_index`.
+
+        :param path:        Path of the stored index
+        :raises ValueError: If the index was built for a different map
+        """
+        self._ranks = load_side_index(
+            lib.fst_rankindex_open, lib.fst_map_rankindex_matches,
+            lib.fst_rankindex_free, self._ptr, path)
+
+    def rank(self, key):
+        """ Get the number of keys in the map that are lexicographically
+            smaller than a key.
+
+        For a key in the map, this is its position in iteration order,
+        i.e. a dense id in `range(len(self))`. The cost grows with the length
+        of the key, not with its position. If no rank index was built or
+        loaded, one is built in memory on the first call, see
+        :py:meth:`build_rank_index`.
+
+        :param key:     The key, of the map's key type
+        :rtype:         int
+        """
+        if self._ranks is None:
+            self.build_rank_index()
+        key = self._encode(key)
+        return lib.fst_map_rank(self._ptr, self._ranks, key, len(key))
+
+    def select(self, idx):
+        """ Get the (key, value) pair at a position in iteration order.
+
+        This is the inverse of :py:meth:`rank`, see there for the costs.
+
+        :param idx:         The position, negative values count from the end
+        :returns:           The (key, value) pair
+        :raises IndexError: If the position is out of range
+        """
+        num_keys = len(self)
+        if idx < 0:
+            idx += num_keys
+        if not 0 <= idx < num_keys:
+            raise IndexError("Map index out of range")
+        if self._ranks is None:
+            self.build_rank_index()
+        return take_batch(self._decode, lib.fst_map_select, self._ptr,
+                          self._ranks, idx)[0]
 
     def _make_opbuilder(self, *others):
-        opbuilder = OpBuilder(self._ptr)
+        opbuilder = OpBuilder(self._ptr, keys=self._keys)
         for oth in others:
             opbuilder.push(oth._ptr)
         return opbuilder
 
-    def union(self, *others):
+    def union(self, *others, **kwargs):
         """ Get an iterator over the items in the union of this map and others.
 
         The iterator will return pairs of `(key, [IndexedValue])`, where
@@ -301,13 +960,30 @@ class Map(object):
         maps, represented as a tuple of the map index and the value in the
         map.
 
+        With `reduce`, the values of each key are combined into one in the
+        native library and the iterator returns `(key, value)` pairs, like
+        :py:meth:`items`:
+
+        - `'sum'`: Sum of the values, capped at `2 ** 64 - 1`
+        - `'min'`, `'max'`: Smallest or largest value
+        - `'first'`, `'last'`: Value in the map with the lowest or highest
+          index
+        - `'count'`: Number of maps that contain the key
+
+        Only iterators over reduced results support
+        :py:meth:`~rust_fst.common.StreamIterator.to_arrays`, since the
+        unreduced results have a variable number of values per key.
+
         :param others:  List of :py:class:`Map` objects
+        :param reduce:  Name of the function to combine the values of each
+                        key with, if any
         :returns:       Iterator over all items in all maps in lexicographical
                         order
         """
-        return self._make_opbuilder(*others).union()
+        reducer = pop_reducer(kwargs)
+        return self._make_opbuilder(*others).union(reducer)
 
-    def intersection(self, *others):
+    def intersection(self, *others, **kwargs):
         """ Get an iterator over the items in the intersection of this map and
             others.
 
@@ -316,13 +992,19 @@ class Map(object):
         maps, represented as a tuple of the map index and the value in the
         map.
 
+        See :py:meth:`union` for the values of `reduce` and why only reduced
+        results can be exported with `to_arrays()`.
+
         :param others:  List of :py:class:`Map` objects
+        :param reduce:  Name of the function to combine the values of each
+                        key with, if any
         :returns:       Iterator over all items whose key exists in all of the
                         passed maps in lexicographical order
         """
-        return self._make_opbuilder(*others).intersection()
+        reducer = pop_reducer(kwargs)
+        return self._make_opbuilder(*others).intersection(reducer)
 
-    def difference(self, *others):
+    def difference(self, *others, **kwargs):
         """ Get an iterator over the items in the difference of this map and
             others.
 
@@ -331,13 +1013,19 @@ class Map(object):
         maps, represented as a tuple of the map index and the value in the
         map.
 
+        See :py:meth:`union` for the values of `reduce` and why only reduced
+        results can be exported with `to_arrays()`.
+
         :param others:  List of :py:class:`Map` objects
+        :param reduce:  Name of the function to combine the values of each
+                        key with, if any
         :returns:       Iterator over all items whose key exists in this map,
                         but in none of the other maps, in lexicographical order
         """
-        return self._make_opbuilder(*others).difference()
+        reducer = pop_reducer(kwargs)
+        return self._make_opbuilder(*others).difference(reducer)
 
-    def symmetric_difference(self, *others):
+    def symmetric_difference(self, *others, **kwargs):
         """ Get an iterator over the items in the symmetric difference of this
             map and others.
 
@@ -346,8 +1034,91 @@ class Map(object):
         maps, represented as a tuple of the map index and the value in the
         map.
 
+        See :py:meth:`union` for the values of `reduce` and why only reduced
+        results can be exported with `to_arrays()`.
+
         :param others:  List of :py:class:`Map` objects
+        :param reduce:  Name of the function to combine the values of each
+                        key with, if any
         :returns:       Iterator over all items whose key exists in only one of
                         the maps in lexicographical order
         """
-        return self._make_opbuilder(*others).symmetric_difference()
+        reducer = pop_reducer(kwargs)
+        return self._make_opbuilder(*others).symmetric_difference(reducer)
+
+    def union_into(self, path, *others, **kwargs):
+        """ Write the union of this map and others into a new map file.
+
+        Unlike building a map from :py:meth:`union`, the items are streamed
+        from the operation into the new file by the native library, without
+        creating Python objects for them. This makes merging many maps into
+        one limited by I/O. The same applies to :py:meth:`intersection_into`,
+        :py:meth:`difference_into` and :py:meth:`symmetric_difference_into`.
+
+        Since a map holds a single value per key, the values of each key are
+        always combined, by default with the `'last'` reducer, i.e. the value
+        of the last map that contains the key wins, also if `reduce` is
+        passed as `None`. See :py:meth:`union` for the other reducers.
+
+        :param path:    Path to build the new map in, which must not be the
+                        path of any of the maps
+        :param others:  List of :py:class:`Map` objects
+        :param reduce:  Name of the function to combine the values of each
+                        key with
+        :returns:       The new map
+        :rtype:         :py:class:`Map`
+        """
+        reducer = pop_reducer(kwargs, 'last')
+        self._make_opbuilder(*others).union_into(path, reducer)
+        return Map(path, keys=self._keys)
+
+    def intersection_into(self, path, *others, **kwargs):
+        """ Write the intersection of this map and others into a new map
+            file.
+
+        See :py:meth:`union_into`.
+
+        :param path:    Path to build the new map in
+        :param others:  List of :py:class:`Map` objects
+        :param reduce:  Name of the function to combine the values of each
+                        key with, `'last'` by default
+        :returns:       The new map
+        :rtype:         :py:class:`Map`
+        """
+        reducer = pop_reducer(kwargs, 'last')
+        self._make_opbuilder(*others).intersection_into(path, reducer)
+        return Map(path, keys=self._keys)
+
+    def difference_into(self, path, *others, **kwargs):
+        """ Write the difference of this map and others into a new map file.
+
+        See :py:meth:`union_into`.
+
+        :param path:    Path to build the new map in
+        :param others:  List of :py:class:`Map` objects
+        :param reduce:  Name of the function to combine the values of each
+                        key with, `'last'` by default
+        :returns:       The new map
+        :rtype:         :py:class:`Map`
+        """
+        reducer = pop_reducer(kwargs, 'last')
+        self._make_opbuilder(*others).difference_into(path, reducer)
+        return Map(path, keys=self._keys)
+
+    def symmetric_difference_into(self, path, *others, **kwargs):
+        """ Write the symmetric difference of this map and others into a new
+            map file.
+
+        See :py:meth:`union_into`.
+
+        :param path:    Path to build the new map in
+        :param others:  List of :py:class:`Map` objects
+        :param reduce:  Name of the function to combine the values of each
+                        key with, `'last'` by default
+        :returns:       The new map
+        :rtype:         :py:class:`Map`
+        """
+        reducer = pop_reducer(kwargs, 'last')
+        self._make_opbuilder(*others).symmetric_difference_into(path,
+                                                                reducer)
+        return Map(path, keys=self._keys)
@@ -0,0 +1,616 @@
+""" Mutable sets and maps that are stored as a stack of immutable segments.
+
+Writes go to an in-memory buffer, which is written to a new segment file
+once it is full or when :py:meth:`MutableSet.flush` is called. Deleted keys
+are recorded as tombstones, a set of keys in each segment that hides them
+in all older segments. The newest segment that mentions a key decides
+whether and with which value it is in the index.
+
+To keep the number of segments that reads have to consult small, the newest
+segments are merged whenever they have grown as large as the segment below
+them, so only the tail of the index is rebuilt on a write and the number of
+segments grows logarithmically with the size of the index. Merging can also
+run in a background thread.
+
+Since every change is buffered in Python first, instances are not safe to be
+written from more than one thread at a time, while reads can run concurrently
+with a single writer.
+"""
+import heapq
+import json
+import os
+import threading
+from collections import namedtuple
+from itertools import groupby
+from operator import itemgetter
+
+from .common import (BATCH_SIZE, MAX_VALUE, MapItemStreamIterator, ValueFns,
+                     chunked, get_reducer)
+from .lib import checked_call, lib
+from .map import Map
+from .set import Set
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+#: Default number of buffered changes that trigger a flush
+BUFFER_SIZE = 65536
+
+#: Marks deleted keys in the buffer and in merged layers
+DELETED = object()
+
+#: Marks keys that are not in the buffer
+_MISSING = object()
+
+#: A segment file with the keys or items in it, the tombstones file for the
+#: keys it deletes from older segments or `None` and its id
+Segment = namedtuple('Segment', ('id', 'index', 'tombstones'))
+
+# Use an atomic rename on all platforms where it is available
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _tag(items, age):
+    for key, value in items:
+        yield key, age, value
+
+
+def merge_layers(layers):
+    """ Merge the layers of a mutable index.
+
+    :param layers:  `(items, tombstones)` tuples of iterators over the
+                    `(key, value)` items and the deleted keys of each layer,
+                    in key order, newest layer first
+    :returns:       Iterator over `(key, value)` pairs in key order, with
+                    the value from the newest layer that mentions the key or
+                    :py:data:`DELETED` if it was deleted there
+    """
+    streams = []
+    for age, (items, tombstones) in enumerate(layers):
+        streams.append(_tag(items, age))
+        streams.append(_tag(((key, DELETED) for key in tombstones), age))
+    for key, group in groupby(heapq.merge(*streams), key=itemgetter(0)):
+        yield key, next(group)[2]
+
+
+def _push_index(op_ptr, index):
+    if isinstance(index, Map):
+        lib.fst_opbuilder_push_mapstream(op_ptr,
+                                         lib.fst_map_stream(index._ptr))
+    else:
+        lib.fst_opbuilder_push_setstream(op_ptr,
+                                         lib.fst_set_stream(index._ptr))
+
+
+def union_newest(layers):
+    """ Build a native union of sets or maps that keeps the value from the
+        newest one with a key.
+
+    :param layers:  `(index, hiding)` tuples, oldest first, where `hiding`
+                    are the sets or maps whose keys are removed from `index`
+                    with a native difference before the union
+    :returns:       Pointer to the reduced map stream, which borrows all
+                    indexes
+    """
+    union_ptr = lib.fst_opbuilder_new()
+    for index, hiding in layers:
+        if not hiding:
+            _push_index(union_ptr, index)
+            continue
+        diff_ptr = lib.fst_opbuilder_new()
+        _push_index(diff_ptr, index)
+        for other in hiding:
+            _push_index(diff_ptr, other)
+        lib.fst_opbuilder_push_reducedstream(
+            union_ptr, lib.fst_map_difference_reduce(
+                lib.fst_map_opbuilder_difference(diff_ptr),
+                get_reducer('first')))
+    return lib.fst_map_union_reduce(lib.fst_map_opbuilder_union(union_ptr),
+                                    get_reducer('last'))
+
+
+def _live_layers(segments):
+    """ Get the layers of :py:func:`union_newest` for the items in segments,
+        without the keys that newer segments delete.
+    """
+    return [(segment.index, [seg.tombstones for seg in segments[pos + 1:]
+                             if seg.tombstones is not None])
+            for pos, segment in enumerate(segments)]
+
+
+def _tombstone_layers(segments):
+    """ Get the layers of :py:func:`union_newest` for the tombstones in
+        segments, without the keys that newer segments add again.
+    """
+    return [(segment.tombstones, [seg.index for seg in segments[pos + 1:]])
+            for pos, segment in enumerate(segments)
+            if segment.tombstones is not None]
+
+
+def _segment_size(segment):
+    size = len(segment.index)
+    if segment.tombstones is not None:
+        size += len(segment.tombstones)
+    return size
+
+
+def pick_compaction(sizes):
+    """ Find the newest segments that should be merged into one.
+
+    Segments are merged as long as the next older segment is not larger than
+    twice the size of the merged ones, which keeps the sizes of the segments
+    growing geometrically from the newest to the oldest.
+
+    :param sizes:   Number of keys and tombstones in the segments, oldest
+                    first
+    :returns:       Position of the oldest segment to merge, or `None` if no
+                    segments should be merged
+    """
+    if not sizes:
+        return None
+    start = len(sizes) - 1
+    total = sizes[start]
+    while start > 0 and sizes[start - 1] <= 2 * total:
+        start -= 1
+        total += sizes[start]
+    if start == len(sizes) - 1:
+        return None
+    return start
+
+
+class _MutableBase(object):
+    _kind = None
+    _index_cls = None
+
+    def __init__(self, path, keys='str', buffer_size=BUFFER_SIZE,
+                 background=False):
+        """ Open a mutable index in a directory, which is created if it does
+            not exist yet.
+
+        :param path:        Directory that holds the segments and the
+                            manifest
+        :param keys:        Type of the keys, `'str'` for unicode strings or
+                            `'bytes'` for byte strings. Must match the type
+                            of an existing index.
+        :param buffer_size: Number of changes that are buffered in memory
+                            before they are written to a new segment
+        :param background:  Merge segments in a background thread instead of
+                            during the write that triggers it
+        """
+        self._path = path
+        self._keys = keys
+        self.buffer_size = buffer_size
+        self._background = background
+        # Key to value, or `DELETED`, of the changes since the last flush
+        self._buffer = {}
+        # The previous buffer while a flush writes it to a new segment, it
+        # is no longer modified
+        self._flushing = {}
+        # Guards the segments, the manifest and the buffers. Reads take a
+        # snapshot of them, the segment list is replaced instead of modified.
+        self._lock = threading.Lock()
+        self._compaction = None
+        manifest_path = os.path.join(path, MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self._segments = []
+            self._next_id = 0
+            self._save_manifest()
+            return
+        with open(manifest_path) as fp:
+            manifest = json.load(fp)
+        if manifest['type'] != self._kind:
+            raise ValueError("Manifest describes a {}, not a {}".format(
+                manifest['type'], self._kind))
+        if manifest['keys'] != keys:
+            raise ValueError("Index has {!r} keys, not {!r}".format(
+                manifest['keys'], keys))
+        self._next_id = manifest['next_id']
+        self._segments = [self._open_segment(seg['id'], seg['tombstones'])
+                          for seg in manifest['segments']]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _segment_paths(self, seg_id):
+        name = 'segment-{:06d}'.format(seg_id)
+        return (os.path.join(self._path, name + '.fst'),
+                os.path.join(self._path, name + '.del.fst'))
+
+    def _open_segment(self, seg_id, has_tombstones):
+        index_path, tombstones_path = self._segment_paths(seg_id)
+        tombstones = None
+        if has_tombstones:
+            tombstones = Set(tombstones_path, keys=self._keys)
+        return Segment(seg_id, self._index_cls(index_path, keys=self._keys),
+                       tombstones)
+
+    def _remove_segment(self, segment):
+        for path in self._segment_paths(segment.id):
+            try:
+                os.remove(path)
+            except OSError:
+                # The tombstones file does not exist, or the file is still
+                # mapped on a platform that does not allow removing it
+                pass
+
+    def _save_manifest(self):
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'type': self._kind,
+            'keys': self._keys,
+            'next_id': self._next_id,
+            'segments': [{'id': seg.id,
+                          'tombstones': seg.tombstones is not None}
+                         for seg in self._segments]
+        }
+        manifest_path = os.path.join(self._path, MANIFEST_NAME)
+        with open(manifest_path + '.tmp', 'w') as fp:
+            json.dump(manifest, fp, indent=2, sort_keys=True)
+        _replace(manifest_path + '.tmp', manifest_path)
+
+    @property
+    def segments(self):
+        """ The segments, oldest first. """
+        return list(self._segments)
+
+    def _insert_many(self, builder, items):
+        raise NotImplementedError
+
+    def _write_segment(self, seg_id, merged, keep_tombstones):
+        """ Write merged items to a new segment.
+
+        :param merged:          Iterator over `(key, value)` pairs in key
+                                order, where deleted keys have the value
+                                :py:data:`DELETED`
+        :param keep_tombstones: Whether to record the deleted keys, which is
+                                only needed if there are older segments
+        :returns:               The segment, or `None` if it is empty
+        """
+        index_path, tombstones_path = self._segment_paths(seg_id)
+        num_items = num_tombstones = 0
+        with self._index_cls.build(index_path, keys=self._keys) as builder:
+            with Set.build(tombstones_path, keys=self._keys) as tb_builder:
+                for chunk in chunked(merged, BATCH_SIZE):
+                    items = [item for item in chunk if item[1] is not DELETED]
+                    self._insert_many(builder, items)
+                    num_items += len(items)
+                    if keep_tombstones and len(items) < len(chunk):
+                        tb_builder.insert_many([key for key, value in chunk
+                                                if value is DELETED])
+                        num_tombstones += len(chunk) - len(items)
+        if not num_tombstones:
+            os.remove(tombstones_path)
+        if not num_items and not num_tombstones:
+            os.remove(index_path)
+            return None
+        return self._open_segment(seg_id, bool(num_tombstones))
+
+    def flush(self):
+        """ Write the buffered changes to a new segment. """
+        with self._lock:
+            if not self._buffer:
+                return
+            # Reads see the changes in `_flushing` until the segment with
+            # them is published
+            flushing = self._flushing = self._buffer
+            self._buffer = {}
+            seg_id = self._next_id
+            self._next_id += 1
+            keep_tombstones = bool(self._segments)
+        merged = sorted(flushing.items(), key=itemgetter(0))
+        try:
+            segment = self._write_segment(seg_id, iter(merged),
+                                          keep_tombstones)
+        except Exception:
+            with self._lock:
+                # Keep the changes buffered, so the flush can be retried
+                self._buffer, self._flushing = flushing, {}
+            raise
+        with self._lock:
+            if segment is not None:
+                self._segments = self._segments + [segment]
+            self._save_manifest()
+            self._flushing = {}
+        self._maybe_compact()
+
+    def _maybe_compact(self):
+        if self._compaction is not None and self._compaction.is_alive():
+            return
+        start = pick_compaction([_segment_size(seg)
+                                 for seg in self._segments])
+        if start is None:
+            return
+        if not self._background:
+            self._compact(start)
+            return
+        self._compaction = threading.Thread(target=self._compact,
+                                            args=(start,))
+        self._compaction.daemon = True
+        self._compaction.start()
+
+    def _compact(self, start):
+        """ Merge the segments from position `start` on into one.
+
+        The items and tombstones are merged with native set operations and
+        written to the new segment without passing through Python.
+        """
+        with self._lock:
+            run = self._segments[start:]
+            seg_id = self._next_id
+            self._next_id += 1
+        index_path, tombstones_path = self._segment_paths(seg_id)
+        into_fn = (lib.fst_map_reducedstream_into if self._kind == 'map'
+                   else lib.fst_map_reducedstream_into_set)
+        checked_call(into_fn, union_newest(_live_layers(run)),
+                     index_path.encode('utf8'))
+        # Tombstones only need to hide keys in older segments
+        tombstone_layers = _tombstone_layers(run) if start > 0 else []
+        has_tombstones = False
+        if tombstone_layers:
+            checked_call(lib.fst_map_reducedstream_into_set,
+                         union_newest(tombstone_layers),
+                         tombstones_path.encode('utf8'))
+            has_tombstones = len(Set(tombstones_path, keys=self._keys)) > 0
+            if not has_tombstones:
+                os.remove(tombstones_path)
+        merged = self._open_segment(seg_id, has_tombstones)
+        if not has_tombstones and not len(merged.index):
+            self._remove_segment(merged)
+            merged = None
+        with self._lock:
+            # Flushes only append segments, so the merged ones are still in
+            # place
+            segments = self._segments
+            assert segments[start:start + len(run)] == run
+            self._segments = (segments[:start] +
+                              ([merged] if merged is not None else []) +
+                              segments[start + len(run):])
+            self._save_manifest()
+        for segment in run:
+            self._remove_segment(segment)
+
+    def compact(self):
+        """ Flush the buffer and merge all segments into one, dropping all
+            tombstones.
+        """
+        self.flush()
+        self._wait()
+        if len(self._segments) > 1 or any(
+                seg.tombstones is not None for seg in self._segments):
+            self._compact(0)
+
+    def _wait(self):
+        if self._compaction is not None:
+            self._compaction.join()
+            self._compaction = None
+
+    def close(self):
+        """ Flush the buffer and wait for a background merge to finish. """
+        self.flush()
+        self._wait()
+
+    def _segment_items(self, segments):
+        """ Get a native iterator over the `(key, value)` pairs in segments.
+
+        See :py:func:`union_newest`, the items are never merged in Python.
+        """
+        stream_ptr = union_newest(_live_layers(segments))
+        # The streams borrow the segments
+        return MapItemStreamIterator(
+            stream_ptr, lib.fst_map_reducedstream_next,
+            lib.fst_map_reducedstream_free, segments,
+            count_fn=lib.fst_map_reducedstream_count,
+            batch_fn=lib.fst_map_reducedstream_batch, keys=self._keys,
+            value_fns=ValueFns(lib.fst_map_reducedstream_values,
+                               lib.fst_map_reducedstream_stats,
+                               lib.fst_map_reducedstream_histogram))
+
+    def _snapshot(self):
+        """ Get the segments, the changes that are being flushed and the
+            buffer at one point in time.
+
+        The buffer is not copied, so this is only suitable for point reads.
+        """
+        with self._lock:
+            return self._segments, self._flushing, self._buffer
+
+    def _pending_snapshot(self):
+        """ Get the segments and a copy of all changes that are not in them
+            yet at one point in time.
+        """
+        with self._lock:
+            pending = dict(self._flushing)
+            pending.update(self._buffer)
+            return self._segments, pending
+
+    def _merged(self):
+        """ Get an iterator over the `(key, value)` pairs in the index.
+
+        Only the buffered changes are merged into the segments in Python.
+        """
+        segments, pending = self._pending_snapshot()
+        buffered = sorted(pending.items(), key=itemgetter(0))
+        if segments:
+            items = self._segment_items(segments)
+            if not buffered:
+                return items
+            merged = merge_layers([(buffered, ()), (items, ())])
+        else:
+            merged = iter(buffered)
+        return ((key, value) for key, value in merged
+                if value is not DELETED)
+
+    def __len__(self):
+        segments, pending = self._pending_snapshot()
+        count = self._segment_items(segments).count() if segments else 0
+        for key, value in pending.items():
+            in_segments = self._lookup(key, segments) is not None
+            count += (value is not DELETED) - in_segments
+        return count
+
+    def _lookup(self, key, segments=None):
+        """ Find the segment that decides about a key.
+
+        :param segments:    The segments to search, defaults to the current
+                            ones
+        :returns:           The segment, or `None` if the key is not in any
+                            segment or deleted in the newest segment that
+                            mentions it
+        """
+        if segments is None:
+            segments = self._segments
+        for segment in reversed(segments):
+            if segment.tombstones is not None and key in segment.tombstones:
+                return None
+            if key in segment.index:
+                return segment
+        return None
+
+    def _index_value(self, index, key):
+        raise NotImplementedError
+
+    def _get(self, key):
+        """ Get the value of a key, or :py:data:`DELETED` if it is not in
+            the index.
+        """
+        segments, flushing, buffer = self._snapshot()
+        for changes in (buffer, flushing):
+            value = changes.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        segment = self._lookup(key, segments)
+        if segment is None:
+            return DELETED
+        return self._index_value(segment.index, key)
+
+    def __contains__(self, key):
+        return self._get(key) is not DELETED
+
+    def _write(self, key, value):
+        with self._lock:
+            self._buffer[key] = value
+            is_full = len(self._buffer) >= self.buffer_size
+        if is_full:
+            self.flush()
+
+    def _delete(self, key):
+        # Only the writer flushes, so all older changes are in the segments
+        if self._lookup(key) is not None:
+            self._write(key, DELETED)
+        else:
+            with self._lock:
+                self._buffer.pop(key, None)
+
+
+class MutableSet(_MutableBase):
+    """ A mutable ordered string set backed by finite state transducers.
+
+    The set is stored in a directory. Changes are buffered in memory until
+    :py:meth:`flush` or :py:meth:`close` is called, or the buffer is full::
+
+        with MutableSet('/path/to/blocklist') as blocklist:
+            blocklist.add('spam')
+            blocklist.discard('ham')
+    """
+    _kind = 'set'
+    _index_cls = Set
+
+    def _insert_many(self, builder, items):
+        builder.insert_many([key for key, _ in items])
+
+    def _index_value(self, index, key):
+        return None
+
+    def __iter__(self):
+        return (key for key, _ in self._merged())
+
+    def add(self, key):
+        """ Add a key to the set. """
+        self._write(key, None)
+
+    def update(self, keys):
+        """ Add all keys from an iterable to the set. """
+        for key in keys:
+            self._write(key, None)
+
+    def discard(self, key):
+        """ Remove a key from the set if it is a member. """
+        self._delete(key)
+
+
+class MutableMap(_MutableBase):
+    """ A mutable map of unicode keys to unsigned integer values backed by
+        finite state transducers.
+
+    Like :py:class:`MutableSet`, but for items::
+
+        with MutableMap('/path/to/counts') as counts:
+            counts['spam'] = 3
+            del counts['ham']
+    """
+    _kind = 'map'
+    _index_cls = Map
+
+    def _insert_many(self, builder, items):
+        if items:
+            keys, values = zip(*items)
+            builder.insert_many(keys, values)
+
+    def _index_value(self, index, key):
+        return index[key]
+
+    def __iter__(self):
+        return self.keys()
+
+    def __getitem__(self, key):
+        value = self._get(key)
+        if value is DELETED:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        """ Get the value for a key or a default value if it is not in the
+            map.
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if not 0 <= value <= MAX_VALUE:
+            raise ValueError(
+                "Values must be unsigned 64 bit integers, not {!r}".format(
+                    value))
+        self._write(key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._delete(key)
+
+    def update(self, items):
+        """ Set the values of all `(key, value)` pairs from an iterable or
+            of all items of a dictionary.
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        for key, value in items:
+            self[key] = value
+
+    def items(self):
+        """ Get an iterator over all `(key, value)` pairs in key order. """
+        return self._merged()
+
+    def keys(self):
+        """ Get an iterator over all keys in order. """
+        return (key for key, _ in self.items())
+
+    def values(self):
+        """ Get an iterator over all values in key order. """
+        return (value for _, value in self.items())
@@ -0,0 +1,111 @@
+""" Page cache warmup and access hints for memory-mapped sets and maps.
+
+The native library maps files lazily, so every page of an FST is faulted in
+from disk on its first access. The helpers in this module map the file from
+Python instead when hints are requested, which gives control over `madvise`
+and `MAP_POPULATE`, and load files into the page cache ahead of the first
+queries.
+"""
+import mmap
+import os
+import threading
+
+#: Size of the chunks in which files are read during warmup
+WARMUP_CHUNK_SIZE = 1024 * 1024
+
+#: Supported prefetch modes when opening a file:
+#: `'none'` maps the file lazily, `'full'` loads the whole file before
+#: returning and `'async'` loads it in a background thread
+PREFETCH_MODES = ('none', 'full', 'async')
+
+#: `madvise` advice for the supported access hints, `None` where the platform
+#: does not support it
+ACCESS_HINTS = {
+    'normal': getattr(mmap, 'MADV_NORMAL', None),
+    'random': getattr(mmap, 'MADV_RANDOM', None),
+    'sequential': getattr(mmap, 'MADV_SEQUENTIAL', None),
+}
+
+
+def check_options(prefetch, access):
+    if prefetch not in PREFETCH_MODES:
+        raise ValueError("Prefetch mode must be one of {}, not {!r}".format(
+            ", ".join(repr(m) for m in PREFETCH_MODES), prefetch))
+    if access is not None and access not in ACCESS_HINTS:
+        raise ValueError("Access hint must be one of {}, not {!r}".format(
+            ", ".join(repr(h) for h in sorted(ACCESS_HINTS)), access))
+
+
+def needs_mapping(prefetch, access):
+    """ Check if a file has to be mapped from Python to apply the options. """
+    return prefetch == 'full' or access is not None
+
+
+def open_mapping(path, prefetch='none', access=None):
+    """ Map a file read-only and apply the prefetch mode and access hint.
+
+    With `prefetch='full'`, the mapping is populated with `MAP_POPULATE`
+    where available and by touching every page otherwise. Access hints are
+    ignored on platforms without `madvise`.
+
+    :param path:        Path to the file
+    :param prefetch:    Prefetch mode, see :py:data:`PREFETCH_MODES`
+    :param access:      Expected access pattern, one of `'normal'`,
+                        `'random'` or `'sequential'`, or `None`
+    :returns:           The `mmap.mmap` object, or the contents of the file
+                        as `bytes` if it is empty
+    """
+    populate = prefetch == 'full' and hasattr(mmap, 'MAP_POPULATE')
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            # Empty files can not be mapped, read them instead so that
+            # loading fails with the same error as without hints
+            return fp.read()
+        if populate:
+            buf = mmap.mmap(fp.fileno(), 0,
+                            flags=mmap.MAP_SHARED | mmap.MAP_POPULATE,
+                            prot=mmap.PROT_READ)
+        else:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    advice = ACCESS_HINTS.get(access)
+    if advice is not None and hasattr(buf, 'madvise'):
+        buf.madvise(advice)
+    if prefetch == 'full' and not populate:
+        touch_pages(buf)
+    return buf
+
+
+def read_file(path):
+    """ Load a file into the page cache by reading it sequentially.
+
+    The reads release the GIL, so this does not stall other threads.
+    """
+    chunk = bytearray(WARMUP_CHUNK_SIZE)
+    with open(path, 'rb', buffering=0) as fp:
+        while fp.readinto(chunk):
+            pass
+
+
+def touch_pages(buf):
+    """ Fault in every page of a buffer by reading one byte per page. """
+    for pos in range(0, len(buf), mmap.PAGESIZE):
+        buf[pos]
+
+
+def warmup(path=None, buf=None):
+    """ Load a file and/or a mapped buffer into memory in a background
+        thread.
+
+    :param path:    Path to the file to read into the page cache
+    :param buf:     Buffer whose pages should be faulted in afterwards
+    :returns:       The started daemon `threading.Thread`
+    """
+    def run():
+        if path:
+            read_file(path)
+        if buf is not None:
+            touch_pages(buf)
+    thread = threading.Thread(target=run, name='rust_fst-warmup')
+    thread.daemon = True
+    thread.start()
+    return thread
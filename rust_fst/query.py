@@ -0,0 +1,130 @@
+""" Composite queries that combine automata and key ranges.
+
+A :py:class:`Query` describes the keys to search for as the intersection of
+any number of Levenshtein automata, regular expressions and prefixes, each of
+which can also be negated to exclude its matches, restricted to a key range.
+It is executed with :py:meth:`rust_fst.Set.query` or
+:py:meth:`rust_fst.Map.query` as a single traversal of the transducer, which
+skips all parts of it that cannot contain results.
+"""
+from . import automaton
+from .lib import ffi, lib
+
+
+class Query(object):
+    """ A composite query, built by chaining its methods.
+
+    Queries are independent of sets and maps and can be reused for any
+    number of searches::
+
+        query = Query().ge('m').lt('q').search_re(r'.*ing').search('moo', 1)
+        matches = list(fst_set.query(query))
+    """
+    def __init__(self):
+        # (kind, automaton or prefix, negate) tuples
+        self._terms = []
+        # (key, inclusive) tuples or `None`
+        self._lower = None
+        self._upper = None
+
+    def search(self, term, max_dist=None, negate=False):
+        """ Only match keys within an edit distance of a term.
+
+        :param term:        The search term or a compiled
+                            :py:class:`rust_fst.Levenshtein`
+        :param max_dist:    The maximum edit distance, must be omitted for a
+                            compiled automaton
+        :param negate:      Exclude the keys within the edit distance instead
+        :returns:           The query
+        """
+        lev = automaton.get_levenshtein(term, max_dist)
+        self._terms.append(('levenshtein', lev, negate))
+        return self
+
+    def search_re(self, pattern, negate=False):
+        """ Only match keys that match a regular expression.
+
+        See :py:meth:`rust_fst.Set.search_re` for the supported syntax.
+
+        :param pattern:     A regular expression or a compiled
+                            :py:class:`rust_fst.Regex`
+        :param negate:      Exclude the keys that match instead
+        :returns:           The query
+        """
+        regex = automaton.get_regex(pattern)
+        self._terms.append(('regex', regex, negate))
+        return self
+
+    def prefix(self, prefix, negate=False):
+        """ Only match keys that start with a prefix.
+
+        :param prefix:      The prefix, of the key type of the searched set or
+                            map
+        :param negate:      Exclude the keys with the prefix instead
+        :returns:           The query
+        """
+        self._terms.append(('prefix', prefix, negate))
+        return self
+
+    def ge(self, key):
+        """ Only match keys greater than or equal to a key.
+
+        :returns:   The query
+        """
+        self._lower = (key, True)
+        return self
+
+    def gt(self, key):
+        """ Only match keys greater than a key.
+
+        :returns:   The query
+        """
+        self._lower = (key, False)
+        return self
+
+    def le(self, key):
+        """ Only match keys less than or equal to a key.
+
+        :returns:   The query
+        """
+        self._upper = (key, True)
+        return self
+
+    def lt(self, key):
+        """ Only match keys less than a key.
+
+        :returns:   The query
+        """
+        self._upper = (key, False)
+        return self
+
+    @property
+    def bounds(self):
+        """ The lower and upper bound as `(key, inclusive)` tuples, or `None`
+            if unbounded.
+        """
+        return self._lower, self._upper
+
+    def _compile(self, encode):
+        """ Build the native query for a set or map.
+
+        :param encode:  Function to encode keys for the set or map
+        :returns:       The native query and the objects it borrows, which
+                        must outlive any stream over the query
+        """
+        c_query = ffi.gc(lib.fst_query_new(), lib.fst_query_free)
+        for kind, arg, negate in self._terms:
+            if kind == 'levenshtein':
+                lib.fst_query_add_levenshtein(c_query, arg._ptr, negate)
+            elif kind == 'regex':
+                lib.fst_query_add_regex(c_query, arg._ptr, negate)
+            else:
+                prefix = encode(arg)
+                lib.fst_query_add_prefix(c_query, prefix, len(prefix),
+                                         negate)
+        for set_fn, bound in ((lib.fst_query_set_lower, self._lower),
+                              (lib.fst_query_set_upper, self._upper)):
+            if bound is not None:
+                key = encode(bound[0])
+                set_fn(c_query, key, len(key), bound[1])
+        return c_query, [arg for kind, arg, _ in self._terms]
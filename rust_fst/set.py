@@ -1,6 +1,9 @@
 from contextlib import contextmanager
 
-from .common import KeyStreamIterator
+from . import automaton, extsort, pagecache
+from .common import (BATCH_SIZE, KeyStreamIterator, build_side_index, chunked,
+                     contains_many, get_key_codec, load_side_index, pack_keys,
+                     ranked_search, take_batch, take_bytes)
 from .lib import ffi, lib, checked_call
 
 
@@ -8,58 +11,105 @@ class SetBuilder(object):
     def insert(self, val):
         raise NotImplementedError
 
+    def insert_many(self, vals):
+        """ Insert many keys at once.
+
+        :param vals:    Iterable over the keys, in lexicographical order
+        """
+        raise NotImplementedError
+
+    def insert_file(self, src):
+        raise NotImplementedError
+
+    def insert_records(self, src, start, end):
+        """ Insert the keys of a byte range of a run file, as written by
+            :py:func:`rust_fst.extsort.write_records`.
+        """
+        raise NotImplementedError
+
     def finish(self):
         raise NotImplementedError
 
 
 class FileSetBuilder(SetBuilder):
-    def __init__(self, path):
-        self._ctx = lib.fst_context_new()
-        self._writer_p = checked_call(
-            lib.fst_bufwriter_new, self._ctx, path.encode('utf8'))
-        self._builder_p = checked_call(
-            lib.fst_filesetbuilder_new, self._ctx, self._writer_p)
+    def __init__(self, path, keys='str'):
+        self._keys = keys
+        self._encode = get_key_codec(keys)[0]
+        self._writer_p = checked_call(lib.fst_bufwriter_new,
+                                      path.encode('utf8'))
+        self._builder_p = checked_call(lib.fst_filesetbuilder_new,
+                                       self._writer_p)
 
     def insert(self, val):
-        c_str = ffi.new("char[]", val.encode('utf8'))
+        key = self._encode(val)
         checked_call(lib.fst_filesetbuilder_insert,
-                     self._ctx, self._builder_p, c_str)
+                     self._builder_p, key, len(key))
+
+    def insert_many(self, vals):
+        c_keys = [self._encode(v) for v in vals]
+        if not c_keys:
+            return
+        c_buf, c_offsets = pack_keys(c_keys)
+        checked_call(lib.fst_filesetbuilder_insert_many,
+                     self._builder_p, c_buf, c_offsets, len(c_keys))
+
+    def insert_file(self, src):
+        checked_call(lib.fst_filesetbuilder_insert_file,
+                     self._builder_p, src.encode('utf8'), self._keys == 'str')
+
+    def insert_records(self, src, start, end):
+        checked_call(lib.fst_filesetbuilder_insert_records,
+                     self._builder_p, src.encode('utf8'), start, end)
 
     def finish(self):
-        checked_call(lib.fst_filesetbuilder_finish,
-                     self._ctx, self._builder_p)
+        checked_call(lib.fst_filesetbuilder_finish, self._builder_p)
         lib.fst_bufwriter_free(self._writer_p)
-        lib.fst_context_free(self._ctx)
 
 
 class MemSetBuilder(SetBuilder):
-    def __init__(self):
-        self._ctx = lib.fst_context_new()
+    def __init__(self, keys='str'):
+        self._keys = keys
+        self._encode = get_key_codec(keys)[0]
         self._ptr = lib.fst_memsetbuilder_new()
         self._set_ptr = None
 
     def insert(self, val):
-        c_str = ffi.new("char[]", val.encode('utf8'))
-        checked_call(lib.fst_memsetbuilder_insert, self._ctx, self._ptr, c_str)
+        key = self._encode(val)
+        checked_call(lib.fst_memsetbuilder_insert, self._ptr,
+                     key, len(key))
+
+    def insert_many(self, vals):
+        c_keys = [self._encode(v) for v in vals]
+        if not c_keys:
+            return
+        c_buf, c_offsets = pack_keys(c_keys)
+        checked_call(lib.fst_memsetbuilder_insert_many, self._ptr,
+                     c_buf, c_offsets, len(c_keys))
+
+    def insert_file(self, src):
+        checked_call(lib.fst_memsetbuilder_insert_file, self._ptr,
+                     src.encode('utf8'), self._keys == 'str')
+
+    def insert_records(self, src, start, end):
+        checked_call(lib.fst_memsetbuilder_insert_records, self._ptr,
+                     src.encode('utf8'), start, end)
 
     def finish(self):
-        self._set_ptr = checked_call(lib.fst_memsetbuilder_finish,
-                                     self._ctx, self._ptr)
-        lib.fst_context_free(self._ctx)
-        self._ctx = None
+        self._set_ptr = checked_call(lib.fst_memsetbuilder_finish, self._ptr)
         self._ptr = None
 
     def get_set(self):
         if self._set_ptr is None:
             raise ValueError("The builder has to be finished first.")
-        return Set(None, _pointer=self._set_ptr)
+        return Set(None, keys=self._keys, _pointer=self._set_ptr)
 
 
 class OpBuilder(object):
-    def __init__(self, set_ptr):
+    def __init__(self, set_ptr, keys='str'):
         # NOTE: No need for `ffi.gc`, since the struct will be free'd
         #       once we call union/intersection/difference
         self._ptr = lib.fst_set_make_opbuilder(set_ptr)
+        self._keys = keys
 
     def push(self, set_ptr):
         lib.fst_set_opbuilder_push(self._ptr, set_ptr)
@@ -67,23 +117,53 @@ class OpBuilder(object):
     def union(self):
         stream_ptr = lib.fst_set_opbuilder_union(self._ptr)
         return KeyStreamIterator(stream_ptr, lib.fst_set_union_next,
-                                 lib.fst_set_union_free)
+                                 lib.fst_set_union_free,
+                                 count_fn=lib.fst_set_union_count,
+                                 batch_fn=lib.fst_set_union_batch,
+                                 keys=self._keys)
 
     def intersection(self):
         stream_ptr = lib.fst_set_opbuilder_intersection(self._ptr)
         return KeyStreamIterator(stream_ptr, lib.fst_set_intersection_next,
-                                 lib.fst_set_intersection_free)
+                                 lib.fst_set_intersection_free,
+                                 count_fn=lib.fst_set_intersection_count,
+                                 batch_fn=lib.fst_set_intersection_batch,
+                                 keys=self._keys)
 
     def difference(self):
         stream_ptr = lib.fst_set_opbuilder_difference(self._ptr)
         return KeyStreamIterator(stream_ptr, lib.fst_set_difference_next,
-                                 lib.fst_set_difference_free)
+                                 lib.fst_set_difference_free,
+                                 count_fn=lib.fst_set_difference_count,
+                                 batch_fn=lib.fst_set_difference_batch,
+                                 keys=self._keys)
 
     def symmetric_difference(self):
         stream_ptr = lib.fst_set_opbuilder_symmetricdifference(self._ptr)
-        return KeyStreamIterator(stream_ptr,
-                                 lib.fst_set_symmetricdifference_next,
-                                 lib.fst_set_symmetricdifference_free)
+        return KeyStreamIterator(
+            stream_ptr, lib.fst_set_symmetricdifference_next,
+            lib.fst_set_symmetricdifference_free,
+            count_fn=lib.fst_set_symmetricdifference_count,
+            batch_fn=lib.fst_set_symmetricdifference_batch, keys=self._keys)
+
+    def union_into(self, path):
+        stream_ptr = lib.fst_set_opbuilder_union(self._ptr)
+        checked_call(lib.fst_set_union_into, stream_ptr, path.encode('utf8'))
+
+    def intersection_into(self, path):
+        stream_ptr = lib.fst_set_opbuilder_intersection(self._ptr)
+        checked_call(lib.fst_set_intersection_into, stream_ptr,
+                     path.encode('utf8'))
+
+    def difference_into(self, path):
+        stream_ptr = lib.fst_set_opbuilder_difference(self._ptr)
+        checked_call(lib.fst_set_difference_into, stream_ptr,
+                     path.encode('utf8'))
+
+    def symmetric_difference_into(self, path):
+        stream_ptr = lib.fst_set_opbuilder_symmetricdifference(self._ptr)
+        checked_call(lib.fst_set_symmetricdifference_into, stream_ptr,
+                     path.encode('utf8'))
 
 
 class Set(object):
@@ -95,7 +175,9 @@ class Set(object):
 
     To build a set, use the :py:meth:`from_iter` classmethod and pass it an
     iterator and (optionally) a path where the set should be stored. If the
-    latter is missing, the set will be built in memory.
+    latter is missing, the set will be built in memory. A set can be
+    serialized with :py:meth:`to_bytes` and loaded without copying from any
+    buffer with :py:meth:`from_buffer`.
 
     The interface follows the built-in `set` type, with a few additions:
 
@@ -108,68 +190,220 @@ class Set(object):
 
     * Once constructed, a Set can never be modified.
     * Sets must be built with iterators of lexicographically sorted
-      unicode strings
+      unicode strings, unless they are built with :py:meth:`from_unsorted`
+
+    Sets can also store raw byte strings instead of unicode strings. To do so,
+    pass `keys='bytes'` when building and opening the set. All keys passed to
+    and returned from the set will then be `bytes` objects that may contain
+    arbitrary (including non-UTF8 and NUL) bytes and are never transcoded.
+    Search terms and regular expressions are unicode strings in both modes.
+
+    Sets are safe to share between threads: lookups, searches, range queries,
+    set operations and iteration can all be run concurrently on the same
+    set, since errors are reported through per-thread state. The native
+    calls release the GIL. Builders and the iterators returned by the
+    queries must not be shared between threads, though.
     """
 
     @staticmethod
     @contextmanager
-    def build(path=None):
+    def build(path=None, keys='str'):
         """ Context manager to build a new set.
 
         Call :py:meth:`insert` on the returned builder object to insert
         new items into the set. Keep in mind that insertion must happen in
         lexicographical order, otherwise an exception will be thrown.
 
+        When inserting many keys, prefer :py:meth:`insert_many` with chunks
+        of keys, which only crosses the FFI boundary once per chunk.
+
         :param path:    Path to build set in, or `None` if set should be built
                         in memory
+        :param keys:    Type of the keys, `'str'` for unicode strings or
+                        `'bytes'` for byte strings
         :returns:       :py:class:`SetBuilder`
         """
         if path:
-            builder = FileSetBuilder(path)
+            builder = FileSetBuilder(path, keys=keys)
         else:
-            builder = MemSetBuilder()
+            builder = MemSetBuilder(keys=keys)
         yield builder
         builder.finish()
 
     @classmethod
-    def from_iter(cls, it, path=None):
+    def from_iter(cls, it, path=None, batch_size=BATCH_SIZE, keys='str'):
         """ Build a new set from an iterator.
 
         Keep in mind that the iterator must return unicode strings in
         lexicographical order, otherwise an exception will be thrown.
 
-        :param it:      Iterator to build set with
-        :type it:       iterator over unicode strings
+        :param it:          Iterator to build set with
+        :type it:           iterator over unicode strings
+        :param path:        Path to build set in, or `None` if set should be
+                            built in memory
+        :param batch_size:  Number of keys to insert per native call
+        :param keys:        Type of the keys, `'str'` for unicode strings or
+                            `'bytes'` for byte strings
+        :returns:           The finished set
+        :rtype:             :py:class:`Set`
+        """
+        with cls.build(path, keys=keys) as builder:
+            for chunk in chunked(it, batch_size):
+                builder.insert_many(chunk)
+        if path:
+            return cls(path=path, keys=keys)
+        else:
+            return builder.get_set()
+
+    @classmethod
+    def from_file(cls, src, path=None, keys='str'):
+        """ Build a new set from a text file with one key per line.
+
+        The file is read and parsed by the native library without any
+        per-key work in Python, which makes this the fastest way to build a
+        set from sorted keys on disk. Lines may be terminated by `\\n` or
+        `\\r\\n` and empty lines are skipped. Like with
+        :py:meth:`from_iter`, the keys must be in lexicographical order.
+
+        Errors are reported with the number of the offending line.
+
+        :param src:     Path to the text file with the keys
         :param path:    Path to build set in, or `None` if set should be built
                         in memory
+        :param keys:    Type of the keys. For `'str'`, the file must be
+                        UTF-8 encoded, for `'bytes'` the lines are used as-is
         :returns:       The finished set
         :rtype:         :py:class:`Set`
         """
-        with cls.build(path) as builder:
-            for key in it:
-                builder.insert(key)
+        with cls.build(path, keys=keys) as builder:
+            builder.insert_file(src)
         if path:
-            return cls(path=path)
+            return cls(path=path, keys=keys)
         else:
             return builder.get_set()
 
-    def __init__(self, path, _pointer=None):
+    @classmethod
+    def from_unsorted(cls, it, path=None, keys='str',
+                      memory_limit=extsort.DEFAULT_MEMORY_LIMIT, tmpdir=None):
+        """ Build a new set from an iterator over keys in arbitrary order.
+
+        Duplicate keys are dropped. The keys are sorted in runs of at most
+        `memory_limit` bytes, which are spilled to a temporary directory and
+        merged into the set if the input does not fit into a single run.
+
+        :param it:              Iterator to build set with
+        :param path:            Path to build set in, or `None` if set should
+                                be built in memory
+        :param keys:            Type of the keys, `'str'` for unicode strings
+                                or `'bytes'` for byte strings
+        :param memory_limit:    Approximate memory budget in bytes for sorting
+        :param tmpdir:          Directory to spill sorted runs to, defaults to
+                                the system's temporary directory
+        :returns:               The finished set
+        :rtype:                 :py:class:`Set`
+        """
+        return cls.from_iter(
+            extsort.sort_keys(it, keys=keys, memory_limit=memory_limit,
+                              tmpdir=tmpdir),
+            path=path, keys=keys)
+
+    @classmethod
+    def from_buffer(cls, obj, keys='str'):
+        """ Load a set from an object that supports the buffer protocol.
+
+        The set uses the memory of the buffer directly instead of copying
+        it, which allows embedding sets in other file formats or sharing a
+        single copy between processes, e.g. with `mmap.mmap` or
+        `multiprocessing.shared_memory`. A reference to `obj` is kept for
+        the lifetime of the set. The contents of the buffer must not be
+        modified while the set is in use.
+
+        :param obj:     Object with the serialized set, e.g. the result
+                        of :py:meth:`to_bytes`
+        :param keys:    Type of the keys, `'str'` for unicode strings or
+                        `'bytes'` for byte strings
+        :returns:       The loaded set
+        :rtype:         :py:class:`Set`
+        """
+        c_buf = ffi.from_buffer(obj)
+        ptr = checked_call(lib.fst_set_from_buffer, c_buf, len(c_buf))
+        return cls(None, keys=keys, _pointer=ptr, _buffer=c_buf)
+
+    def __init__(self, path, keys='str', prefetch='none',
+                 access=None, _pointer=None, _buffer=None):
         """ Load a set from a given file.
 
-        :param path:    Path to set on disk
+        The file is memory-mapped and by default only read from disk as it
+        is accessed, so the first queries after opening may be slow. Use
+        `prefetch` to load it ahead of time and `access` to tell the
+        operating system how the set will be queried.
+
+        :param path:        Path to set on disk
+        :param keys:        Type of the keys, `'str'` for unicode strings or
+                            `'bytes'` for byte strings
+        :param prefetch:    `'none'` to load the file lazily, `'full'` to
+                            load it completely before returning or `'async'`
+                            to load it in a background thread, see
+                            :py:meth:`warmup`
+        :param access:      Expected access pattern, `'random'`,
+                            `'sequential'` or `'normal'`, passed to the
+                            operating system with `madvise` where supported
         """
-        self._ctx = ffi.gc(lib.fst_context_new(), lib.fst_context_free)
-        if path:
-            s = checked_call(lib.fst_set_open, self._ctx,
+        self._keys = keys
+        self._encode, self._decode = get_key_codec(keys)
+        pagecache.check_options(prefetch, access)
+        if path and pagecache.needs_mapping(prefetch, access):
+            _buffer = ffi.from_buffer(
+                pagecache.open_mapping(path, prefetch, access))
+            s = checked_call(lib.fst_set_from_buffer, _buffer, len(_buffer))
+        elif path:
+            s = checked_call(lib.fst_set_open,
                              ffi.new("char[]", path.encode('utf8')))
         else:
             s = _pointer
         self._ptr = ffi.gc(s, lib.fst_set_free)
+        # Buffer that the set borrows its data from, if it was loaded with
+        # `from_buffer` or mapped with hints
+        self._buffer = _buffer
+        self._path = path
+        # Index for `rank`/`select`, built or loaded on demand
+        self._ranks = None
+        if prefetch == 'async':
+            self.warmup()
+
+    def warmup(self):
+        """ Load the set into memory in a background thread.
+
+        The file is read sequentially into the page cache without holding
+        the GIL, after which the pages of a mapping made with `prefetch` or
+        `access` hints are faulted in. Queries can be run while the warmup
+        is in progress.
+
+        :returns:   The started `threading.Thread`, join it to wait for the
+                    warmup to finish
+        """
+        buf = ffi.buffer(self._buffer) if self._buffer is not None else None
+        return pagecache.warmup(path=self._path, buf=buf)
 
     def __contains__(self, val):
         """ Check if the set contains the value. """
-        return lib.fst_set_contains(
-            self._ptr, ffi.new("char[]", val.encode('utf8')))
+        key = self._encode(val)
+        return lib.fst_set_contains(self._ptr, key, len(key))
+
+    def contains_many(self, keys):
+        """ Check many keys for membership at once.
+
+        This is considerably faster than checking the keys one by one, since
+        the lookups are done in batches by the native library.
+
+        :param keys:    Sequence of keys, e.g. a list or a NumPy string or
+                        object array
+        :returns:       A NumPy `bool` array with the result for each key, or
+                        a `bytearray` with `0`/`1` bytes if NumPy is not
+                        installed
+        """
+        return contains_many(lib.fst_set_contains_many, self._ptr, keys,
+                             self._encode)
 
     def __iter__(self):
         """ Get an iterator over all keys in the set in lexicographical order.
@@ -177,16 +411,30 @@ class Set(object):
         """
         stream_ptr = lib.fst_set_stream(self._ptr)
         return KeyStreamIterator(stream_ptr, lib.fst_set_stream_next,
-                                 lib.fst_set_stream_free)
+                                 lib.fst_set_stream_free,
+                                 count_fn=lib.fst_set_stream_count,
+                                 batch_fn=lib.fst_set_stream_batch,
+                                 keys=self._keys)
 
     def __len__(self):
         """ Get the number of keys in the set. """
         return int(lib.fst_set_len(self._ptr))
 
+    def to_bytes(self):
+        """ Serialize the set.
+
+        The result has the same format as a set file on disk and can be
+        loaded again with :py:meth:`from_buffer`.
+
+        :returns:   The serialized set
+        :rtype:     bytes
+        """
+        return take_bytes(lib.fst_set_to_bytes, self._ptr)
+
     def __getitem__(self, s):
         """ Get an iterator over a range of set contents.
 
-        Start and stop indices of the slice must be unicode strings.
+        Start and stop indices of the slice must be of the set's key type.
 
         .. important::
             Slicing follows the semantics for numerical indices, i.e. the
@@ -205,17 +453,170 @@ class Set(object):
                 "Start key must be lexicographically smaller than stop.")
         sb_ptr = lib.fst_set_streambuilder_new(self._ptr)
         if s.start:
-            c_start = ffi.new("char[]", s.start.encode('utf8'))
-            sb_ptr = lib.fst_set_streambuilder_add_ge(sb_ptr, c_start)
+            start = self._encode(s.start)
+            sb_ptr = lib.fst_set_streambuilder_add_ge(sb_ptr, start,
+                                                      len(start))
         if s.stop:
-            c_stop = ffi.new("char[]", s.stop.encode('utf8'))
-            sb_ptr = lib.fst_set_streambuilder_add_lt(sb_ptr, c_stop)
+            stop = self._encode(s.stop)
+            sb_ptr = lib.fst_set_streambuilder_add_lt(sb_ptr, stop, len(stop))
+        stream_ptr = lib.fst_set_streambuilder_finish(sb_ptr)
+        return KeyStreamIterator(stream_ptr, lib.fst_set_stream_next,
+                                 lib.fst_set_stream_free,
+                                 count_fn=lib.fst_set_stream_count,
+                                 batch_fn=lib.fst_set_stream_batch,
+                                 keys=self._keys)
+
+    def to_arrays(self, start=None, stop=None):
+        """ Get the keys in a range of the set as columns.
+
+        See :py:meth:`rust_fst.common.StreamIterator.to_arrays` for the
+        format. Query results can be exported with their iterator's
+        `to_arrays` method, e.g. `s.search_re(pattern).to_arrays()`.
+
+        :param start:   Smallest key to include, defaults to the first key
+        :param stop:    Key to stop before (exclusive), defaults to the end of
+                        the set
+        :rtype:         :py:class:`rust_fst.common.Arrays`
+        """
+        return self[start:stop].to_arrays()
+
+    def query(self, query):
+        """ Search the set with a composite query.
+
+        All terms and bounds of the query are evaluated together in a single
+        traversal of the set, see :py:class:`rust_fst.Query`.
+
+        :param query:   A :py:class:`rust_fst.Query`
+        :returns:       An iterator over all matching keys in the set
+        :rtype:         :py:class:`KeyStreamIterator`
+        """
+        c_query, borrowed = query._compile(self._encode)
+        stream_ptr = lib.fst_set_querysearch(self._ptr, c_query)
+        return KeyStreamIterator(stream_ptr, lib.fst_set_querystream_next,
+                                 lib.fst_set_querystream_free,
+                                 (c_query, borrowed),
+                                 count_fn=lib.fst_set_querystream_count,
+                                 batch_fn=lib.fst_set_querystream_batch,
+                                 keys=self._keys)
+
+    def search_ranked(self, term, max_dist=None, k=None):
+        """ Search the set with a Levenshtein automaton and rank the
+            matches by their edit distance to the term.
+
+        Matches are ordered by edit distance and then by key. The distances
+        are computed and the top `k` matches are selected natively, so only
+        the returned matches are passed to Python.
+
+        :param term:        The search term or a compiled
+                            :py:class:`rust_fst.Levenshtein`
+        :param max_dist:    The maximum edit distance for search results,
+                            must be omitted for a compiled automaton
+        :param k:           Maximum number of matches to return, defaults to
+                            all matches
+        :returns:           List of `(key, distance)` tuples
+        """
+        lev = automaton.get_levenshtein(term, max_dist)
+        if k is None:
+            k = len(self)
+        return ranked_search(lib.fst_set_levsearch_ranked, self._ptr, lev, k,
+                             self._decode)
+
+    def prefix(self, prefix):
+        """ Get an iterator over all keys that start with a prefix.
+
+        The range of matching keys is computed natively on the encoded
+        prefix, which is also correct for non-ASCII input.
+
+        :param prefix:  The prefix, of the set's key type
+        :returns:       An iterator over the matching keys
+        :rtype:         :py:class:`KeyStreamIterator`
+        """
+        prefix = self._encode(prefix)
+        sb_ptr = lib.fst_set_streambuilder_new(self._ptr)
+        sb_ptr = lib.fst_set_streambuilder_add_prefix(sb_ptr, prefix,
+                                                      len(prefix))
         stream_ptr = lib.fst_set_streambuilder_finish(sb_ptr)
         return KeyStreamIterator(stream_ptr, lib.fst_set_stream_next,
-                                 lib.fst_set_stream_free)
+                                 lib.fst_set_stream_free,
+                                 count_fn=lib.fst_set_stream_count,
+                                 batch_fn=lib.fst_set_stream_batch,
+                                 keys=self._keys)
+
+    def count_prefix(self, prefix):
+        """ Count the keys that start with a prefix.
+
+        Use the `count()` method of the iterators returned by ranges,
+        searches and set operations to count other queries.
+
+        :param prefix:  The prefix, of the set's key type
+        :rtype:         int
+        """
+        return self.prefix(prefix).count()
+
+    def build_rank_index(self, path=None):
+        """ Build the index used by :py:meth:`rank` and :py:meth:`select`.
+
+        The index stores the number of keys below the nodes of the
+        transducer that lead to many keys. Building it visits every node
+        once, so for large sets pass a `path` to store it in a side file
+        and load it with :py:meth:`load_rank_index` the next time the set
+        is opened.
+
+        :param path:    Path to store the index at
+        """
+        self._ranks = build_side_index(
+            lib.fst_set_rankindex_build, lib.fst_rankindex_save,
+            lib.fst_rankindex_free, self._ptr, path)
+
+    def load_rank_index(self, path):
+        """ Load an index built with :py:meth:`build_rank_index`.
+
+        :param path:        Path of the stored index
+        :raises ValueError: If the index was built for a different set
+        """
+        self._ranks = load_side_index(
+            lib.fst_rankindex_open, lib.fst_set_rankindex_matches,
+            lib.fst_rankindex_free, self._ptr, path)
+
+    def rank(self, key):
+        """ Get the number of keys in the set that are lexicographically
+            smaller than a key.
+
+        For a key in the set, this is its position in iteration order,
+        i.e. a dense id in `range(len(self))`. The cost grows with the length
+        of the key, not with its position. If no rank index was built or
+        loaded, one is built in memory on the first call, see
+        :py:meth:`build_rank_index`.
+
+        :param key:     The key, of the set's key type
+        :rtype:         int
+        """
+        if self._ranks is None:
+            self.build_rank_index()
+        key = self._encode(key)
+        return lib.fst_set_rank(self._ptr, self._ranks, key, len(key))
+
+    def select(self, idx):
+        """ Get the key at a position in iteration order.
+
+        This is the inverse of :py:meth:`rank`, see there for the costs.
+
+        :param idx:         The position, negative values count from the end
+        :returns:           The key
+        :raises IndexError: If the position is out of range
+        """
+        num_keys = len(self)
+        if idx < 0:
+            idx += num_keys
+        if not 0 <= idx < num_keys:
+            raise IndexError("Set index out of range")
+        if self._ranks is None:
+            self.build_rank_index()
+        return take_batch(self._decode, lib.fst_set_select, self._ptr,
+                          self._ranks, idx)[0]
 
     def _make_opbuilder(self, *others):
-        opbuilder = OpBuilder(self._ptr)
+        opbuilder = OpBuilder(self._ptr, keys=self._keys)
         for oth in others:
             opbuilder.push(oth._ptr)
         return opbuilder
@@ -259,6 +660,65 @@ class Set(object):
         """
         return self._make_opbuilder(*others).symmetric_difference()
 
+    def union_into(self, path, *others):
+        """ Write the union of this set and others into a new set file.
+
+        Unlike building a set from :py:meth:`union`, the keys are streamed
+        from the operation into the new file by the native library, without
+        creating Python objects for them. This makes merging many sets into
+        one limited by I/O. The same applies to :py:meth:`intersection_into`,
+        :py:meth:`difference_into` and :py:meth:`symmetric_difference_into`.
+
+        :param path:    Path to build the new set in, which must not be the
+                        path of any of the sets
+        :param others:  List of :py:class:`Set` objects
+        :returns:       The new set
+        :rtype:         :py:class:`Set`
+        """
+        self._make_opbuilder(*others).union_into(path)
+        return Set(path, keys=self._keys)
+
+    def intersection_into(self, path, *others):
+        """ Write the intersection of this set and others into a new set
+            file.
+
+        See :py:meth:`union_into`.
+
+        :param path:    Path to build the new set in
+        :param others:  List of :py:class:`Set` objects
+        :returns:       The new set
+        :rtype:         :py:class:`Set`
+        """
+        self._make_opbuilder(*others).intersection_into(path)
+        return Set(path, keys=self._keys)
+
+    def difference_into(self, path, *others):
+        """ Write the difference of this set and others into a new set file.
+
+        See :py:meth:`union_into`.
+
+        :param path:    Path to build the new set in
+        :param others:  List of :py:class:`Set` objects
+        :returns:       The new set
+        :rtype:         :py:class:`Set`
+        """
+        self._make_opbuilder(*others).difference_into(path)
+        return Set(path, keys=self._keys)
+
+    def symmetric_difference_into(self, path, *others):
+        """ Write the symmetric difference of this set and others into a new
+            set file.
+
+        See :py:meth:`union_into`.
+
+        :param path:    Path to build the new set in
+        :param others:  List of :py:class:`Set` objects
+        :returns:       The new set
+        :rtype:         :py:class:`Set`
+        """
+        self._make_opbuilder(*others).symmetric_difference_into(path)
+        return Set(path, keys=self._keys)
+
     def issubset(self, other):
         """ Check if this set is a subset of another set.
 
@@ -306,30 +766,39 @@ class Set(object):
         For background on these limitations, consult the documentation of
         the Rust crate: http://burntsushi.net/rustdoc/fst/struct.Regex.html
 
-        :param pattern:     A regular expression
+        Compiled automata are looked up in :py:data:`rust_fst.automaton.cache`
+        to avoid recompiling the pattern on repeated searches.
+
+        :param pattern:     A regular expression or a compiled
+                            :py:class:`rust_fst.Regex`
         :returns:           An iterator over all matching keys in the set
         :rtype:             :py:class:`KeyStreamIterator`
         """
-        re_ptr = checked_call(
-            lib.fst_regex_new, self._ctx,
-            ffi.new("char[]", pattern.encode('utf8')))
-        stream_ptr = lib.fst_set_regexsearch(self._ptr, re_ptr)
+        regex = automaton.get_regex(pattern)
+        stream_ptr = lib.fst_set_regexsearch(self._ptr, regex._ptr)
         return KeyStreamIterator(stream_ptr, lib.fst_set_regexstream_next,
-                                 lib.fst_set_regexstream_free, re_ptr,
-                                 lib.fst_regex_free)
+                                 lib.fst_set_regexstream_free, regex,
+                                 count_fn=lib.fst_set_regexstream_count,
+                                 batch_fn=lib.fst_set_regexstream_batch,
+                                 keys=self._keys)
 
-    def search(self, term, max_dist):
+    def search(self, term, max_dist=None):
         """ Search the set with a Levenshtein automaton.
 
-        :param term:        The search term
-        :param max_dist:    The maximum edit distance for search results
+        Compiled automata are looked up in :py:data:`rust_fst.automaton.cache`
+        to avoid recompiling them on repeated searches.
+
+        :param term:        The search term or a compiled
+                            :py:class:`rust_fst.Levenshtein`
+        :param max_dist:    The maximum edit distance for search results,
+                            must be omitted for a compiled automaton
         :returns:           Iterator over matching values in the set
         :rtype:             :py:class:`KeyStreamIterator`
         """
-        lev_ptr = checked_call(
-            lib.fst_levenshtein_new, self._ctx,
-            ffi.new("char[]", term.encode('utf8')), max_dist)
-        stream_ptr = lib.fst_set_levsearch(self._ptr, lev_ptr)
+        lev = automaton.get_levenshtein(term, max_dist)
+        stream_ptr = lib.fst_set_levsearch(self._ptr, lev._ptr)
         return KeyStreamIterator(stream_ptr, lib.fst_set_levstream_next,
-                                 lib.fst_set_levstream_free, lev_ptr,
-                                 lib.fst_levenshtein_free)
+                                 lib.fst_set_levstream_free, lev,
+                                 count_fn=lib.fst_set_levstream_count,
+                                 batch_fn=lib.fst_set_levstream_batch,
+                                 keys=self._keys)
@@ -0,0 +1,556 @@
+""" Sets and maps that are split into multiple FST files by key range.
+
+Each shard holds a contiguous range of the key space, so shards can be built
+independently of each other in a pool of worker processes. A JSON manifest
+in the index directory records the shards in key order, along with their
+first and last keys.
+"""
+import binascii
+import bisect
+import heapq
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+from itertools import chain, groupby
+from operator import itemgetter
+
+from . import automaton, extsort
+from .common import (BATCH_SIZE, REDUCERS, IndexedValue, chunked,
+                     get_key_codec, pop_reducer)
+from .lib import TransducerError
+from .map import Map
+from .set import Set
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+#: Maximum number of input offsets that are sampled to find shard boundaries
+MAX_SAMPLES = 2 ** 16
+
+
+def _hexlify(key):
+    return binascii.hexlify(key).decode('ascii')
+
+
+def _build_shard(task):
+    """ Build a single shard from a byte range of the spilled input.
+
+    Runs in a worker process, hence the single tuple argument. The records
+    are read and inserted by the native library.
+    """
+    kind, spill_path, start, end, shard_path = task
+    shard_cls = Map if kind == 'map' else Set
+    with shard_cls.build(shard_path, keys='bytes') as builder:
+        builder.insert_records(spill_path, start, end)
+
+
+def _spill_input(it, kind, encode, spill_path):
+    """ Write the input to a record file in chunks, sampling its items.
+
+    The sampling stride is doubled whenever more than :py:data:`MAX_SAMPLES`
+    items were sampled, which keeps memory usage bounded.
+
+    :returns:   Tuple of the samples as `(offset, index, key, previous key)`
+                tuples, the number of items, the last key and the end offset
+                of the file
+    """
+    with_values = kind == 'map'
+    samples = []
+    stride = 1
+    num_items = 0
+    last_key = None
+    pos = 0
+    with open(spill_path, 'wb') as fp:
+        for chunk in chunked(it, BATCH_SIZE):
+            if with_values:
+                keys, vals = zip(*chunk)
+            else:
+                keys, vals = chunk, None
+            keys = list(map(encode, keys))
+            sample_pos = pos
+            prev_idx = 0
+            for idx in range(-num_items % stride, len(keys), stride):
+                sample_pos += extsort.records_size(keys[prev_idx:idx],
+                                                   with_values)
+                prev_idx = idx
+                samples.append((sample_pos, num_items + idx, keys[idx],
+                                keys[idx - 1] if idx else last_key))
+            while len(samples) > MAX_SAMPLES:
+                samples = samples[::2]
+                stride *= 2
+            pos += extsort.write_records(fp, keys, vals)
+            num_items += len(keys)
+            last_key = keys[-1]
+    return samples, num_items, last_key, pos
+
+
+def build_shards(it, path, kind, num_shards=None, processes=None,
+                 keys='str'):
+    """ Build a sharded set or map from a sorted iterator.
+
+    The input is written to a temporary file, which is then split into up to
+    `num_shards` ranges of roughly equal size that are built in parallel.
+
+    :param it:          Iterator over keys (sets) or (key, value) pairs (maps)
+                        in lexicographical order
+    :param path:        Directory to write shards and manifest to
+    :param kind:        Either `'set'` or `'map'`
+    :param num_shards:  Number of shards, defaults to the number of CPUs
+    :param processes:   Number of worker processes, defaults to `num_shards`.
+                        With a value of 1, shards are built in the calling
+                        process.
+    :param keys:        Type of the keys, `'str'` or `'bytes'`
+    """
+    encode = get_key_codec(keys)[0]
+    if num_shards is None:
+        num_shards = multiprocessing.cpu_count()
+    if processes is None:
+        processes = num_shards
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    spill_dir = tempfile.mkdtemp(prefix='rust_fst-', dir=path)
+    try:
+        spill_path = os.path.join(spill_dir, 'input')
+        samples, num_items, last_key, end = _spill_input(it, kind, encode,
+                                                         spill_path)
+        bounds = sorted(set(samples[len(samples) * idx // num_shards]
+                            for idx in range(num_shards)
+                            if samples))
+        # The builders only see the keys of their own shard, so the order is
+        # checked across shard boundaries here
+        for _, _, first, prev in bounds[1:]:
+            if prev >= first:
+                raise TransducerError(
+                    "Keys must be in lexicographical order and unique, but "
+                    "{!r} was followed by {!r}".format(prev, first))
+        tasks = []
+        shards = []
+        for idx, (start, first_idx, first, _) in enumerate(bounds):
+            if idx + 1 < len(bounds):
+                shard_end, next_idx, _, last = bounds[idx + 1]
+            else:
+                shard_end, next_idx, last = end, num_items, last_key
+            shard_name = 'shard-{:05}.fst'.format(idx)
+            tasks.append((kind, spill_path, start, shard_end,
+                          os.path.join(path, shard_name)))
+            shards.append({'path': shard_name,
+                           'first': _hexlify(first),
+                           'last': _hexlify(last),
+                           'len': next_idx - first_idx})
+        if processes == 1 or len(tasks) < 2:
+            for task in tasks:
+                _build_shard(task)
+        else:
+            pool = multiprocessing.Pool(min(processes, len(tasks)))
+            try:
+                pool.map(_build_shard, tasks)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'type': kind,
+        'keys': keys,
+        'shards': shards,
+    }
+    with open(os.path.join(path, MANIFEST_NAME), 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+
+
+def _tag_stream(stream, idx):
+    for key, val in stream:
+        yield key, idx, val
+
+
+def _merge_streams(streams):
+    """ Merge sorted (key, value) streams into (key, (IndexedValue, ...)). """
+    merged = heapq.merge(*[_tag_stream(stream, idx)
+                           for idx, stream in enumerate(streams)])
+    for key, group in groupby(merged, key=itemgetter(0)):
+        yield key, tuple(IndexedValue(idx, val) for _, idx, val in group)
+
+
+#: Predicates for keys in the result of an operation, given the merged values
+#: and the number of operands
+_OP_FILTERS = {
+    'union': lambda vals, num: True,
+    'intersection': lambda vals, num: len(vals) == num,
+    'difference': lambda vals, num: len(vals) == 1 and vals[0].index == 0,
+    'symmetric_difference': lambda vals, num: len(vals) % 2 == 1,
+}
+
+
+def _run_op(op, streams):
+    keep = _OP_FILTERS[op]
+    return ((key, vals) for key, vals in _merge_streams(streams)
+            if keep(vals, len(streams)))
+
+
+def _run_key_op(op, operands):
+    streams = [((key, None) for key in operand) for operand in operands]
+    return (key for key, _ in _run_op(op, streams))
+
+
+class _ShardedBase(object):
+    _kind = None
+    _shard_cls = None
+
+    @classmethod
+    def from_iter(cls, it, path, num_shards=None, processes=None,
+                  keys='str'):
+        """ Build a new sharded index from an iterator.
+
+        The input must be in lexicographical order. It is split into
+        `num_shards` contiguous key ranges that are built in a pool of
+        `processes` worker processes.
+
+        :param it:          Iterator to build the index with
+        :param path:        Directory to store the shards and the manifest in
+        :param num_shards:  Number of shards, defaults to the number of CPUs
+        :param processes:   Number of worker processes, defaults to the
+                            number of shards
+        :param keys:        Type of the keys, `'str'` for unicode strings or
+                            `'bytes'` for byte strings
+        :returns:           The finished index
+        """
+        build_shards(it, path, cls._kind, num_shards=num_shards,
+                     processes=processes, keys=keys)
+        return cls(path)
+
+    def __init__(self, path):
+        """ Load a sharded index from a directory.
+
+        :param path:    Directory that contains the manifest and the shards
+        """
+        with open(os.path.join(path, MANIFEST_NAME)) as fp:
+            manifest = json.load(fp)
+        if manifest['type'] != self._kind:
+            raise ValueError("Manifest describes a {}, not a {}".format(
+                manifest['type'], self._kind))
+        self._keys = manifest['keys']
+        self._encode = get_key_codec(self._keys)[0]
+        self._shards = [
+            self._shard_cls(os.path.join(path, shard['path']),
+                            keys=self._keys)
+            for shard in manifest['shards']]
+        self._firsts = [binascii.unhexlify(s['first'])
+                        for s in manifest['shards']]
+        self._lasts = [binascii.unhexlify(s['last'])
+                       for s in manifest['shards']]
+
+    @property
+    def shards(self):
+        """ The individual shards in key order. """
+        return list(self._shards)
+
+    def _shard_for(self, key):
+        """ Get the only shard that can contain the key, or `None`. """
+        idx = bisect.bisect_right(self._firsts, self._encode(key)) - 1
+        if idx < 0:
+            return None
+        return self._shards[idx]
+
+    def _shards_for_range(self, start, stop):
+        if start and stop and start > stop:
+            raise ValueError(
+                "Start key must be lexicographically smaller than stop.")
+        start = self._encode(start) if start else None
+        stop = self._encode(stop) if stop else None
+        return [shard for shard, first, last
+                in zip(self._shards, self._firsts, self._lasts)
+                if (start is None or last >= start)
+                and (stop is None or first < stop)]
+
+    def _shards_for_prefix(self, prefix):
+        prefix = self._encode(prefix)
+        return [shard for shard, first, last
+                in zip(self._shards, self._firsts, self._lasts)
+                if last >= prefix
+                and (first < prefix or first.startswith(prefix))]
+
+    def __contains__(self, key):
+        shard = self._shard_for(key)
+        return shard is not None and key in shard
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def prefix(self, prefix):
+        """ Get an iterator over all matches for a prefix in key order.
+
+        See :py:meth:`rust_fst.Set.prefix` and :py:meth:`rust_fst.Map.prefix`
+        for the semantics.
+        """
+        return chain.from_iterable(
+            shard.prefix(prefix) for shard in self._shards_for_prefix(prefix))
+
+    def count_prefix(self, prefix):
+        """ Count the keys that start with a prefix. """
+        return sum(shard.count_prefix(prefix)
+                   for shard in self._shards_for_prefix(prefix))
+
+    def search_re(self, pattern):
+        """ Search all shards with a regular expression.
+
+        See :py:meth:`rust_fst.Set.search_re` for the supported syntax.
+
+        :param pattern:     A regular expression or a compiled
+                            :py:class:`rust_fst.Regex`
+        :returns:           An iterator over all matches in key order
+        """
+        # Compile once up front instead of looking it up for every shard
+        pattern = automaton.get_regex(pattern)
+        return chain.from_iterable(shard.search_re(pattern)
+                                   for shard in self._shards)
+
+    def search(self, term, max_dist=None):
+        """ Search all shards with a Levenshtein automaton.
+
+        :param term:        The search term or a compiled
+                            :py:class:`rust_fst.Levenshtein`
+        :param max_dist:    The maximum edit distance for search results,
+                            must be omitted for a compiled automaton
+        :returns:           An iterator over all matches in key order
+        """
+        lev = automaton.get_levenshtein(term, max_dist)
+        return chain.from_iterable(shard.search(lev)
+                                   for shard in self._shards)
+
+    def query(self, query):
+        """ Search the shards that overlap the bounds of a composite query.
+
+        See :py:class:`rust_fst.Query` for the semantics.
+
+        :param query:   A :py:class:`rust_fst.Query`
+        :returns:       An iterator over all matches in key order
+        """
+        lower, upper = query.bounds
+        lower = self._encode(lower[0]) if lower else None
+        upper = self._encode(upper[0]) if upper else None
+        # Bounds are treated as inclusive, which at worst searches one shard
+        # too many
+        shards = [shard for shard, first, last
+                  in zip(self._shards, self._firsts, self._lasts)
+                  if (lower is None or last >= lower)
+                  and (upper is None or first <= upper)]
+        return chain.from_iterable(shard.query(query) for shard in shards)
+
+    def search_ranked(self, term, max_dist=None, k=None):
+        """ Search all shards with a Levenshtein automaton and rank the
+            matches by their edit distance to the term.
+
+        See :py:meth:`rust_fst.Set.search_ranked` and
+        :py:meth:`rust_fst.Map.search_ranked` for the semantics.
+        """
+        lev = automaton.get_levenshtein(term, max_dist)
+        ranked = sorted(chain.from_iterable(shard.search_ranked(lev, k=k)
+                                            for shard in self._shards),
+                        key=self._rank_key)
+        return ranked if k is None else ranked[:k]
+
+
+class ShardedSet(_ShardedBase):
+    """ An immutable ordered string set that is split into multiple
+        :py:class:`rust_fst.Set` shards by key range.
+
+    Use :py:meth:`from_iter` to build a sharded set in parallel and open an
+    existing one by passing its directory to the constructor.
+
+    Lookups only query the shard that owns the key, while iteration, range
+    queries and searches concatenate the results of the shards in key order.
+    Set operations accept both sharded and regular sets as operands.
+    """
+    _kind = 'set'
+    _shard_cls = Set
+
+    def _rank_key(self, match):
+        key, distance = match
+        return distance, self._encode(key)
+
+    def __iter__(self):
+        return chain.from_iterable(self._shards)
+
+    def __getitem__(self, s):
+        """ Get an iterator over a range of set contents.
+
+        See :py:meth:`rust_fst.Set.__getitem__` for the semantics.
+        """
+        if not isinstance(s, slice):
+            raise ValueError(
+                "Value must be a string slice (e.g. `['foo':]`)")
+        return chain.from_iterable(
+            shard[s] for shard in self._shards_for_range(s.start, s.stop))
+
+    def union(self, *others):
+        """ Get an iterator over the keys in the union of this set and others.
+
+        :param others:  List of :py:class:`ShardedSet` or
+                        :py:class:`rust_fst.Set` objects
+        """
+        return _run_key_op('union', (self,) + others)
+
+    def intersection(self, *others):
+        """ Get an iterator over the keys in the intersection of this set and
+            others.
+
+        :param others:  List of :py:class:`ShardedSet` or
+                        :py:class:`rust_fst.Set` objects
+        """
+        return _run_key_op('intersection', (self,) + others)
+
+    def difference(self, *others):
+        """ Get an iterator over the keys in the difference of this set and
+            others.
+
+        :param others:  List of :py:class:`ShardedSet` or
+                        :py:class:`rust_fst.Set` objects
+        """
+        return _run_key_op('difference', (self,) + others)
+
+    def symmetric_difference(self, *others):
+        """ Get an iterator over the keys in the symmetric difference of this
+            set and others.
+
+        :param others:  List of :py:class:`ShardedSet` or
+                        :py:class:`rust_fst.Set` objects
+        """
+        return _run_key_op('symmetric_difference', (self,) + others)
+
+    def issubset(self, other):
+        """ Check if this set is a subset of another set. """
+        return next(_run_key_op('difference', (self, other)), None) is None
+
+    def issuperset(self, other):
+        """ Check if this set is a superset of another set. """
+        return next(_run_key_op('difference', (other, self)), None) is None
+
+    def isdisjoint(self, other):
+        """ Check if this set is disjoint to another set. """
+        return next(self.intersection(other), None) is None
+
+
+class ShardedMap(_ShardedBase):
+    """ An immutable map of keys to unsigned integers that is split into
+        multiple :py:class:`rust_fst.Map` shards by key range.
+
+    Use :py:meth:`from_iter` to build a sharded map in parallel and open an
+    existing one by passing its directory to the constructor.
+
+    Lookups only query the shard that owns the key, while iteration, range
+    queries and searches concatenate the results of the shards in key order.
+    Set operations accept both sharded and regular maps as operands and
+    return the same `(key, (IndexedValue, ...))` pairs as
+    :py:meth:`rust_fst.Map.union`.
+    """
+    _kind = 'map'
+    _shard_cls = Map
+
+    def _rank_key(self, match):
+        key, value, distance = match
+        return distance, -value, self._encode(key)
+
+    def top_completions(self, prefix, k):
+        """ Get the `k` items with the highest values whose keys start with a
+            prefix.
+
+        See :py:meth:`rust_fst.Map.top_completions` for the semantics. The
+        completion index of every shard is built on first use.
+        """
+        completions = chain.from_iterable(
+            shard.top_completions(prefix, k)
+            for shard in self._shards_for_prefix(prefix))
+        return sorted(completions,
+                      key=lambda item: (-item[1], self._encode(item[0])))[:k]
+
+    def __iter__(self):
+        return self.keys()
+
+    def __getitem__(self, key):
+        """ Get the value for a key or a range of (key, value) pairs.
+
+        See :py:meth:`rust_fst.Map.__getitem__` for the semantics.
+        """
+        if isinstance(key, slice):
+            return chain.from_iterable(
+                shard[key]
+                for shard in self._shards_for_range(key.start, key.stop))
+        shard = self._shard_for(key)
+        if shard is None:
+            raise KeyError(key)
+        return shard[key]
+
+    def get(self, key, default=None):
+        """ Get the value for a key, or a default value if it is not in the
+            map.
+        """
+        shard = self._shard_for(key)
+        if shard is None:
+            return default
+        return shard.get(key, default)
+
+    def keys(self):
+        """ Get an iterator over all keys in the map. """
+        return chain.from_iterable(shard.keys() for shard in self._shards)
+
+    def values(self):
+        """ Get an iterator over all values in the map. """
+        return chain.from_iterable(shard.values() for shard in self._shards)
+
+    def items(self):
+        """ Get an iterator over all (key, value) pairs in the map. """
+        return chain.from_iterable(shard.items() for shard in self._shards)
+
+    def _run_op(self, op, others, kwargs):
+        reducer = pop_reducer(kwargs)
+        items = _run_op(op, [operand.items() for operand in (self,) + others])
+        if reducer is None:
+            return items
+        reduce_fn = REDUCERS[reducer][1]
+        return ((key, reduce_fn(vals)) for key, vals in items)
+
+    def union(self, *others, **kwargs):
+        """ Get an iterator over the items in the union of this map and others.
+
+        :param others:  List of :py:class:`ShardedMap` or
+                        :py:class:`rust_fst.Map` objects
+        :param reduce:  Name of the function to combine the values of each
+                        key with, see :py:meth:`rust_fst.Map.union`
+        """
+        return self._run_op('union', others, kwargs)
+
+    def intersection(self, *others, **kwargs):
+        """ Get an iterator over the items in the intersection of this map and
+            others.
+
+        :param others:  List of :py:class:`ShardedMap` or
+                        :py:class:`rust_fst.Map` objects
+        :param reduce:  Name of the function to combine the values of each
+                        key with, see :py:meth:`rust_fst.Map.union`
+        """
+        return self._run_op('intersection', others, kwargs)
+
+    def difference(self, *others, **kwargs):
+        """ Get an iterator over the items in the difference of this map and
+            others.
+
+        :param others:  List of :py:class:`ShardedMap` or
+                        :py:class:`rust_fst.Map` objects
+        :param reduce:  Name of the function to combine the values of each
+                        key with, see :py:meth:`rust_fst.Map.union`
+        """
+        return self._run_op('difference', others, kwargs)
+
+    def symmetric_difference(self, *others, **kwargs):
+        """ Get an iterator over the items in the symmetric difference of this
+            map and others.
+
+        :param others:  List of :py:class:`ShardedMap` or
+                        :py:class:`rust_fst.Map` objects
+        :param reduce:  Name of the function to combine the values of each
+                        key with, see :py:meth:`rust_fst.Map.union`
+        """
+        return self._run_op('symmetric_difference', others, kwargs)
@@ -36,6 +36,7 @@ setup(
     platforms='any',
     setup_requires=['milksnake'],
     install_requires=['milksnake'],
+    extras_require={'numpy': ['numpy']},
     milksnake_tasks=[build_native],
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
+import threading
+
 import pytest
 
 import rust_fst.lib as lib
-from rust_fst import Map
+from rust_fst import (Levenshtein, Map, MutableMap, Query, Set, ShardedMap,
+                      fanout)
+from rust_fst.automaton import cache
 
 
 TEST_ITEMS = [(u"möö", 1), (u"bar", 2), (u"baz", 1337), (u"foo", 2**16)]
@@ -131,3 +135,467 @@ def test_range(fst_map):
     assert dict(fst_map['baz':'m']) == {'baz': 1337, 'foo': 2**16}
     with pytest.raises(ValueError):
         fst_map['c':'a']
+
+
+def test_build_insert_many(tmpdir):
+    fst_path = str(tmpdir.join('test.fst'))
+    keys, vals = zip(*sorted(TEST_ITEMS))
+    with Map.build(fst_path) as builder:
+        builder.insert_many(keys[:2], vals[:2])
+        builder.insert_many([], [])
+        builder.insert_many(iter(keys[2:]), (val for val in vals[2:]))
+    assert list(Map(fst_path).items()) == sorted(TEST_ITEMS)
+
+
+def test_build_insert_many_length_mismatch():
+    with Map.build() as builder:
+        with pytest.raises(ValueError):
+            builder.insert_many(["bar", "foo"], [1])
+        with pytest.raises(ValueError):
+            builder.insert_many([], [1])
+
+
+def test_build_batched():
+    items = [("key{:05}".format(i), i) for i in range(1000)]
+    m = Map.from_iter(items, batch_size=7)
+    assert list(m.items()) == items
+
+
+def test_bytes_keys():
+    items = [(b"\x00bar", 1), (b"baz", 2), (b"f\x00o", 3), (b"\xff\xfe", 4)]
+    m = Map.from_iter(items, keys='bytes')
+    assert list(m.items()) == items
+    assert list(m.keys()) == [k for k, _ in items]
+    assert m[b"f\x00o"] == 3
+    assert b"\xff\xfe" in m
+    assert dict(m[b'baz':]) == dict(items[1:])
+    with pytest.raises(KeyError):
+        m[b"f"]
+    other = Map.from_iter([(b"baz", 5)], keys='bytes')
+    assert dict(m.intersection(other)) == {b"baz": ((0, 2), (1, 5))}
+
+
+@pytest.mark.parametrize(("duplicates", "expected"), [
+    ("first", {"bar": 1, "foo": 3}),
+    ("last", {"bar": 4, "foo": 2}),
+    ("sum", {"bar": 5, "foo": 5}),
+    ("min", {"bar": 1, "foo": 2}),
+    ("max", {"bar": 4, "foo": 3}),
+])
+def test_build_unsorted(duplicates, expected):
+    items = [("foo", 3), ("bar", 1), ("foo", 2), ("bar", 4)]
+    m = Map.from_unsorted(items, duplicates=duplicates, memory_limit=1)
+    assert dict(m.items()) == expected
+
+
+def test_build_unsorted_badpolicy(tmpdir):
+    path = str(tmpdir.join('bad.fst'))
+    with pytest.raises(ValueError):
+        Map.from_unsorted(TEST_ITEMS, path=path, duplicates="median")
+    assert not tmpdir.join('bad.fst').check()
+
+
+def test_build_unsorted_sum_saturates():
+    m = Map.from_unsorted([("foo", 2**64 - 1), ("foo", 1)], duplicates="sum",
+                          memory_limit=1)
+    assert m["foo"] == 2**64 - 1
+
+
+def test_sharded(tmpdir):
+    items = [("key{:04}".format(i), i) for i in range(0, 1000, 3)]
+    fst_map = ShardedMap.from_iter(items, str(tmpdir.join('sharded')),
+                                   num_shards=4, processes=2)
+    assert len(fst_map) == len(items)
+    assert list(fst_map.items()) == items
+    assert fst_map["key0999"] == 999
+    with pytest.raises(KeyError):
+        fst_map["a"]
+    assert fst_map.get("a", 7) == 7
+    assert fst_map.get("key0003") == 3
+    assert list(fst_map["key0100":"key0110"]) == [
+        ("key0102", 102), ("key0105", 105), ("key0108", 108)]
+    union = dict(fst_map.union(Map.from_iter([("key0001", 1)])))
+    assert len(union) == len(items) + 1
+    assert union["key0001"] == ((1, 1),)
+    other = Map.from_iter([("key0003", 7)])
+    assert list(fst_map.intersection(other, reduce='sum')) == [
+        ("key0003", 10)]
+
+
+def test_from_file(tmpdir):
+    src = tmpdir.join('items.tsv')
+    src.write_binary(u"bar\t2\r\nbaz\t1337\n\nfoo\t65536\nmöö\t1"
+                     .encode('utf8'))
+    fst_path = str(tmpdir.join('test.fst'))
+    fst_map = Map.from_file(str(src), fst_path)
+    assert list(fst_map.items()) == sorted(TEST_ITEMS)
+    assert list(Map.from_file(str(src)).items()) == sorted(TEST_ITEMS)
+
+
+def test_from_file_sep(tmpdir):
+    src = tmpdir.join('items.csv')
+    src.write("a,b,1\nc,2\n")
+    fst_map = Map.from_file(str(src), sep=',')
+    assert list(fst_map.items()) == [("a,b", 1), ("c", 2)]
+    with pytest.raises(ValueError):
+        Map.from_file(str(src), sep='')
+
+
+@pytest.mark.parametrize("contents", [
+    "bar\t1\nbaz\t-1\n",
+    "bar\t1\nbaz\tfoo\n",
+    "bar\t1\nbaz 2\n",
+])
+def test_from_file_invalid(tmpdir, contents):
+    src = tmpdir.join('items.tsv')
+    src.write(contents)
+    with pytest.raises(ValueError) as excinfo:
+        Map.from_file(str(src))
+    assert "line 2" in str(excinfo.value)
+
+
+def test_to_bytes():
+    fst_map = Map.from_iter(sorted(TEST_ITEMS))
+    data = fst_map.to_bytes()
+    loaded = Map.from_buffer(bytearray(data))
+    assert list(loaded.items()) == sorted(TEST_ITEMS)
+    assert loaded[u"möö"] == 1
+
+
+def test_open_prefetch(tmpdir):
+    fst_path = str(tmpdir.join('test.fst'))
+    Map.from_iter(sorted(TEST_ITEMS), fst_path)
+    fst_map = Map(fst_path, prefetch="full", access="random")
+    assert fst_map["bar"] == 2
+    fst_map.warmup().join()
+    assert list(fst_map.items()) == sorted(TEST_ITEMS)
+
+
+def test_contains_many():
+    fst_map = Map.from_iter(sorted(TEST_ITEMS))
+    result = fst_map.contains_many(["bar", "qux", u"möö"])
+    assert list(result) == [True, False, True]
+
+
+def test_get_many():
+    fst_map = Map.from_iter(sorted(TEST_ITEMS))
+    keys = ["bar", "qux", u"möö", "foo"]
+    assert list(fst_map.get_many(keys)) == [2, 0, 1, 2**16]
+    assert list(fst_map.get_many(keys, default=2**64 - 1)) == [
+        2, 2**64 - 1, 1, 2**16]
+    values, found = fst_map.get_many(iter(keys), mask=True)
+    assert list(values) == [2, 0, 1, 2**16]
+    assert list(found) == [True, False, True, True]
+    assert len(fst_map.get_many([])) == 0
+    with pytest.raises(TypeError):
+        fst_map.get_many(keys, default=None)
+    for default in (-1, 2**64):
+        with pytest.raises(ValueError):
+            fst_map.get_many(keys, default=default)
+
+
+def test_get_many_batches():
+    fst_map = Map.from_iter(("key{:05}".format(i), i)
+                            for i in range(0, 10000, 2))
+    keys = ["key{:05}".format(i) for i in range(10000)]
+    values, found = fst_map.get_many(keys, mask=True)
+    assert list(values) == [i if i % 2 == 0 else 0 for i in range(10000)]
+    assert list(found) == [i % 2 == 0 for i in range(10000)]
+
+
+def test_get_many_numpy():
+    np = pytest.importorskip("numpy")
+    fst_map = Map.from_iter(sorted(TEST_ITEMS))
+    values, found = fst_map.get_many(np.array(["baz", "qux"]), mask=True)
+    assert values.dtype == np.uint64 and found.dtype == np.bool_
+    assert values.tolist() == [1337, 0]
+    assert found.tolist() == [True, False]
+
+
+def test_get():
+    fst_map = Map.from_iter(sorted(TEST_ITEMS))
+    assert fst_map.get("bar") == 2
+    assert fst_map.get(u"möö", 42) == 1
+    assert fst_map.get("qux") is None
+    assert fst_map.get("qux", 42) == 42
+    with pytest.raises(KeyError) as excinfo:
+        fst_map["qux"]
+    assert excinfo.value.args == ("qux",)
+
+
+def test_error_reset():
+    fst_map = Map.from_iter(sorted(TEST_ITEMS))
+    with pytest.raises(lib.RegexError):
+        list(fst_map.search_re(r'(foo'))
+    assert list(fst_map.search_re(r'ba.*')) == [("bar", 2), ("baz", 1337)]
+
+
+def test_concurrent_reads():
+    items = [("key{:05}".format(i), i) for i in range(0, 10000, 2)]
+    fst_map = Map.from_iter(items)
+    errors = []
+
+    def query():
+        try:
+            for i in range(1000):
+                idx = i * 37 % 10000
+                expected = idx if idx % 2 == 0 else None
+                assert fst_map.get("key{:05}".format(idx)) == expected
+                with pytest.raises(lib.RegexError):
+                    fst_map.search_re(r'(key')
+            values, found = fst_map.get_many([k for k, _ in items],
+                                             mask=True)
+            assert list(values) == [v for _, v in items]
+            assert all(found)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=query) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_search_cached(fst_map):
+    cache.clear()
+    assert list(fst_map.search("bam", 1)) == [(u"bar", 2), (u"baz", 1337)]
+    assert list(fst_map.search("bam", 1)) == [(u"bar", 2), (u"baz", 1337)]
+    assert list(fst_map.search_re(r'ba.*')) == [(u"bar", 2), (u"baz", 1337)]
+    info = cache.info()
+    assert (info.hits, info.misses, info.entries) == (1, 2, 2)
+    lev = Levenshtein("foo", 0)
+    assert list(fst_map.search(lev)) == [(u"foo", 2**16)]
+    assert cache.info().misses == 2
+
+
+def test_prefix(fst_map):
+    assert list(fst_map.prefix("ba")) == [(u"bar", 2), (u"baz", 1337)]
+    assert list(fst_map.prefix(u"m\xf6")) == [(u"m\xf6\xf6", 1)]
+    assert fst_map.count_prefix("b") == 2
+    assert fst_map.count_prefix("") == len(fst_map)
+    assert fst_map.search_re(r'.*o.*').count() == 1
+    assert fst_map.union(fst_map).count() == len(fst_map)
+
+
+def test_take(fst_map):
+    assert fst_map.search_re(r'.*').take(2, offset=1) == [(u"baz", 1337),
+                                                          (u"foo", 2**16)]
+    assert fst_map.items().take(1) == [(u"bar", 2)]
+    assert fst_map.prefix(u"m").take(3) == [(u"möö", 1)]
+    assert fst_map.union(fst_map).take(1, offset=3)[0][0] == u"möö"
+
+
+def test_search_ranked():
+    fst_map = Map.from_iter([("bam", 1), ("bar", 5), ("bas", 7), ("cam", 5)])
+    assert fst_map.search_ranked("bam", 1) == [
+        ("bam", 1, 0), ("bas", 7, 1), ("bar", 5, 1), ("cam", 5, 1)]
+    assert fst_map.search_ranked("bam", 1, k=2) == [("bam", 1, 0),
+                                                     ("bas", 7, 1)]
+
+
+def test_top_completions(tmpdir):
+    items = [(u"bar", 3), (u"bark", 10), (u"barn", 7), (u"bat", 10),
+             (u"baz", 1), (u"foo", 20), (u"m\xf6\xf6", 5), (u"m\xf6w", 8)]
+    fst_map = Map.from_iter(items)
+    assert fst_map.top_completions("ba", 3) == [(u"bark", 10), (u"bat", 10),
+                                                (u"barn", 7)]
+    assert fst_map.top_completions("bar", 10) == [(u"bark", 10), (u"barn", 7),
+                                                  (u"bar", 3)]
+    assert fst_map.top_completions(u"m\xf6", 1) == [(u"m\xf6w", 8)]
+    assert fst_map.top_completions("", 2) == [(u"foo", 20), (u"bark", 10)]
+    assert fst_map.top_completions("x", 5) == []
+    assert fst_map.top_completions("ba", 0) == []
+
+    path = str(tmpdir.join('completions.idx'))
+    fst_map.build_completion_index(path)
+    other_map = Map.from_iter(items)
+    other_map.load_completion_index(path)
+    assert other_map.top_completions("b", 1) == [(u"bark", 10)]
+    with pytest.raises(ValueError):
+        Map.from_iter(items[:3]).load_completion_index(path)
+
+
+def test_rank_select():
+    items = [("key{:05d}".format(i), i * 3) for i in range(200)]
+    fst_map = Map.from_iter(items)
+    for idx in (0, 1, 63, 64, 199):
+        assert fst_map.select(idx) == items[idx]
+        assert fst_map.rank(items[idx][0]) == idx
+    assert fst_map.select(-200) == items[0]
+    assert fst_map.rank("key00100\xff") == 101
+    with pytest.raises(IndexError):
+        fst_map.select(200)
+
+
+def test_query():
+    fst_map = Map.from_iter([("bar", 1), ("baz", 2), ("foo", 3), ("fop", 4),
+                             ("moo", 5)])
+    query = Query().search("foo", 1).search_re(r'f.*', negate=True)
+    assert list(fst_map.query(query)) == [("moo", 5)]
+    query = Query().gt("bar").le("fop").search_re(r'.*[oz]')
+    assert list(fst_map.query(query)) == [("baz", 2), ("foo", 3)]
+    assert fst_map.query(Query().prefix("fo")).count() == 2
+
+
+def test_next_batch():
+    items = [("key{:05d}".format(i), i) for i in range(3000)]
+    fst_map = Map.from_iter(items)
+    assert list(fst_map.items()) == items
+    assert list(fst_map.keys()) == [key for key, _ in items]
+    it = fst_map.keys()
+    next(it)
+    assert it.count() == 2999
+    assert list(fst_map.values()) == list(range(3000))
+    it = fst_map.values()
+    assert it.next_batch(2) == [0, 1]
+    assert it.take(2, offset=1) == [3, 4]
+    it = fst_map.union(Map.from_iter({'key00001': 7}))
+    it.batch_size = 2
+    assert next(it) == ('key00000', ((0, 0),))
+    assert it.next_batch(2) == [('key00001', ((0, 1), (1, 7))),
+                                ('key00002', ((0, 2),))]
+    assert it.count() == 2997
+
+
+def test_to_arrays():
+    fst_map = Map.from_iter([("bar", 1), ("baz", 2), ("foo", 3)])
+    arrays = fst_map.to_arrays()
+    assert list(arrays.offsets) == [0, 3, 6, 9]
+    assert bytes(arrays.data) == b"barbazfoo"
+    assert list(arrays.values) == [1, 2, 3]
+    arrays = fst_map.to_arrays(start="baz")
+    assert bytes(arrays.data) == b"bazfoo"
+    assert list(arrays.values) == [2, 3]
+    arrays = fst_map.search_re(r'x.*').to_arrays()
+    assert list(arrays.offsets) == [0]
+    assert len(arrays.values) == 0
+    assert list(fst_map.values().to_arrays().values) == [1, 2, 3]
+    other = Map.from_iter([("bar", 4)])
+    with pytest.raises(TypeError):
+        fst_map.union(other).to_arrays()
+    arrays = fst_map.union(other, reduce='sum').to_arrays()
+    assert list(arrays.values) == [5, 2, 3]
+
+
+def test_value_reductions():
+    items = [("key{:03d}".format(i), i * 10) for i in range(100)]
+    fst_map = Map.from_iter(items)
+    assert list(fst_map.values_array()) == [value for _, value in items]
+    assert list(fst_map.values_array("key010", "key013")) == [100, 110, 120]
+    assert list(fst_map.search_re(r'key00.').values_array()) == list(
+        range(0, 100, 10))
+    assert fst_map.values().sum() == sum(range(0, 1000, 10))
+    assert fst_map["key050":].min() == 500
+    assert fst_map.prefix("key01").max() == 190
+    assert fst_map.values().stats() == (100, 49500, 0, 990)
+    assert list(fst_map.values().histogram([0, 100, 500, 990])) == [
+        10, 40, 50]
+    it = fst_map.items()
+    next(it)
+    assert it.stats() == (99, 49500, 10, 990)
+    assert fst_map.search_re(r'x').stats() == (0, 0, None, None)
+    with pytest.raises(ValueError):
+        fst_map.search_re(r'x').max()
+    with pytest.raises(ValueError):
+        fst_map.values().histogram([5, 5])
+    for bins in ([0, 2.5], [-1, 5], [0, 2 ** 64], [0, float('inf')]):
+        with pytest.raises(ValueError):
+            fst_map.values().histogram(bins)
+    assert list(fst_map.values().histogram([0.0, 100.0])) == [10]
+
+    big_map = Map.from_iter([("a", 2 ** 64 - 1), ("b", 2 ** 64 - 1)])
+    assert big_map.values().sum() == 2 ** 65 - 2
+
+
+def test_map_op_reduce():
+    a = Map.from_iter({'bar': 8, 'baz': 16})
+    b = Map.from_iter({'bar': 32, 'moo': 64})
+    c = Map.from_iter({'bar': 4, 'moo': 2})
+    assert list(a.union(b, c, reduce='sum')) == [
+        ('bar', 44), ('baz', 16), ('moo', 66)]
+    assert dict(a.union(b, c, reduce='min'))['bar'] == 4
+    assert dict(a.union(b, c, reduce='max'))['bar'] == 32
+    assert dict(a.union(b, c, reduce='first')) == {
+        'bar': 8, 'baz': 16, 'moo': 64}
+    assert dict(a.union(b, c, reduce='last')) == {
+        'bar': 4, 'baz': 16, 'moo': 2}
+    assert dict(a.union(b, c, reduce='count')) == {
+        'bar': 3, 'baz': 1, 'moo': 2}
+    assert list(a.intersection(b, reduce='sum')) == [('bar', 40)]
+    assert list(a.difference(b, reduce='max')) == [('baz', 16)]
+    assert list(a.symmetric_difference(b, reduce='count')) == [
+        ('baz', 1), ('moo', 1)]
+    assert a.union(b, c, reduce='sum').count() == 3
+    assert list(a.union(b, reduce='sum').values_array()) == [40, 16, 64]
+    assert a.union(b, c, reduce='count').sum() == 6
+    with pytest.raises(ValueError):
+        a.union(b, reduce='avg')
+    with pytest.raises(TypeError):
+        a.union(b, reduction='sum')
+
+    big = Map.from_iter({'bar': 2 ** 64 - 1})
+    assert list(a.union(big, reduce='sum')) == [
+        ('bar', 2 ** 64 - 1), ('baz', 16)]
+
+
+def test_map_ops_into(tmpdir):
+    a = Map.from_iter({'bar': 8, 'baz': 16})
+    b = Map.from_iter({'bar': 32, 'moo': 64})
+    union = a.union_into(str(tmpdir.join('union.fst')), b)
+    assert list(union.items()) == [('bar', 32), ('baz', 16), ('moo', 64)]
+    union = a.union_into(str(tmpdir.join('sum.fst')), b, reduce='sum')
+    assert union['bar'] == 40
+    union = a.union_into(str(tmpdir.join('none.fst')), b, reduce=None)
+    assert union['bar'] == 32
+    inter = a.intersection_into(str(tmpdir.join('inter.fst')), b,
+                                reduce='min')
+    assert list(inter.items()) == [('bar', 8)]
+    diff = a.difference_into(str(tmpdir.join('diff.fst')), b)
+    assert list(diff.items()) == [('baz', 16)]
+    symdiff = a.symmetric_difference_into(str(tmpdir.join('symdiff.fst')), b)
+    assert list(symdiff.items()) == [('baz', 16), ('moo', 64)]
+    with pytest.raises(ValueError):
+        a.union_into(str(tmpdir.join('bad.fst')), b, reduce='avg')
+
+
+def test_mutable_map(tmpdir):
+    path = str(tmpdir.join('mutable'))
+    with MutableMap(path, buffer_size=2) as fst_map:
+        fst_map.update({'foo': 1, 'bar': 2})
+        fst_map['baz'] = 3
+        fst_map['foo'] = 4
+        assert fst_map['foo'] == 4
+        del fst_map['bar']
+        with pytest.raises(KeyError):
+            fst_map['bar']
+        with pytest.raises(KeyError):
+            del fst_map['moo']
+        with pytest.raises(ValueError):
+            fst_map['moo'] = -1
+        assert list(fst_map.items()) == [('baz', 3), ('foo', 4)]
+    fst_map = MutableMap(path)
+    assert fst_map.get('foo') == 4
+    assert fst_map.get('bar', 7) == 7
+    fst_map['bar'] = 5
+    fst_map.flush()
+    assert list(fst_map.items()) == [('bar', 5), ('baz', 3), ('foo', 4)]
+    fst_map.compact()
+    assert list(fst_map.keys()) == ['bar', 'baz', 'foo']
+    assert list(fst_map.values()) == [5, 3, 4]
+    assert len(fst_map) == 3
+
+
+def test_fanout():
+    maps = [Map.from_iter({'bar': 8, 'baz': 16}),
+            Map.from_iter({'bar': 32, 'moo': 64})]
+    assert list(fanout.search_re(maps, r'ba.')) == [
+        ('bar', ((0, 8), (1, 32))), ('baz', ((0, 16),))]
+    assert list(fanout.search(maps, 'bar', 1, reduce='sum')) == [
+        ('bar', 40), ('baz', 16)]
+    assert list(fanout.key_range(maps, 'baz', reduce='max')) == [
+        ('baz', 16), ('moo', 64)]
+    assert list(fanout.prefix(maps, 'b', reduce='count')) == [
+        ('bar', 2), ('baz', 1)]
+    with pytest.raises(ValueError):
+        fanout.search_re([maps[0], Set.from_iter(['bar'])], r'.*')
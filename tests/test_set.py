@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
+import threading
+
 import pytest
 
 import rust_fst.lib as lib
-from rust_fst import Set
+from rust_fst import (AutomatonCache, Levenshtein, MutableMap, MutableSet,
+                      Query, Regex, Set, ShardedSet, extsort, fanout)
 
 
 TEST_KEYS = [u"möö", "bar", "baz", "foo"]
@@ -147,3 +150,503 @@ def test_range(fst_set):
         fst_set['c':'a']
     with pytest.raises(ValueError):
         fst_set['c']
+
+
+def test_build_insert_many(tmpdir):
+    fst_path = str(tmpdir.join('test.fst'))
+    with Set.build(fst_path) as builder:
+        builder.insert_many(sorted(TEST_KEYS)[:2])
+        builder.insert_many([])
+        builder.insert_many(iter(sorted(TEST_KEYS)[2:]))
+    assert list(Set(fst_path)) == sorted(TEST_KEYS)
+
+
+def test_build_insert_many_outoforder():
+    with pytest.raises(lib.TransducerError):
+        with Set.build() as builder:
+            builder.insert_many(["foo", "bar"])
+
+
+def test_build_batched():
+    keys = ["key{:05}".format(i) for i in range(1000)]
+    memset = Set.from_iter(keys, batch_size=7)
+    assert list(memset) == keys
+
+
+def test_bytes_keys(tmpdir):
+    keys = [b"\x00bar", b"baz", b"f\x00o", b"\xff\xfe"]
+    fst_path = str(tmpdir.join('test.fst'))
+    Set.from_iter(keys, path=fst_path, keys='bytes')
+    fst_set = Set(fst_path, keys='bytes')
+    assert list(fst_set) == keys
+    for key in keys:
+        assert key in fst_set
+    assert b"f" not in fst_set
+    assert list(fst_set[b'baz':b'\xff']) == [b"baz", b"f\x00o"]
+
+
+def test_bytes_keys_memory():
+    keys = [b"bar", b"baz", b"foo"]
+    memset = Set.from_iter(keys, keys='bytes')
+    assert list(memset.search_re(r'ba.*')) == [b"bar", b"baz"]
+    other = Set.from_iter([b"abc", b"bar"], keys='bytes')
+    assert list(memset.union(other)) == [b"abc", b"bar", b"baz", b"foo"]
+
+
+def test_bad_key_type():
+    with pytest.raises(ValueError):
+        Set.from_iter(["foo"], keys='int')
+
+
+def test_build_unsorted(tmpdir):
+    keys = ["key{:03}".format(i % 300) for i in range(999, -1, -1)]
+    fst_path = str(tmpdir.join('test.fst'))
+    fst_set = Set.from_unsorted(keys, fst_path, memory_limit=1024,
+                                tmpdir=str(tmpdir))
+    assert list(fst_set) == sorted(set(keys))
+    assert tmpdir.listdir() == [tmpdir.join('test.fst')]
+
+
+def test_build_unsorted_memory():
+    assert list(Set.from_unsorted(TEST_KEYS * 2)) == sorted(TEST_KEYS)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_sharded(tmpdir, processes):
+    keys = ["key{:04}".format(i) for i in range(0, 1000, 3)]
+    fst_set = ShardedSet.from_iter(keys, str(tmpdir.join('sharded')),
+                                   num_shards=3, processes=processes)
+    assert len(fst_set.shards) == 3
+    assert len(fst_set) == len(keys)
+    assert list(fst_set) == keys
+    assert "key0003" in fst_set
+    assert "key0001" not in fst_set
+    assert "a" not in fst_set and "z" not in fst_set
+    assert list(fst_set["key0100":"key0200"]) == [
+        k for k in keys if "key0100" <= k < "key0200"]
+    assert list(fst_set.search_re(r'key099.')) == ["key0990", "key0993",
+                                                   "key0996", "key0999"]
+    assert list(fst_set.search("key0999", 1)) == ["key0999"]
+
+
+def test_sharded_ops(tmpdir):
+    a = ["key{:04}".format(i) for i in range(0, 100, 3)]
+    b = ["key{:04}".format(i) for i in range(0, 100, 2)]
+    sa = ShardedSet.from_iter(a, str(tmpdir.join('a')), num_shards=3,
+                              processes=1)
+    sb = ShardedSet.from_iter(b, str(tmpdir.join('b')), num_shards=2,
+                              processes=1)
+    assert list(sa.union(sb)) == sorted(set(a) | set(b))
+    assert list(sa.intersection(sb)) == sorted(set(a) & set(b))
+    assert list(sa.difference(sb)) == sorted(set(a) - set(b))
+    assert list(sa.symmetric_difference(sb)) == sorted(set(a) ^ set(b))
+    assert sa.issubset(sa) and sa.issuperset(sa)
+    assert not sa.issubset(sb) and not sa.isdisjoint(sb)
+
+
+def test_sharded_unsorted(tmpdir):
+    with pytest.raises(lib.TransducerError):
+        ShardedSet.from_iter(["foo", "bar"], str(tmpdir.join('sharded')),
+                             num_shards=2, processes=1)
+
+
+def test_insert_records(tmpdir):
+    src = str(tmpdir.join('records'))
+    with open(src, 'wb') as fp:
+        start = extsort.write_records(fp, [b"bar", b"baz"])
+        end = start + extsort.write_records(fp, [b"foo", b"moo"])
+    with Set.build(keys='bytes') as builder:
+        builder.insert_records(src, start, end)
+    assert list(builder.get_set()) == [b"foo", b"moo"]
+
+
+def test_from_file(tmpdir):
+    src = tmpdir.join('keys.txt')
+    src.write_binary(u"bar\r\nbaz\n\nfoo\nmöö".encode('utf8'))
+    fst_path = str(tmpdir.join('test.fst'))
+    fst_set = Set.from_file(str(src), fst_path)
+    assert list(fst_set) == sorted(TEST_KEYS)
+    assert list(Set.from_file(str(src))) == sorted(TEST_KEYS)
+
+
+def test_from_file_bytes(tmpdir):
+    src = tmpdir.join('keys.txt')
+    src.write_binary(b"\x00bar\nf\x00o\n\xff\xfe\n")
+    fst_set = Set.from_file(str(src), keys='bytes')
+    assert list(fst_set) == [b"\x00bar", b"f\x00o", b"\xff\xfe"]
+    with pytest.raises(ValueError) as excinfo:
+        Set.from_file(str(src))
+    assert "line 3" in str(excinfo.value)
+
+
+def test_from_file_unsorted(tmpdir):
+    src = tmpdir.join('keys.txt')
+    src.write("bar\nfoo\nbaz\n")
+    with pytest.raises(lib.TransducerError) as excinfo:
+        Set.from_file(str(src))
+    assert "line 3" in str(excinfo.value)
+
+
+def test_from_file_missing(tmpdir):
+    with pytest.raises(OSError):
+        Set.from_file(str(tmpdir.join('missing.txt')))
+
+
+def test_to_bytes(fst_set):
+    data = fst_set.to_bytes()
+    assert isinstance(data, bytes)
+    loaded = Set.from_buffer(data)
+    assert list(loaded) == list(fst_set)
+    assert loaded.to_bytes() == data
+
+
+def test_from_buffer_mmap(tmpdir):
+    import mmap
+    fst_path = str(tmpdir.join('test.fst'))
+    do_build(fst_path)
+    with open(fst_path, 'rb') as fp:
+        buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    fst_set = Set.from_buffer(buf)
+    del buf
+    assert list(fst_set) == sorted(TEST_KEYS)
+    assert u"möö" in fst_set
+
+
+def test_from_buffer_invalid():
+    with pytest.raises(lib.FstError):
+        Set.from_buffer(b"not an fst")
+
+
+@pytest.mark.parametrize("prefetch", ["none", "full", "async"])
+@pytest.mark.parametrize("access", [None, "random", "sequential"])
+def test_open_prefetch(tmpdir, prefetch, access):
+    fst_path = str(tmpdir.join('test.fst'))
+    do_build(fst_path)
+    fst_set = Set(fst_path, prefetch=prefetch, access=access)
+    assert list(fst_set) == sorted(TEST_KEYS)
+    assert "bar" in fst_set
+
+
+def test_open_prefetch_invalid(tmpdir):
+    fst_path = str(tmpdir.join('test.fst'))
+    do_build(fst_path)
+    with pytest.raises(ValueError):
+        Set(fst_path, prefetch="eager")
+    with pytest.raises(ValueError):
+        Set(fst_path, access="backwards")
+
+
+def test_open_prefetch_empty_file(tmpdir):
+    fst_path = tmpdir.join('empty.fst')
+    fst_path.write_binary(b'')
+    for kwargs in ({}, {'prefetch': "full"}, {'access': "random"}):
+        with pytest.raises(lib.FstError):
+            Set(str(fst_path), **kwargs)
+
+
+def test_warmup(tmpdir):
+    fst_path = str(tmpdir.join('test.fst'))
+    do_build(fst_path)
+    for fst_set in (Set(fst_path), Set(fst_path, access="random"),
+                    Set.from_iter(sorted(TEST_KEYS))):
+        fst_set.warmup().join()
+        assert "foo" in fst_set
+
+
+def test_contains_many(fst_set):
+    keys = ["bar", "qux", u"möö", "", "foo", "fo"]
+    result = fst_set.contains_many(keys)
+    assert len(result) == len(keys)
+    assert list(result) == [True, False, True, False, True, False]
+    assert len(fst_set.contains_many([])) == 0
+
+
+def test_contains_many_batches():
+    keys = ["key{:05}".format(i) for i in range(0, 10000, 2)]
+    fst_set = Set.from_iter(keys)
+    candidates = ["key{:05}".format(i) for i in range(10000)]
+    result = fst_set.contains_many(iter(candidates))
+    assert list(result) == [i % 2 == 0 for i in range(10000)]
+
+
+def test_contains_many_numpy(fst_set):
+    np = pytest.importorskip("numpy")
+    keys = np.array(["bar", "qux", u"möö"])
+    result = fst_set.contains_many(keys)
+    assert result.dtype == np.bool_
+    assert result.tolist() == [True, False, True]
+    result = fst_set.contains_many(np.array(["foo", "qux"], dtype=object))
+    assert result.tolist() == [True, False]
+
+
+def run_threads(target, num_threads=8):
+    errors = []
+
+    def run():
+        try:
+            target()
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_concurrent_reads():
+    keys = ["key{:05}".format(i) for i in range(0, 10000, 2)]
+    fst_set = Set.from_iter(keys)
+
+    def query():
+        for i in range(200):
+            key = "key{:05}".format(i * 37 % 10000)
+            assert (key in fst_set) == (i * 37 % 2 == 0)
+            expected = ["key0000{}".format(n) for n in range(0, 10, 2)]
+            assert list(fst_set.search_re(r'key0000.')) == expected
+            assert list(fst_set.search("key00001", 1)) == expected
+            with pytest.raises(lib.RegexError):
+                fst_set.search_re(r'(key')
+        with pytest.raises(lib.LevenshteinError):
+            fst_set.search("areallylongstring", 8)
+    run_threads(query)
+
+
+def test_search_compiled_automata(fst_set):
+    other_set = Set.from_iter(["bad", "bam", "foo"])
+    lev = Levenshtein("bam", 1)
+    regex = Regex(r'ba.*')
+    assert list(fst_set.search(lev)) == ["bar", "baz"]
+    assert list(other_set.search(lev)) == ["bad", "bam"]
+    assert list(fst_set.search_re(regex)) == ["bar", "baz"]
+    assert list(other_set.search_re(regex)) == ["bad", "bam"]
+    assert regex.memory > 0
+    with pytest.raises(ValueError):
+        fst_set.search(lev, 1)
+    with pytest.raises(ValueError):
+        fst_set.search("bam")
+    with pytest.raises(lib.RegexError):
+        Regex(r'ba.*?')
+
+
+def test_automaton_cache():
+    cache = AutomatonCache(max_entries=2)
+    lev = cache.levenshtein("bam", 1)
+    assert cache.levenshtein("bam", 1) is lev
+    cache.regex(r'ba.*')
+    cache.regex(r'fo.*')
+    assert cache.levenshtein("bam", 1) is not lev
+    info = cache.info()
+    assert (info.hits, info.misses, info.entries) == (1, 4, 2)
+    with pytest.raises(lib.RegexError):
+        cache.regex(r'ba.*?')
+    assert cache.info().entries == 2
+    cache.configure(max_entries=None, max_memory=info.memory - 1)
+    assert cache.info().entries == 1
+    cache.configure(max_entries=5)
+    assert cache.info()[-2:] == (5, info.memory - 1)
+    cache.configure(max_memory=None)
+    assert cache.info()[-2:] == (5, None)
+    cache.clear()
+    assert cache.info()[:3] == (0, 0, 0)
+
+
+def test_prefix():
+    fst_set = Set.from_iter([u"fo", u"foo", u"foo\xff", u"fo\xf6", u"fp",
+                             u"m\xf6\xf6", u"m\xf6\xf7"])
+    assert list(fst_set.prefix("foo")) == [u"foo", u"foo\xff"]
+    assert list(fst_set.prefix(u"m\xf6")) == [u"m\xf6\xf6", u"m\xf6\xf7"]
+    assert list(fst_set.prefix("x")) == []
+    assert list(fst_set.prefix("")) == list(fst_set)
+    assert fst_set.count_prefix("fo") == 4
+    assert fst_set.count_prefix("") == len(fst_set)
+    assert Set.from_iter([b"a\xff", b"a\xff\xff", b"b"],
+                         keys='bytes').count_prefix(b"a\xff") == 2
+
+
+def test_count(fst_set):
+    assert fst_set.search_re(r'ba.*').count() == 2
+    assert fst_set.search("bam", 1).count() == 2
+    assert fst_set["b":"f"].count() == 2
+    assert fst_set.union(Set.from_iter(["zap"])).count() == 5
+    it = iter(fst_set)
+    next(it)
+    assert it.count() == 3
+    assert it.count() == 0
+
+
+def test_take(fst_set):
+    assert fst_set.search_re(r'.*').take(2) == ["bar", "baz"]
+    assert fst_set.search_re(r'.*').take(2, offset=3) == [u"möö"]
+    assert fst_set.search("bam", 1).take(10) == ["bar", "baz"]
+    assert fst_set.prefix("ba").take(0) == []
+    assert fst_set.union(Set.from_iter(["zap"])).take(2, offset=3) == [
+        u"möö", "zap"]
+    assert fst_set["c":].take(5, offset=10) == []
+    it = iter(fst_set)
+    assert next(it) == "bar"
+    assert it.take(2) == ["baz", "foo"]
+    assert it.take(2) == []
+    assert list(it) == []
+
+
+def test_close(fst_set):
+    it = fst_set.search_re(r'.*')
+    next(it)
+    it.close()
+    it.close()
+    assert list(it) == []
+    assert it.count() == 0
+
+
+def test_search_ranked(fst_set):
+    other_set = Set.from_iter(["bam", "bar", "bas", "bat", "cam"])
+    assert other_set.search_ranked("bam", 1) == [
+        ("bam", 0), ("bar", 1), ("bas", 1), ("bat", 1), ("cam", 1)]
+    assert other_set.search_ranked("bam", 1, k=2) == [("bam", 0), ("bar", 1)]
+    assert other_set.search_ranked(Levenshtein("bat", 0)) == [("bat", 0)]
+    assert other_set.search_ranked("bam", 1, k=0) == []
+    # Distances are counted in characters, not in bytes
+    assert fst_set.search_ranked("moo", 2) == [("foo", 1), (u"möö", 2)]
+
+
+def test_rank_select(fst_set, tmpdir):
+    keys = sorted(TEST_KEYS)
+    for idx, key in enumerate(keys):
+        assert fst_set.rank(key) == idx
+        assert fst_set.select(idx) == key
+    assert fst_set.select(-1) == u"möö"
+    assert fst_set.rank("a") == 0
+    assert fst_set.rank("bas") == 1
+    assert fst_set.rank("ba") == 0
+    assert fst_set.rank("zzz") == 4
+    with pytest.raises(IndexError):
+        fst_set.select(4)
+    with pytest.raises(IndexError):
+        fst_set.select(-5)
+
+    big_keys = ["key{:05d}".format(i) for i in range(1000)]
+    big_set = Set.from_iter(big_keys)
+    path = str(tmpdir.join('ranks.idx'))
+    big_set.build_rank_index(path)
+    other_set = Set.from_iter(big_keys)
+    other_set.load_rank_index(path)
+    for idx in (0, 1, 31, 32, 500, 999):
+        assert other_set.select(idx) == big_keys[idx]
+        assert other_set.rank(big_keys[idx]) == idx
+    assert other_set.rank("key00500a") == 501
+    with pytest.raises(ValueError):
+        fst_set.load_rank_index(path)
+
+
+def test_query():
+    fst_set = Set.from_iter(["bam", "bar", "bat", "cam", "car", "cat", "dog",
+                             "mar", "mat", "moo"])
+    query = Query().ge("bat").lt("mat").search_re(r'.a.').search("bar", 1)
+    assert list(fst_set.query(query)) == ["bat", "car", "mar"]
+    query = Query().search_re(r'.a.').prefix("c", negate=True)
+    assert list(fst_set.query(query)) == ["bam", "bar", "bat", "mar", "mat"]
+    query = Query().prefix("ca").search("cat", 0, negate=True).gt("cam")
+    assert list(fst_set.query(query)) == ["car"]
+    query = Query().search(Levenshtein("mat", 1)).le("mat")
+    assert fst_set.query(query).count() == 4
+    assert fst_set.query(query).take(2, offset=1) == ["cat", "mar"]
+    assert list(fst_set.query(Query())) == list(fst_set)
+    assert list(fst_set.query(Query().gt("z"))) == []
+
+
+def test_next_batch(fst_set):
+    it = iter(fst_set)
+    assert it.next_batch(3) == ["bar", "baz", "foo"]
+    assert it.next_batch(3) == [u"möö"]
+    assert it.next_batch(3) == []
+    it = fst_set.search_re(r'.*')
+    it.batch_size = 1
+    assert next(it) == "bar"
+    assert it.next_batch() == ["baz"]
+    assert list(it) == ["foo", u"möö"]
+    big_set = Set.from_iter("key{:05d}".format(i) for i in range(5000))
+    assert list(big_set) == ["key{:05d}".format(i) for i in range(5000)]
+
+
+def test_to_arrays(fst_set):
+    arrays = fst_set.to_arrays()
+    assert list(arrays.offsets) == [0, 3, 6, 9, 14]
+    assert bytes(arrays.data) == u"barbazfoomöö".encode('utf8')
+    assert arrays.values is None
+    arrays = fst_set.to_arrays("baz", "m")
+    assert list(arrays.offsets) == [0, 3, 6]
+    assert bytes(arrays.data) == b"bazfoo"
+    assert bytes(fst_set.search("fo", 1).to_arrays().data) == b"foo"
+    it = iter(fst_set)
+    next(it)
+    arrays = it.to_arrays()
+    assert list(arrays.offsets) == [0, 3, 6, 11]
+    assert list(it) == []
+
+
+def test_ops_into(tmpdir):
+    a = Set.from_iter(["bar", "baz", "foo"])
+    b = Set.from_iter(["bar", "moo"])
+    union = a.union_into(str(tmpdir.join('union.fst')), b)
+    assert list(union) == ["bar", "baz", "foo", "moo"]
+    assert list(a.intersection_into(str(tmpdir.join('inter.fst')), b)) == [
+        "bar"]
+    assert list(a.difference_into(str(tmpdir.join('diff.fst')), b)) == [
+        "baz", "foo"]
+    assert list(a.symmetric_difference_into(
+        str(tmpdir.join('symdiff.fst')), b)) == ["baz", "foo", "moo"]
+    with pytest.raises(OSError):
+        a.union_into(str(tmpdir.join('missing', 'union.fst')), b)
+
+
+def test_mutable_set(tmpdir):
+    path = str(tmpdir.join('mutable'))
+    with MutableSet(path, buffer_size=2) as fst_set:
+        fst_set.update(["foo", "bar"])
+        fst_set.add("baz")
+        fst_set.discard("foo")
+        assert "foo" not in fst_set
+        assert "bar" in fst_set
+        assert list(fst_set) == ["bar", "baz"]
+        assert len(fst_set) == 2
+    fst_set = MutableSet(path)
+    assert list(fst_set) == ["bar", "baz"]
+    fst_set.add("foo")
+    fst_set.discard("bar")
+    assert list(fst_set) == ["baz", "foo"]
+    fst_set.compact()
+    assert len(fst_set.segments) == 1
+    assert list(fst_set) == ["baz", "foo"]
+    with pytest.raises(ValueError):
+        MutableMap(path)
+
+
+def test_mutable_set_discard_missing(tmpdir):
+    with MutableSet(str(tmpdir.join('mutable'))) as fst_set:
+        fst_set.add("foo")
+        fst_set.flush()
+        fst_set.discard("bar")
+        fst_set.flush()
+        assert all(seg.tombstones is None for seg in fst_set.segments)
+        assert list(fst_set) == ["foo"]
+
+
+def test_fanout():
+    sets = [Set.from_iter(["bar", "baz", "foo"]),
+            Set.from_iter(["bar", "moo"]),
+            Set.from_iter(["fob", "foo"])]
+    assert list(fanout.search_re(sets, r'ba.|mo+')) == [
+        ("bar", (0, 1)), ("baz", (0,)), ("moo", (1,))]
+    assert list(fanout.search(sets, "foo", 1)) == [
+        ("fob", (2,)), ("foo", (0, 2)), ("moo", (1,))]
+    assert list(fanout.key_range(sets, "baz", "fob")) == [("baz", (0,))]
+    assert list(fanout.prefix(sets, "f")) == [("fob", (2,)), ("foo", (0, 2))]
+    assert list(fanout.query(sets, Query().search_re(r'.o.').lt('moo'))) == [
+        ("fob", (2,)), ("foo", (0, 2))]
+    assert fanout.search_re(sets, r'.*').count() == 5
+    with pytest.raises(ValueError):
+        fanout.search_re([], r'.*')
+    with pytest.raises(ValueError):
+        fanout.search_re(sets, r'.*', reduce='sum')